@@ -22,15 +22,14 @@ along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
 
 import logging
 
-from dotenv import load_dotenv
-from flask  import cli, Flask
-from os     import environ, getenv
+from dotenv                        import load_dotenv
+from flask                         import cli, Flask
+from os                            import environ, getenv
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 app = Flask(__name__)
 
-from src.routes import *
-
-# Set environment
+# Set environment before the modules that read it are imported
 load_dotenv('.env')
 
 for key in ['DATABASE_URL', 'SECRET_KEY', 'ADMIN_PASSWORD']:
@@ -40,6 +39,16 @@ for key in ['DATABASE_URL', 'SECRET_KEY', 'ADMIN_PASSWORD']:
 
 app.secret_key = getenv("SECRET_KEY")
 
+# Gunicorn listens on localhost behind a reverse proxy, so the client's address is
+# taken from the X-Forwarded-For header of the trusted proxies. 0 trusts none.
+PROXY_HOPS = int(getenv('PROXY_HOPS', 1))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS)  # type: ignore
+
+from src.routes      import *
+from src.api         import *
+from src.compression import *
+
 
 def main() -> None:
     """Main application."""
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import multiprocessing
+
+# Each connection is a greenlet, so idle live update streams are cheap
+bind = '127.0.0.1:5000'
+workers = multiprocessing.cpu_count()
+worker_class = 'gevent'
+worker_connections = 1000
+
+
+def post_fork(server, worker) -> None:
+    """Make psycopg2 yield to other greenlets while waiting for the database."""
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import http.cookiejar
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from datetime import datetime
+from typing   import Callable
+
+SCENARIOS   = ['index', 'thread', 'search', 'reply', 'like', 'unlike']
+DEFAULT_MIX = 'index=30,thread=35,search=10,reply=5,like=10,unlike=10'
+
+SEARCH_WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'quiquia', 'numquam', 'tempora']
+
+THREAD_LINK     = re.compile(r'/thread/(\d+)')
+LIKE_LINK       = re.compile(r'/like_reply/(\d+)/(\d+)')
+CATEGORY_OPTION = re.compile(r'<option value="(\d+)">')
+
+# Common and combined log formats, e.g. the gunicorn access log
+ACCESS_LOG_LINE = re.compile(r'\[(?P<time>[^\]]+)\] "(?P<method>[A-Z]+) (?P<path>\S+) [^"]*" (?P<status>\d{3})')
+
+# Logged requests that would log the client out, change its user, or delete the content being replayed
+REPLAY_SKIPPED = re.compile(r'^/(logout|login|register|delete_category|delete_thread|delete_reply)\b')
+
+# Form fields of the logged POST requests by path, the access log doesn't record them
+REPLAY_FORMS = {'/submit_thread/'          : ['category_id', 'title', 'content'],
+                '/submit_modified_thread/' : ['title', 'content'],
+                '/submit_reply/'           : ['content'],
+                '/submit_modified_reply/'  : ['content'],
+                '/create_category'         : ['category_name'],
+                '/create_group'            : ['group_name']}
+
+
+###############################################################################
+#                                   RESULTS                                   #
+###############################################################################
+
+class Results:
+
+    def __init__(self) -> None:
+        """Create new Results object.
+
+        Latencies are recorded per route, with the numeric parts
+        of the path replaced so that e.g. all threads share a route.
+        """
+        self.latencies : dict[str, list[float]] = dict()
+        self.errors : dict[str, int] = dict()
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"  Results ({sum(map(len, self.latencies.values()))} requests)"
+
+    def record(self, route: str, seconds: float, ok: bool) -> None:
+        """Record the latency of a request, and whether it failed."""
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            self.errors.setdefault(route, 0)
+            if not ok:
+                self.errors[route] += 1
+
+    def report(self, elapsed: float) -> str:
+        """Return the latency percentiles, throughput and error rate of each route as a table."""
+        lines = [f"{'route':<36} {'requests':>8} {'req/s':>8} {'errors':>7} "
+                 f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"]
+
+        with self.lock:
+            routes = sorted(self.latencies.items())
+            everything = sorted(latency for _, latencies in routes for latency in latencies)
+            routes.append(('total', everything))
+            errors = {**self.errors, 'total': sum(self.errors.values())}
+
+        for route, latencies in routes:
+            if not latencies:
+                continue
+            latencies = sorted(latencies)
+            lines.append(f"{route:<36} {len(latencies):>8} {len(latencies) / elapsed:>8.1f} "
+                         f"{errors[route] / len(latencies):>7.1%} "
+                         f"{percentile(latencies, 50) * 1000:>8.1f} {percentile(latencies, 95) * 1000:>8.1f} "
+                         f"{percentile(latencies, 99) * 1000:>8.1f} {latencies[-1] * 1000:>8.1f}")
+        return '\n'.join(lines)
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    """Return the nearest-rank percentile of sorted values."""
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def route_of(path: str) -> str:
+    """Return the route of the path, e.g. /thread/<id>/ for /thread/12/."""
+    return re.sub(r'/\d+', '/<id>', urllib.parse.urlsplit(path).path)
+
+
+###############################################################################
+#                                    CLIENT                                   #
+###############################################################################
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Return redirects as they are, so that only the timed request is made."""
+
+    def redirect_request(self, *args, **kwargs) -> None:
+        return None
+
+
+class Client:
+
+    def __init__(self, base_url: str, results: Results, timeout: float) -> None:
+        """Create new Client object.
+
+        Each client has a cookie jar of its own, i.e. it's logged in as one user.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.results = results
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                                                  NoRedirect)
+
+    def __repr__(self) -> str:
+        return f"  Client ({self.base_url})"
+
+    def request(self, path: str, data: dict[str, str] | None = None, record: bool = True) -> tuple[int, str]:
+        """Make a GET, or a POST if there's form data. Return the status and the body."""
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(self.base_url + path, body, timeout=self.timeout) as response:
+                status, text = response.status, response.read().decode(errors='replace')
+        except urllib.error.HTTPError as error:
+            status, text = error.code, error.read().decode(errors='replace')
+        except (urllib.error.URLError, OSError):
+            status, text = 0, ''
+        seconds = time.perf_counter() - start
+
+        if record:
+            self.results.record(route_of(path), seconds, ok=0 < status < 400)
+        return status, text
+
+    def login(self, username: str, password: str) -> bool:
+        """Log in. Return True if the login succeeded."""
+        self.request('/login', {'username': username, 'password': password}, record=False)
+        return self.is_logged_in()
+
+    def is_logged_in(self) -> bool:
+        """Return True if the session belongs to a logged in user."""
+        status, _ = self.request('/api/categories', record=False)
+        return status == 200
+
+
+###############################################################################
+#                                  SCENARIOS                                  #
+###############################################################################
+
+class User:
+
+    def __init__(self, client: Client) -> None:
+        """Create new User object.
+
+        The user remembers the threads and replies it has seen,
+        and the replies it has liked, so that the requests it
+        makes refer to content that exists.
+        """
+        self.client = client
+        self.thread_ids : list[int] = list()
+        self.likeable : list[tuple[int, int]] = list()
+        self.liked : list[tuple[int, int]] = list()
+
+    def __repr__(self) -> str:
+        return f"  User ({len(self.thread_ids)} threads, {len(self.liked)} liked replies)"
+
+    def index(self) -> None:
+        """Load the front page."""
+        _, text = self.client.request('/')
+        thread_ids = list(dict.fromkeys(int(thread_id) for thread_id in THREAD_LINK.findall(text)))
+        if thread_ids:
+            self.thread_ids = thread_ids
+
+    def thread(self) -> None:
+        """Load a thread page."""
+        if not self.thread_ids:
+            return self.index()
+
+        _, text = self.client.request(f'/thread/{random.choice(self.thread_ids)}/')
+        likeable = [(int(thread_id), int(reply_id)) for thread_id, reply_id in LIKE_LINK.findall(text)]
+        if likeable:
+            self.likeable = likeable
+
+    def search(self) -> None:
+        """Search posts."""
+        self.client.request('/search_posts/?' + urllib.parse.urlencode({'query': random.choice(SEARCH_WORDS)}))
+
+    def reply(self) -> None:
+        """Reply to a thread."""
+        if not self.thread_ids:
+            return self.index()
+
+        content = random_sentence(12)
+        self.client.request(f'/submit_reply/{random.choice(self.thread_ids)}/', {'content': content})
+
+    def like(self) -> None:
+        """Like a reply seen on a thread page."""
+        if not self.likeable:
+            return self.thread()
+
+        thread_id, reply_id = self.likeable.pop(random.randrange(len(self.likeable)))
+        self.client.request(f'/like_reply/{thread_id}/{reply_id}/', {})
+        self.liked.append((thread_id, reply_id))
+
+    def unlike(self) -> None:
+        """Remove a like the user made earlier."""
+        if not self.liked:
+            return self.like()
+
+        thread_id, reply_id = self.liked.pop(random.randrange(len(self.liked)))
+        self.client.request(f'/unlike_reply/{thread_id}/{reply_id}/', {})
+
+
+def random_sentence(words: int) -> str:
+    """Return a sentence of random search words, so that the posts show up in searches."""
+    return ' '.join(random.choices(SEARCH_WORDS, k=words)).capitalize() + '.'
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    """Parse request mix such as 'index=30,thread=70' into weights by scenario."""
+    weights = dict()
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise ValueError(f"Unknown scenario '{name}'.")
+        weights[name.strip()] = int(weight)
+    if sum(weights.values()) <= 0:
+        raise ValueError("The request mix needs a positive weight.")
+    return weights
+
+
+def run_mix(user: User, weights: dict[str, int], deadline: float, stop: threading.Event) -> None:
+    """Run scenarios picked by weight until the deadline."""
+    names = list(weights)
+    scenarios : list[Callable[[], None]] = [getattr(user, name) for name in names]
+
+    while time.monotonic() < deadline and not stop.is_set():
+        random.choices(scenarios, weights=[weights[name] for name in names])[0]()
+
+
+###############################################################################
+#                                    REPLAY                                   #
+###############################################################################
+
+def read_access_log(path: str) -> list[tuple[float, str, str]]:
+    """Read the (timestamp, method, path) of each request in an access log."""
+    requests = []
+    with open(path, encoding='utf-8', errors='replace') as file:
+        for line in file:
+            match = ACCESS_LOG_LINE.search(line)
+            if match is None:
+                continue
+            timestamp = datetime.strptime(match['time'], '%d/%b/%Y:%H:%M:%S %z').timestamp()
+            requests.append((timestamp, match['method'], match['path']))
+    return requests
+
+
+def replay_form(path: str, category_ids: list[str]) -> dict[str, str]:
+    """Return form data for a logged POST request to the path. New threads go to one of `category_ids`."""
+    fields = next((fields for prefix, fields in REPLAY_FORMS.items() if path.startswith(prefix)), [])
+
+    values = {'category_id'   : lambda: random.choice(category_ids or ['1']),
+              'title'         : lambda: random_sentence(4).rstrip('.'),
+              'content'       : lambda: random_sentence(12),
+              'category_name' : lambda: f"Kuormitus {random.randrange(10 ** 6)}",
+              'group_name'    : lambda: f"Kuormitus {random.randrange(10 ** 6)}"}
+    return {field: values[field]() for field in fields}
+
+
+def run_replay(client : Client,
+               lines  : list[tuple[float, str, str]],
+               start  : float,
+               origin : float,
+               speed  : float,
+               stop   : threading.Event
+               ) -> None:
+    """Replay requests of an access log, at their original pace scaled by speed, or as fast as possible.
+
+    Logging out, logging in and deletions are skipped, and POST requests get random form data.
+    """
+    # The categories the client may post new threads to
+    _, text = client.request('/new_thread/', record=False)
+    category_ids = CATEGORY_OPTION.findall(text)
+
+    for timestamp, method, path in lines:
+        if stop.is_set():
+            return
+        if REPLAY_SKIPPED.match(path):
+            continue
+        if speed > 0:
+            time.sleep(max(0.0, start + (timestamp - origin) / speed - time.monotonic()))
+
+        if method == 'POST':
+            client.request(path, replay_form(path, category_ids))
+        else:
+            client.request(path)
+
+
+###############################################################################
+#                                     MAIN                                    #
+###############################################################################
+
+def log_in_clients(args: argparse.Namespace, results: Results) -> list[Client]:
+    """Log in one client per worker, cycling through the synthetic users."""
+    clients = []
+    for i in range(args.workers):
+        client = Client(args.url, results, args.timeout)
+        username = f"{args.prefix}{i % args.users + 1}"
+        if not client.login(username, args.password):
+            raise ValueError(f"Login as {username} failed, create the users with 'manage.py seed-users'.")
+        clients.append(client)
+    return clients
+
+
+def main() -> None:
+    """Run load test against a running forum."""
+    parser = argparse.ArgumentParser(description="Keskusteluforum load test")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="forum address (default http://127.0.0.1:5000)")
+    parser.add_argument('--workers', type=int, default=8, help="concurrent clients (default 8)")
+    parser.add_argument('--users', type=int, default=100, help="number of seeded users to log in as (default 100)")
+    parser.add_argument('--prefix', default='loadtest', help="username prefix of the seeded users (default loadtest)")
+    parser.add_argument('--password', default='loadtest', help="password of the seeded users (default loadtest)")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run the request mix (default 30)")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"scenario weights (default {DEFAULT_MIX})")
+    parser.add_argument('--replay', metavar='ACCESS_LOG', help="replay the requests of an access log instead")
+    parser.add_argument('--speed', type=float, default=0,
+                        help="replay at the logged pace multiplied by this, 0 for as fast as possible (default 0)")
+    parser.add_argument('--timeout', type=float, default=30, help="request timeout in seconds (default 30)")
+    args = parser.parse_args()
+
+    try:
+        results = Results()
+        stop = threading.Event()
+
+        if args.replay:
+            lines = read_access_log(args.replay)
+            if not lines:
+                raise ValueError(f"No requests found in {args.replay}.")
+            clients = log_in_clients(args, results)
+            origin, start = lines[0][0], time.monotonic()
+            # Worker i replays every i-th request, so the log order is roughly kept
+            workers = [threading.Thread(target=run_replay,
+                                        args=(client, lines[i::args.workers], start, origin, args.speed, stop))
+                       for i, client in enumerate(clients)]
+        else:
+            weights = parse_mix(args.mix)
+            clients = log_in_clients(args, results)
+            start = time.monotonic()
+            workers = [threading.Thread(target=run_mix, args=(User(client), weights, start + args.duration, stop))
+                       for client in clients]
+
+    except ValueError as error:
+        print(f"Error: {error}", file=sys.stderr)
+        exit(1)
+
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+    print(results.report(time.monotonic() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import argparse
+import gzip
+import sys
+import time
+
+from datetime import datetime
+from typing   import BinaryIO
+
+
+def build_static(_: argparse.Namespace) -> None:
+    """Build content-hashed, precompressed static assets."""
+    from src.assets import build_static as build, BUILD_DIR
+
+    manifest = build()
+    for name, hashed_name in sorted(manifest.items()):
+        print(f"{name} -> {hashed_name}")
+    print(f"Wrote {len(manifest)} assets to {BUILD_DIR}")
+
+
+def partitions(args: argparse.Namespace) -> None:
+    """Manage the monthly partitions of replies and likes."""
+    from app            import app
+    from src.partitions import (PARTITIONED_TABLES, create_partitions, partition_tables,
+                                archive_partitions, get_partitions, is_partitioned)
+
+    with app.app_context():
+        if args.action == 'convert':
+            if partition_tables(args.months_ahead):
+                print("Converted replies and likes into partitioned tables")
+            else:
+                print("Tables are already partitioned")
+            return
+
+        if not is_partitioned():
+            print("Tables aren't partitioned, run 'manage.py partitions convert' first")
+            return
+
+        if args.action == 'create':
+            for name in create_partitions(args.months_ahead):
+                print(f"Created {name}")
+
+        elif args.action == 'archive':
+            if args.before is None:
+                print("Give the cutoff date with --before")
+                return
+            replies = archive_partitions(datetime.fromisoformat(args.before))
+            print(f"Archive holds {replies} replies")
+
+        elif args.action == 'list':
+            for table in PARTITIONED_TABLES:
+                for name, lower, upper, rows in get_partitions(table):
+                    print(f"{name:<20} {str(lower or 'MINVALUE'):<20} {str(upper):<20} ~{rows} rows")
+
+
+def open_dump(path: str, mode: str) -> BinaryIO:
+    """Open dump file, gzipped if the name ends with .gz. The path - is stdin/stdout."""
+    if path == '-':
+        return sys.stdin.buffer if mode == 'rb' else sys.stdout.buffer
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel=1)
+    return open(path, mode)
+
+
+def export(args: argparse.Namespace) -> None:
+    """Export the forum as NDJSON."""
+    from app      import app
+    from src.dump import export_forum
+
+    start = time.monotonic()
+    with app.app_context(), open_dump(args.file, 'wb') as output:
+        counts = export_forum(output, args.batch_size)
+
+    for table, rows in counts.items():
+        print(f"Exported {rows} rows from {table}", file=sys.stderr)
+    print(f"Export took {time.monotonic() - start:.1f} s", file=sys.stderr)
+
+
+def import_(args: argparse.Namespace) -> None:
+    """Import the forum from NDJSON."""
+    from app      import app
+    from src.dump import import_forum
+
+    start = time.monotonic()
+    with app.app_context(), open_dump(args.file, 'rb') as lines:
+        counts = import_forum(lines, args.batch_size)
+
+    for table, rows in counts.items():
+        print(f"Imported {rows} rows into {table}", file=sys.stderr)
+    print(f"Import took {time.monotonic() - start:.1f} s", file=sys.stderr)
+
+
+def refresh_trending(args: argparse.Namespace) -> None:
+    """Recompute trending thread scores, once or periodically."""
+    from app    import app
+    from src.db import refresh_trending as refresh
+
+    with app.app_context():
+        while True:
+            start = time.monotonic()
+            refresh()
+            print(f"Refreshed trending threads in {time.monotonic() - start:.2f} s")
+
+            if args.every is None:
+                return
+            time.sleep(max(0.0, args.every - (time.monotonic() - start)))
+
+
+def rerender(args: argparse.Namespace) -> None:
+    """Re-render posts rendered by an older renderer version."""
+    from app    import app
+    from src.db import rerender_stale_content
+
+    start = time.monotonic()
+    with app.app_context():
+        rendered = rerender_stale_content(args.batch_size)
+    print(f"Re-rendered {rendered} posts in {time.monotonic() - start:.1f} s")
+
+
+def seed_users(args: argparse.Namespace) -> None:
+    """Create synthetic users for load testing."""
+    from app    import app
+    from src.db import create_tables, insert_users_into_db
+
+    if args.count < 1:
+        raise ValueError("The number of users must be positive.")
+
+    usernames = [f"{args.prefix}{i}" for i in range(1, args.count + 1)]
+
+    # The users may be seeded before the forum has served its first request
+    with app.app_context():
+        create_tables()
+        inserted = insert_users_into_db(usernames, args.password)
+    print(f"Created {inserted} users ({usernames[0]}..{usernames[-1]}, "
+          f"{len(usernames) - inserted} already existed)")
+
+
+def bench(args: argparse.Namespace) -> None:
+    """Compare the per-query cost of rebuilt, registered and prepared hot statements."""
+    from sqlalchemy import text
+
+    from app            import app
+    from src.db         import db, statements
+    from src.statements import benchmark_statement
+    from src.statics    import ADMIN
+
+    modes = ['text', 'registry', 'prepared'] if statements.prepare else ['text', 'registry']
+
+    with app.app_context():
+        sample = db.session.execute(text("SELECT "
+                                         "  replies.reply_id, "
+                                         "  replies.thread_id, "
+                                         "  threads.category_id, "
+                                         "  users.user_id, "
+                                         "  users.username "
+                                         "FROM replies "
+                                         "  JOIN threads ON threads.thread_id = replies.thread_id "
+                                         "  JOIN users ON users.user_id <> replies.user_id "
+                                         "WHERE users.username <> :admin "
+                                         "ORDER BY replies.reply_id "
+                                         "LIMIT 1"), {'admin': ADMIN}).mappings().fetchone()
+        if sample is None:
+            raise ValueError("The benchmark needs at least one reply and two users.")
+
+        params = {'username'    : sample['username'],
+                  'user_id'     : sample['user_id'],
+                  'category_id' : sample['category_id'],
+                  'thread_id'   : sample['thread_id'],
+                  'reply_id'    : sample['reply_id'],
+                  'channel'     : 'bench',
+                  'limit'       : 20,
+                  'offset'      : 0}
+
+        # The server times come from EXPLAIN ANALYZE, which SQLite doesn't have
+        columns = ['wall', 'cpu'] if db.engine.dialect.name == 'sqlite' else ['wall', 'cpu', 'plan', 'exec']
+
+        print(f"{'statement':<30}" + ''.join(f"{mode + ' ' + column:>16}" for mode in modes for column in columns))
+
+        # Like toggles are rolled back, so their notifications are never sent
+        connection = db.session.connection()
+        for statement in statements.statements.values():
+            row = f"{statement.name:<30}"
+            for mode in modes:
+                times = benchmark_statement(statements, connection, statement,
+                                            {name: params[name] for name in statement.params}, mode, args.iterations)
+                row += ''.join(f"{seconds * 1e6:>13.1f} us" for seconds in times[:len(columns)])  # type: ignore
+            print(row)
+
+        db.session.rollback()
+
+    if not statements.prepare:
+        print("Prepared statements are disabled (SQLite or PREPARED_STATEMENTS=0)")
+
+
+def seed(args: argparse.Namespace) -> None:
+    """Fill the database with a large synthetic forum for the plan checks."""
+    from app       import app
+    from src.plans import seed_forum
+
+    start = time.monotonic()
+    with app.app_context():
+        counts = seed_forum(args.users, args.categories, args.threads, args.replies, args.likes, args.reads)
+
+    for table, rows in counts.items():
+        print(f"Inserted {rows} rows into {table}")
+    print(f"Seeding took {time.monotonic() - start:.1f} s")
+
+
+def check_plans(args: argparse.Namespace) -> None:
+    """Assert properties of the query plans of the database helpers."""
+    from app       import app
+    from src.plans import check_plans as check
+
+    with app.app_context():
+        results = check(args.max_cost)
+
+    failed = 0
+    for name, statement, violations in results:
+        print(f"{'FAIL' if violations else 'PASS'}  {name:<32} {' '.join(statement.split())[:80]}")
+        for violation in violations:
+            print(f"        {violation}")
+        failed += bool(violations)
+
+    print(f"{len(results) - failed}/{len(results)} plans passed")
+    if failed:
+        raise ValueError(f"{failed} plan checks failed.")
+
+
+def parse_limits(value: str) -> dict[str, int | None]:
+    """Parse job concurrency limits such as `rerender=2,delete_category=1`. 0 removes the limit."""
+    limits : dict[str, int | None] = dict()
+    for item in value.split(','):
+        job_type, _, limit = item.partition('=')
+        try:
+            limits[job_type.strip()] = int(limit) or None
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid limit '{item}'")
+    return limits
+
+
+def worker(args: argparse.Namespace) -> None:
+    """Run queued background jobs until interrupted."""
+    import logging
+    import signal
+
+    from app      import app
+    from src.db   import create_tables, enqueue_recurring_job
+    from src.jobs import JOB_TYPES, RECURRING_JOB_TYPES, JobWorker
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    limits = {job_type: limit for job_type, (_, limit) in JOB_TYPES.items()}
+    for job_type, limit in (args.limits or {}).items():
+        if job_type not in JOB_TYPES:
+            raise ValueError(f"Unknown job type '{job_type}'.")
+        limits[job_type] = limit
+
+    with app.app_context():
+        create_tables()
+        for job_type in RECURRING_JOB_TYPES:
+            enqueue_recurring_job(job_type)
+
+    job_worker = JobWorker(args.threads, limits)
+    signal.signal(signal.SIGINT,  lambda *_: job_worker.stop())
+    signal.signal(signal.SIGTERM, lambda *_: job_worker.stop())
+
+    print(f"Running {', '.join(limits)} jobs in {args.threads} threads")
+    job_worker.run()
+    print(f"Stopped: {job_worker.stats()}")
+
+
+def enqueue(args: argparse.Namespace) -> None:
+    """Queue a background job, e.g. from cron."""
+    import json
+
+    from app      import app
+    from src.db   import enqueue_job
+    from src.jobs import JOB_TYPES
+
+    if args.job_type not in JOB_TYPES:
+        raise ValueError(f"Unknown job type '{args.job_type}', choose from {', '.join(JOB_TYPES)}.")
+
+    try:
+        payload = json.loads(args.payload)
+    except json.JSONDecodeError:
+        raise ValueError("The payload must be a JSON object.")
+
+    with app.app_context():
+        job_id = enqueue_job(args.job_type, payload, args.delay)
+    print(f"Queued job {job_id} ({args.job_type})")
+
+
+def main() -> None:
+    """Run management command."""
+    parser = argparse.ArgumentParser(description="Keskusteluforum management commands")
+    commands = parser.add_subparsers(required=True, metavar='command')
+
+    command = commands.add_parser('build-static', help="build content-hashed, precompressed static assets")
+    command.set_defaults(func=build_static)
+
+    command = commands.add_parser('partitions', help="manage the monthly partitions of replies and likes")
+    command.add_argument('action', choices=['convert', 'create', 'archive', 'list'])
+    command.add_argument('--months-ahead', type=int, default=3,
+                         help="number of future months to create partitions for (default 3)")
+    command.add_argument('--before', metavar='YYYY-MM-DD', help="archive the months before this date")
+    command.set_defaults(func=partitions)
+
+    command = commands.add_parser('export', help="export the forum as NDJSON")
+    command.add_argument('file', help="output file, gzipped if it ends with .gz, - for stdout")
+    command.add_argument('--batch-size', type=int, default=50_000, help="rows fetched at a time (default 50000)")
+    command.set_defaults(func=export)
+
+    command = commands.add_parser('import', help="import the forum from NDJSON into an empty database")
+    command.add_argument('file', help="input file, gzipped if it ends with .gz, - for stdin")
+    command.add_argument('--batch-size', type=int, default=50_000, help="rows per transaction (default 50000)")
+    command.set_defaults(func=import_)
+
+    command = commands.add_parser('refresh-trending', help="recompute trending thread scores")
+    command.add_argument('--every', type=float, metavar='SECONDS', help="keep refreshing at this interval")
+    command.set_defaults(func=refresh_trending)
+
+    command = commands.add_parser('rerender', help="re-render posts rendered by an older renderer version")
+    command.add_argument('--batch-size', type=int, default=1000, help="posts per transaction (default 1000)")
+    command.set_defaults(func=rerender)
+
+    command = commands.add_parser('seed-users', help="create synthetic users that share one password")
+    command.add_argument('--count', type=int, default=100, help="number of users (default 100)")
+    command.add_argument('--prefix', default='loadtest', help="username prefix (default loadtest)")
+    command.add_argument('--password', default='loadtest', help="password of every user (default loadtest)")
+    command.set_defaults(func=seed_users)
+
+    command = commands.add_parser('bench', help="benchmark the hot statements with and without preparing them")
+    command.add_argument('--iterations', type=int, default=1000, help="runs per statement and mode (default 1000)")
+    command.set_defaults(func=bench)
+
+    command = commands.add_parser('seed', help="fill the database with a large synthetic forum")
+    command.add_argument('--users', type=int, default=500, help="number of users (default 500)")
+    command.add_argument('--categories', type=int, default=20, help="number of categories (default 20)")
+    command.add_argument('--threads', type=int, default=10_000, help="number of threads (default 10000)")
+    command.add_argument('--replies', type=int, default=200_000, help="number of replies (default 200000)")
+    command.add_argument('--likes', type=int, default=400_000, help="like attempts, duplicates are skipped (default 400000)")
+    command.add_argument('--reads', type=int, default=50_000, help="read watermarks (default 50000)")
+    command.set_defaults(func=seed)
+
+    command = commands.add_parser('check-plans', help="check the query plans of the database helpers")
+    command.add_argument('--max-cost', type=float, default=1000.0,
+                         help="highest estimated cost of single-thread and lookup plans (default 1000)")
+    command.set_defaults(func=check_plans)
+
+    command = commands.add_parser('worker', help="run queued background jobs")
+    command.add_argument('--threads', type=int, default=2, help="jobs run at once by this worker (default 2)")
+    command.add_argument('--limits', type=parse_limits, metavar='TYPE=N,...',
+                         help="jobs of a type run at once across all workers, 0 for no limit (default 1 each)")
+    command.set_defaults(func=worker)
+
+    command = commands.add_parser('enqueue', help="queue a background job")
+    command.add_argument('job_type', help="delete_category, refresh_trending, repair_like_counts, rerender or create_partitions")
+    command.add_argument('--payload', default='{}', help="job arguments as a JSON object, e.g. '{\"category_id\": 1}'")
+    command.add_argument('--delay', type=float, default=0.0, help="seconds to wait before running the job")
+    command.set_defaults(func=enqueue)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except ValueError as error:
+        print(f"Error: {error}", file=sys.stderr)
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
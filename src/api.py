@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import Any
+
+import orjson
+
+from flask import request, session, Response
+
+from app import app
+
+from src.statics import (USERNAME, ADMIN, API_MAX_IDS, API_MAX_PAGE_SIZE, SEARCH_PAGE_SIZE, TRENDING_LIMIT,
+                         USER_SEARCH_PAGE_SIZE, SUGGEST_LIMIT, SUGGEST_MIN_LENGTH)
+from src.db import (get_user_id_for_session, get_category_summaries,
+                    get_thread_summaries_by_thread_ids, get_page_of_replies_by_thread_id,
+                    search_from_db, get_search_results, get_trending_threads, search_users, suggest_titles)
+
+
+###############################################################################
+#                                   HELPERS                                   #
+###############################################################################
+
+def json_response(data: Any, status: int = 200) -> Response:
+    """Return data serialized as a JSON response."""
+    return Response(orjson.dumps(data), status=status, mimetype='application/json')
+
+
+def json_error(message: str, status: int) -> Response:
+    """Return error message as a JSON response."""
+    return json_response({'error': message}, status=status)
+
+
+def get_page_arguments() -> tuple[int, int]:
+    """Get page number and page size from the query string."""
+    page = max(1, request.args.get('page', 1, type=int))
+    page_size = min(API_MAX_PAGE_SIZE, max(1, request.args.get('per_page', SEARCH_PAGE_SIZE, type=int)))
+    return page, page_size
+
+
+###############################################################################
+#                                    USERS                                    #
+###############################################################################
+
+@app.route("/api/users")
+def api_users() -> Response:
+    """Return a page of users whose name starts with the `prefix` argument.
+
+    The next page is requested with the last username of the page as the `after` argument.
+    """
+    if not USERNAME in session.keys():
+        return json_error("Login required", 401)
+
+    if session[USERNAME] != ADMIN:
+        return json_error("Admin required", 403)
+
+    limit = min(API_MAX_PAGE_SIZE, max(1, request.args.get('limit', USER_SEARCH_PAGE_SIZE, type=int)))
+
+    return json_response(search_users(request.args.get('prefix', ''), request.args.get('after', ''), limit))
+
+
+###############################################################################
+#                                  CATEGORIES                                 #
+###############################################################################
+
+@app.route("/api/categories")
+def api_categories() -> Response:
+    """Return summaries of the categories the user has access to."""
+    if not USERNAME in session.keys():
+        return json_error("Login required", 401)
+
+    return json_response(get_category_summaries(get_user_id_for_session()))
+
+
+###############################################################################
+#                                   THREADS                                   #
+###############################################################################
+
+@app.route("/api/threads")
+def api_threads() -> Response:
+    """Return summaries of threads listed in the `ids` argument, e.g. `?ids=1,2,3`."""
+    if not USERNAME in session.keys():
+        return json_error("Login required", 401)
+
+    try:
+        thread_ids = list(dict.fromkeys(int(id_) for id_ in request.args.get('ids', '').split(',') if id_))
+    except ValueError:
+        return json_error("Thread ids must be integers", 400)
+
+    if not thread_ids:
+        return json_error("No thread ids given", 400)
+    if len(thread_ids) > API_MAX_IDS:
+        return json_error(f"At most {API_MAX_IDS} thread ids can be requested at once", 400)
+
+    return json_response(get_thread_summaries_by_thread_ids(thread_ids, get_user_id_for_session()))
+
+
+@app.route("/api/threads/<int:thread_id>")
+def api_thread(thread_id: int) -> Response:
+    """Return thread with a page of its replies."""
+    if not USERNAME in session.keys():
+        return json_error("Login required", 401)
+
+    summaries = get_thread_summaries_by_thread_ids([thread_id], get_user_id_for_session())
+
+    if not summaries:
+        return json_error("Thread not found", 404)
+
+    page, page_size = get_page_arguments()
+
+    return json_response({'thread'   : summaries[0],
+                          'page'     : page,
+                          'per_page' : page_size,
+                          'replies'  : get_page_of_replies_by_thread_id(thread_id, page, page_size)})
+
+
+@app.route("/api/trending")
+def api_trending() -> Response:
+    """Return the top trending threads forum-wide, or in the category given in the `category_id` argument."""
+    if not USERNAME in session.keys():
+        return json_error("Login required", 401)
+
+    category_id = request.args.get('category_id', type=int)
+    limit = min(API_MAX_PAGE_SIZE, max(1, request.args.get('limit', TRENDING_LIMIT, type=int)))
+
+    return json_response(get_trending_threads(get_user_id_for_session(), category_id, limit))
+
+
+###############################################################################
+#                                    SEARCH                                   #
+###############################################################################
+
+@app.route("/api/search")
+def api_search() -> Response:
+    """Return a page of threads that match the `q` argument."""
+    if not USERNAME in session.keys():
+        return json_error("Login required", 401)
+
+    query = ' '.join(request.args.get('q', '').split())
+
+    if not query:
+        return json_error("Empty search query", 400)
+
+    page, page_size = get_page_arguments()
+    results, total_results = get_search_results(search_from_db(query), get_user_id_for_session(),
+                                                query, page, page_size)
+
+    return json_response({'query'    : query,
+                          'page'     : page,
+                          'per_page' : page_size,
+                          'total'    : total_results,
+                          'results'  : [{'thread_id'        : result.thread_id,
+                                         'category_id'      : result.category_id,
+                                         'category_name'    : result.category_name,
+                                         'username'         : result.username,
+                                         'created'          : result.created,
+                                         'title'            : result.title,
+                                         'most_recent_post' : result.most_recent_post,
+                                         'snippet'          : ''.join(result.highlight(query))}
+                                        for result in results]})
+
+
+@app.route("/api/suggest")
+def api_suggest() -> Response:
+    """Return threads whose title matches the `q` argument, for search-as-you-type."""
+    if not USERNAME in session.keys():
+        return json_error("Login required", 401)
+
+    query = ' '.join(request.args.get('q', '').split())
+
+    if len(query) < SUGGEST_MIN_LENGTH:
+        return json_response([])
+
+    limit = min(API_MAX_PAGE_SIZE, max(1, request.args.get('limit', SUGGEST_LIMIT, type=int)))
+
+    return json_response(suggest_titles(query, get_user_id_for_session(), limit))
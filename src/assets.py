@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR    = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static')
+BUILD_DIR     = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_FILE = os.path.join(BUILD_DIR, 'manifest.json')
+
+HASH_LENGTH = 12
+
+PRECOMPRESSED_EXTENSIONS = ['.css', '.js', '.svg', '.txt', '.html', '.json', '.xml']
+
+_manifest : dict[str, str] | None = None
+
+
+def build_static() -> dict[str, str]:
+    """Copy static files into BUILD_DIR under content-hashed names.
+
+    Text assets are also written precompressed with gzip and, if the
+    brotli module is installed, brotli at maximum levels, so they never
+    have to be compressed per request. Return the manifest that maps
+    the original names to the hashed ones.
+    """
+    global _manifest
+
+    shutil.rmtree(BUILD_DIR, ignore_errors=True)
+    os.makedirs(BUILD_DIR)
+
+    manifest = dict()
+
+    for directory, subdirectories, filenames in os.walk(STATIC_DIR):
+        if os.path.abspath(directory) == BUILD_DIR:
+            continue
+        subdirectories[:] = [d for d in subdirectories if os.path.join(directory, d) != BUILD_DIR]
+
+        for filename in sorted(filenames):
+            source = os.path.join(directory, filename)
+            name = os.path.relpath(source, STATIC_DIR).replace(os.sep, '/')
+
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            stem, extension = os.path.splitext(name)
+            hashed_name = f"{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{extension}"
+            target = os.path.join(BUILD_DIR, hashed_name)
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+
+            if extension in PRECOMPRESSED_EXTENSIONS:
+                with open(target + '.gz', 'wb') as f:
+                    f.write(gzip.compress(data, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    with open(target + '.br', 'wb') as f:
+                        f.write(brotli.compress(data, quality=11))
+
+            manifest[name] = hashed_name
+
+    with open(MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    _manifest = manifest
+    return manifest
+
+
+def get_hashed_name(filename: str) -> str | None:
+    """Return the content-hashed name of a static file, or None if assets haven't been built."""
+    global _manifest
+
+    if _manifest is None:
+        try:
+            with open(MANIFEST_FILE) as f:
+                _manifest = json.load(f)
+        except (OSError, ValueError):
+            _manifest = dict()
+
+    return _manifest.get(filename)
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from typing      import Any, Callable, Hashable
+
+# States of StaleCache entries
+FRESH    = 'fresh'
+EXPIRED  = 'expired'
+OUTDATED = 'outdated'
+MISSING  = 'missing'
+
+
+class Generation:
+
+    def __init__(self) -> None:
+        """Create new Generation counter.
+
+        The counter is bumped whenever the content it guards changes.
+        Cache entries tagged with an older generation are stale. Evictions
+        of single entries don't bump it, but they are counted in `changes`
+        with the bumps, so that a value loaded while either happened
+        isn't cached, as it may predate the change.
+        """
+        self.value = 0
+        self.changes = 0
+        self.bumped_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def bump(self) -> int:
+        """Increment the generation and return the new value."""
+        with self.lock:
+            self.value += 1
+            self.changes += 1
+            self.bumped_at = time.monotonic()
+            return self.value
+
+    def record_eviction(self) -> None:
+        """Count an eviction of entries guarded by the generation."""
+        with self.lock:
+            self.changes += 1
+            self.bumped_at = time.monotonic()
+
+    def age(self) -> float:
+        """Return the number of seconds since the generation was last bumped or its entries evicted."""
+        return time.monotonic() - self.bumped_at
+
+
+class LRUCache:
+
+    def __init__(self, name: str, max_entries: int) -> None:
+        """Create new LRUCache object.
+
+        Each entry is tagged with the generation that was current when
+        the value was loaded, and only served while it's still current.
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.entries : OrderedDict[Hashable, tuple[int, Any, int]] = OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"  LRUCache {self.name} ({len(self.entries)}/{self.max_entries} entries)"
+
+    def get(self, key: Hashable, generation: int) -> Any | None:
+        """Return cached value for key, or None if it's missing or stale."""
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] != generation:
+                if entry is not None:
+                    self._evict(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, generation: int, value: Any) -> None:
+        """Store value for key, evicting the least recently used entries if needed."""
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self._evict(key)
+
+            size = approximate_size(key) + approximate_size(value)
+            self.entries[key] = (generation, value, size)
+            self.memory += size
+
+            while len(self.entries) > self.max_entries:
+                self._evict(next(iter(self.entries)))
+
+    def evict_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Remove the entries whose key matches the predicate. Return the number of removed entries."""
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            for key in keys:
+                self._evict(key)
+            return len(keys)
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self.lock:
+            self.entries.clear()
+            self.memory = 0
+
+    def stats(self) -> dict[str, Any]:
+        """Return cache statistics."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries'      : len(self.entries),
+                    'max_entries'  : self.max_entries,
+                    'hits'         : self.hits,
+                    'misses'       : self.misses,
+                    'hit_rate'     : self.hits / lookups if lookups else 0.0,
+                    'memory_bytes' : self.memory}
+
+    def _evict(self, key: Hashable) -> None:
+        """Remove entry. The caller must hold the lock."""
+        _, _, size = self.entries.pop(key)
+        self.memory -= size
+
+
+class StaleCache:
+
+    def __init__(self, name: str, max_entries: int, max_age: float) -> None:
+        """Create new StaleCache object.
+
+        Unlike LRUCache, entries are kept as the last known good value after
+        they go stale. An entry older than `max_age` seconds is expired, and
+        can be served while it's refreshed in the background. An entry whose
+        generation is no longer current is outdated, and is only served if
+        a fresh value can't be loaded, e.g. while the database is unavailable.
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries : OrderedDict[Hashable, tuple[int, float, Any, int]] = OrderedDict()
+        self.refreshing : set[Hashable] = set()
+        self.memory = 0
+        self.fresh_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"  StaleCache {self.name} ({len(self.entries)}/{self.max_entries} entries)"
+
+    def get(self, key: Hashable, generation: int) -> tuple[Any | None, str]:
+        """Return the cached value for key and the state of the entry. The value is None if it's missing."""
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None, MISSING
+
+            self.entries.move_to_end(key)
+            entry_generation, loaded_at, value, _ = entry
+
+            if entry_generation != generation:
+                self.stale_hits += 1
+                return value, OUTDATED
+
+            if time.monotonic() - loaded_at >= self.max_age:
+                self.stale_hits += 1
+                return value, EXPIRED
+
+            self.fresh_hits += 1
+            return value, FRESH
+
+    def put(self, key: Hashable, generation: int, value: Any) -> None:
+        """Store value for key, evicting the least recently used entries if needed."""
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.memory -= self.entries.pop(key)[3]
+
+            size = approximate_size(key) + approximate_size(value)
+            self.entries[key] = (generation, time.monotonic(), value, size)
+            self.memory += size
+
+            while len(self.entries) > self.max_entries:
+                self.memory -= self.entries.popitem(last=False)[1][3]
+
+    def evict_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Mark the entries whose key matches the predicate outdated. Return the number of marked entries.
+
+        The entries are kept, so that they can still be served as the last
+        known good values while the database is unavailable.
+        """
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            for key in keys:
+                _, loaded_at, value, size = self.entries[key]
+                self.entries[key] = (-1, loaded_at, value, size)
+            return len(keys)
+
+    def begin_refresh(self, key: Hashable) -> bool:
+        """Mark key as being refreshed. Return False if it already is."""
+        with self.lock:
+            if key in self.refreshing:
+                return False
+            self.refreshing.add(key)
+            self.refreshes += 1
+            return True
+
+    def end_refresh(self, key: Hashable) -> None:
+        """Mark the refresh of key finished."""
+        with self.lock:
+            self.refreshing.discard(key)
+
+    def stats(self) -> dict[str, Any]:
+        """Return cache statistics."""
+        with self.lock:
+            lookups = self.fresh_hits + self.stale_hits + self.misses
+            return {'entries'      : len(self.entries),
+                    'max_entries'  : self.max_entries,
+                    'fresh_hits'   : self.fresh_hits,
+                    'stale_hits'   : self.stale_hits,
+                    'misses'       : self.misses,
+                    'hit_rate'     : (self.fresh_hits + self.stale_hits) / lookups if lookups else 0.0,
+                    'refreshes'    : self.refreshes,
+                    'memory_bytes' : self.memory}
+
+
+class InvalidationBus:
+
+    def __init__(self, check_seconds: float) -> None:
+        """Create new InvalidationBus object.
+
+        Caches are registered under a namespace, e.g. `permissions`. An
+        invalidation key is either the namespace, which invalidates all of
+        its entries by bumping its generation, or `namespace:id`, which
+        evicts the entries whose key, or the first item of whose tuple key,
+        is the id.
+
+        Writers bump the namespace's generation in the database and NOTIFY
+        the key with the new generation. Notifications arrive in commit
+        order, so if the database has a newer generation than the last one
+        notified, a notification was missed, and the namespace is cleared.
+        The generations are checked every `check_seconds`.
+        """
+        self.check_seconds = check_seconds
+        self.generations : dict[str, Generation] = dict()
+        self.caches : dict[str, list[LRUCache | StaleCache]] = dict()
+        self.notified : dict[str, int] = dict()
+        self.checked_at = 0.0
+        self.notifications = 0
+        self.missed = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"  InvalidationBus ({len(self.generations)} namespaces)"
+
+    def register(self, namespace: str, cache: LRUCache | StaleCache | None = None) -> Generation:
+        """Register cache under the namespace. Return the generation its entries are tagged with.
+
+        Without a cache, only the generation is kept, e.g. for a structure that is rebuilt when it changes.
+        """
+        with self.lock:
+            caches = self.caches.setdefault(namespace, [])
+            if cache is not None:
+                caches.append(cache)
+            return self.generations.setdefault(namespace, Generation())
+
+    def evict(self, key: str) -> None:
+        """Invalidate the entries of an invalidation key in the local caches."""
+        namespace, _, id_ = key.partition(':')
+
+        if not id_:
+            self.generations[namespace].bump()
+            return
+
+        self.generations[namespace].record_eviction()
+        for cache in self.caches[namespace]:
+            cache.evict_where(lambda cache_key: str(cache_key[0] if isinstance(cache_key, tuple) else cache_key) == id_)
+
+    def receive(self, payload: str) -> None:
+        """Handle a `key@generation` notification."""
+        key, _, generation = payload.rpartition('@')
+        self.evict(key)
+
+        namespace = key.partition(':')[0]
+        with self.lock:
+            self.notifications += 1
+            self.notified[namespace] = max(self.notified.get(namespace, 0), int(generation))
+
+    def clear_all(self) -> None:
+        """Invalidate all namespaces, e.g. when notifications may have been missed while reconnecting."""
+        for generation in self.generations.values():
+            generation.bump()
+
+    def check_due(self) -> bool:
+        """Return True if the generations should be checked against the database, and mark them checked."""
+        with self.lock:
+            if time.monotonic() - self.checked_at < self.check_seconds:
+                return False
+            self.checked_at = time.monotonic()
+            return True
+
+    def check(self, generations: dict[str, int]) -> None:
+        """Clear the namespaces whose notifications have been missed, given their generations in the database."""
+        for namespace, generation in generations.items():
+            with self.lock:
+                notified = self.notified.get(namespace)
+                self.notified[namespace] = max(notified or 0, generation)
+
+                # The first check only sets the baseline
+                if notified is None or generation <= notified:
+                    continue
+                self.missed += 1
+
+            if namespace in self.generations:
+                self.generations[namespace].bump()
+
+    def stats(self) -> dict[str, Any]:
+        """Return bus statistics."""
+        with self.lock:
+            return {'notifications' : self.notifications,
+                    'missed'        : self.missed,
+                    'generations'   : dict(self.notified)}
+
+
+def approximate_size(value: Any) -> int:
+    """Return approximate memory use of a value and the items it contains."""
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(sys.getsizeof(item) for item in value)
+    return size
@@ -22,6 +22,8 @@ along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
 
+from markupsafe import Markup, escape
+
 
 class Category:
 
@@ -60,13 +62,14 @@ class Category:
 class Thread:
 
     def __init__(self,
-                 thread_id   : int,
-                 category_id : int,
-                 user_id     : int,
-                 username    : str,
-                 created     : datetime,
-                 title       : str,
-                 content     : str
+                 thread_id    : int,
+                 category_id  : int,
+                 user_id      : int,
+                 username     : str,
+                 created      : datetime,
+                 title        : str,
+                 content      : str,
+                 content_html : str | None = None
                  ) -> None:
         """Create new Thread object."""
         self.thread_id = thread_id
@@ -76,6 +79,7 @@ class Thread:
         self.created = created
         self.title = title
         self.content = content
+        self.content_html = content_html
         self.replies : dict[int, Reply] = dict()
 
     def total_replies(self) -> int:
@@ -88,6 +92,10 @@ class Thread:
     def __repr__(self) -> str:
         return f"  {self.title} (Thread by {self.username}, created on {self.created})\n    {self.content}"
 
+    def rendered_content(self) -> Markup:
+        """Return the pre-rendered content, or the escaped source if it hasn't been rendered yet."""
+        return render_content(self.content, self.content_html)
+
     def dt_most_recent_post(self) -> datetime:
         """Return the timestamp most recent post in the thread."""
         if not self.replies:
@@ -104,6 +112,8 @@ class Reply:
                  username     : str,
                  reply_tstamp : datetime,
                  content      : int,
+                 like_count   : int = 0,
+                 content_html : str | None = None
                  ) -> None:
         """Creat new Reply object."""
         self.reply_id = reply_id
@@ -112,26 +122,112 @@ class Reply:
         self.username = username
         self.reply_tstamp = reply_tstamp
         self.content = content
+        self.like_count = like_count
+        self.content_html = content_html
         self.likes : dict[int, Like] = dict()
 
     def __repr__(self) -> str:
         return (f"      {self.username}  ({self.reply_tstamp})\n"
                 f"        {self.content}")
 
+    def rendered_content(self) -> Markup:
+        """Return the pre-rendered content, or the escaped source if it hasn't been rendered yet."""
+        return render_content(self.content, self.content_html)
+
     def has_been_liked_by(self, user_id: int) -> bool:
         """Check if a user has liked this reply."""
-        from src.db import user_has_liked_reply
-        return user_has_liked_reply(user_id, self.reply_id)
+        return user_id in self.likes
 
 
 class Like:
 
     def __init__(self,
-                 like_id  : int,
                  user_id  : int,
                  reply_id : int
                  ) -> None:
         """Create new Like object."""
-        self.like_id = like_id
         self.user_id = user_id
         self.reply_id = reply_id
+
+
+class SearchResult:
+
+    def __init__(self,
+                 thread_id        : int,
+                 category_id      : int,
+                 category_name    : str,
+                 username         : str,
+                 created          : datetime,
+                 title            : str,
+                 most_recent_post : datetime,
+                 snippet_source   : str
+                 ) -> None:
+        """Create new SearchResult object."""
+        self.thread_id = thread_id
+        self.category_id = category_id
+        self.category_name = category_name
+        self.username = username
+        self.created = created
+        self.title = title
+        self.most_recent_post = most_recent_post
+        self.snippet_source = snippet_source or ''
+
+    def __repr__(self) -> str:
+        return f"  {self.title} (Search result in {self.category_name}, thread by {self.username})"
+
+    def highlight(self, query: str, radius: int = 60) -> tuple[str, str, str]:
+        """Return snippet around the first match as (before, match, after).
+
+        If the snippet source does not contain the query (e.g. only the
+        title matched), the beginning of the source is returned as `after`.
+        """
+        index = self.snippet_source.find(query)
+        if index < 0:
+            after = self.snippet_source[:2 * radius]
+            return '', '', after + ('...' if len(self.snippet_source) > 2 * radius else '')
+
+        start = max(0, index - radius)
+        end = min(len(self.snippet_source), index + len(query) + radius)
+
+        before = ('...' if start > 0 else '') + self.snippet_source[start:index]
+        after = self.snippet_source[index + len(query):end] + ('...' if end < len(self.snippet_source) else '')
+        return before, self.snippet_source[index:index + len(query)], after
+
+
+class FeedEntry:
+
+    def __init__(self,
+                 thread_id     : int,
+                 reply_id      : int | None,
+                 category_id   : int,
+                 category_name : str,
+                 username      : str,
+                 title         : str,
+                 published     : datetime,
+                 content       : str,
+                 content_html  : str | None
+                 ) -> None:
+        """Create new FeedEntry object for a thread (reply_id=None) or a reply."""
+        self.thread_id = thread_id
+        self.reply_id = reply_id
+        self.category_id = category_id
+        self.category_name = category_name
+        self.username = username
+        self.title = title
+        self.published = published
+        self.content = content
+        self.content_html = content_html
+
+    def __repr__(self) -> str:
+        return f"  {self.title} (Feed entry in {self.category_name}, by {self.username})"
+
+    def rendered_content(self) -> Markup:
+        """Return the pre-rendered content, or the escaped source if it hasn't been rendered yet."""
+        return render_content(self.content, self.content_html)
+
+
+def render_content(content: str, content_html: str | None) -> Markup:
+    """Return pre-rendered HTML as safe markup, falling back to the escaped source."""
+    if content_html is None:
+        return escape(content)
+    return Markup(content_html)
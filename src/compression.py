@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import gzip
+import os
+import zlib
+
+from typing import Iterable, Iterator
+
+from flask import request, Response
+
+from app import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'application/json', 'application/atom+xml'}
+
+COMPRESS_MIN_SIZE     = int(os.getenv('COMPRESS_MIN_SIZE', 500))
+COMPRESS_LEVEL        = int(os.getenv('COMPRESS_LEVEL', 6))
+COMPRESS_BROTLI_LEVEL = int(os.getenv('COMPRESS_BROTLI_LEVEL', 4))
+
+
+def choose_encoding(streamed: bool) -> str | None:
+    """Return the best content coding for the response, or None."""
+    encodings = request.accept_encodings
+
+    # Brotli is only used for complete bodies, a streamed page is gzipped chunk by chunk
+    if brotli is not None and not streamed and encodings['br'] > 0:
+        return 'br'
+    if encodings['gzip'] > 0:
+        return 'gzip'
+    return None
+
+
+def gzip_chunks(chunks: Iterable[bytes | str]) -> Iterator[bytes]:
+    """Gzip streamed chunks, flushing after each one so the client can render them right away."""
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    yield compressor.flush()
+
+
+@app.after_request
+def compress_response(response: Response) -> Response:
+    """Compress text responses if the client accepts it."""
+    if (COMPRESS_LEVEL <= 0
+            or response.status_code != 200
+            or response.direct_passthrough
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if response.is_streamed:
+        if choose_encoding(streamed=True) is None:
+            return response
+
+        response.response = gzip_chunks(response.response)
+        response.headers.remove('Content-Length')
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+    data = response.get_data()
+
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    encoding = choose_encoding(streamed=False)
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=COMPRESS_BROTLI_LEVEL))
+    elif encoding == 'gzip':
+        response.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL))
+    else:
+        return response
+
+    response.headers['Content-Encoding'] = encoding
+    return response
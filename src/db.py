@@ -20,23 +20,393 @@ You should have received a copy of the GNU General Public License
 along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
 """
 
+import json
+import logging
 import os
 import random
+import threading
+import time
+
+from datetime import datetime, timedelta
+from typing   import Any, Callable, Generator, Hashable, Iterator
 
 import argon2
 import lorem
 
-from flask            import session
+from flask            import has_request_context, session
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy       import text
-
-from app         import app
-from src.classes import Thread, Reply, Category, Like
-from src.statics import ADMIN, USERNAME
+from sqlalchemy        import bindparam, text, Boolean, DateTime, Result, Row, TextClause
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc    import OperationalError, SQLAlchemyError
+
+from app            import app
+from src.cache      import EXPIRED, FRESH, Generation, InvalidationBus, LRUCache, StaleCache
+from src.classes    import Thread, Reply, Category, Like, SearchResult, FeedEntry
+from src.health     import HealthMonitor
+from src.live       import CACHE_INVALIDATION_CHANNEL, THREAD_EVENT_CHANNEL, thread_event_hub
+from src.markup     import RENDERER_VERSION, render
+from src.replicas   import ReplicaRouter
+from src.sqlite     import SQLITE_BUSY_TIMEOUT, SQLITE_ENGINE_OPTIONS, WriterQueue, configure_engine, is_sqlite_url
+from src.statements import Statement, StatementRegistry
+from src.suggest    import TitleTrie
+from src.statics    import (ADMIN, USERNAME, USER_ID, SEARCH_PAGE_SIZE, PRIMARY_UNTIL, REPLY_STREAM_BATCH, TRENDING_LIMIT,
+                            USER_SEARCH_PAGE_SIZE, JOB_MAX_ATTEMPTS)
+
+# An SQLite database, e.g. `sqlite:///forum.db`, can be used instead of PostgreSQL on
+# small single-process installs. Features that require PostgreSQL are then unavailable.
+IS_SQLITE = is_sqlite_url(os.getenv('DATABASE_URL'))
 
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
+if IS_SQLITE:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = SQLITE_ENGINE_OPTIONS
 db = SQLAlchemy(app)
 
+writer_queue = None
+
+if IS_SQLITE:
+    writer_queue = WriterQueue(timeout=SQLITE_BUSY_TIMEOUT)
+    with app.app_context():
+        configure_engine(db.engine, writer_queue)
+
+# Dialect-specific SQL fragments
+if IS_SQLITE:
+    SERIAL_PRIMARY_KEY = "INTEGER PRIMARY KEY AUTOINCREMENT"
+    CURRENT_TSTAMP     = "(strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))"
+    BYTEWISE_COLLATION = ""
+    GREATEST           = "MAX"
+else:
+    SERIAL_PRIMARY_KEY = "SERIAL PRIMARY KEY"
+    CURRENT_TSTAMP     = "CURRENT_TIMESTAMP"
+    BYTEWISE_COLLATION = " COLLATE \"C\""
+    GREATEST           = "GREATEST"
+
+# The local caches of worker processes are kept coherent with NOTIFY. Each
+# namespace has a generation in the database as a fallback for missed notifications.
+invalidation_bus = InvalidationBus(check_seconds=float(os.getenv('CACHE_CHECK_SECONDS', 5)))
+thread_event_hub.add_channel(CACHE_INVALIDATION_CHANNEL, invalidation_bus.receive, on_listen=invalidation_bus.clear_all)
+
+search_cache     = LRUCache('search',      int(os.getenv('SEARCH_CACHE_SIZE', 1024)))
+category_cache   = LRUCache('categories',  int(os.getenv('CATEGORY_CACHE_SIZE', 1024)))
+permission_cache = LRUCache('permissions', int(os.getenv('PERMISSION_CACHE_SIZE', 10_000)))
+thread_cache     = LRUCache('threads',     int(os.getenv('THREAD_CACHE_SIZE', 10_000)))
+username_cache   = LRUCache('usernames',   int(os.getenv('USERNAME_CACHE_SIZE', 10_000)))
+
+# Bumped by every write to threads and replies. Cached search results
+# tagged with an older generation are never served.
+content_generation    = invalidation_bus.register('content',     search_cache)
+category_generation   = invalidation_bus.register('categories',  category_cache)
+permission_generation = invalidation_bus.register('permissions', permission_cache)
+thread_generation     = invalidation_bus.register('threads',     thread_cache)
+username_generation   = invalidation_bus.register('usernames',   username_cache)
+
+# Bumped by every change to thread titles. The title trie is rebuilt when it's stale.
+title_generation = invalidation_bus.register('titles')
+title_trie = TitleTrie(max_candidates=int(os.getenv('SUGGEST_TRIE_MAX_CANDIDATES', 1000)))
+
+# Feed documents are tagged with the content version of their categories
+# instead of a generation, so they need no invalidation.
+feed_cache = LRUCache('feeds', int(os.getenv('FEED_CACHE_SIZE', 256)))
+
+# Title suggestions that take longer are cancelled
+SUGGEST_TIMEOUT_MS = int(os.getenv('SUGGEST_TIMEOUT_MS', 50))
+
+# Optional read replicas as a comma separated list of database URLs
+replica_router = ReplicaRouter([url.strip() for url in os.getenv('DATABASE_REPLICA_URL', '').split(',') if url.strip()],
+                               retry_seconds=float(os.getenv('REPLICA_RETRY_SECONDS', 30)))
+
+# How long the reads of a client stick to the primary, and bypass
+# the stale page cache, after it has written
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', 5))
+
+# The last known good copies of the index and of popular thread pages. Stale
+# copies are served while they're refreshed, and while the database is unhealthy.
+page_cache = StaleCache('pages', int(os.getenv('PAGE_CACHE_SIZE', 1000)),
+                        max_age=float(os.getenv('PAGE_CACHE_MAX_AGE', 5)))
+
+# Thread pages are keyed by their thread id, so that `content:<thread_id>`
+# marks a single thread's page outdated, e.g. when a like changes its counts.
+invalidation_bus.register('content', page_cache)
+
+with app.app_context():
+    health_monitor = HealthMonitor(db.engine,
+                                   check_seconds=float(os.getenv('HEALTH_CHECK_SECONDS', 5)),
+                                   failure_threshold=int(os.getenv('HEALTH_FAILURE_THRESHOLD', 3)),
+                                   max_latency=int(os.getenv('HEALTH_MAX_LATENCY_MS', 1000)) / 1000,
+                                   forced=os.getenv('READ_ONLY', '').lower() in ['1', 'true', 'yes'])
+
+# Statements of the hot paths are registered once at import. On PostgreSQL they're run
+# as server-side prepared statements unless PREPARED_STATEMENTS=0, which is needed
+# behind a connection pooler that doesn't keep sessions, e.g. PgBouncer in transaction mode.
+statements = StatementRegistry(prepare=not IS_SQLITE
+                                       and os.getenv('PREPARED_STATEMENTS', 'true').lower() in ['1', 'true', 'yes'])
+
+
+###############################################################################
+#                                   ROUTING                                   #
+###############################################################################
+
+def execute(sql: TextClause | Statement, params: dict | None = None) -> Result:
+    """Execute statement on the primary in the session's transaction.
+
+    Registered statements are run through the statement registry,
+    which prepares them on the connection if needed.
+    """
+    if isinstance(sql, Statement):
+        sql = statements.resolve(sql, db.session.connection())
+
+    return db.session.execute(sql, params)
+
+
+def execute_on_replica(sql: TextClause | Statement, params: dict | None, bind: Engine) -> Result:
+    """Execute statement on a replica with a connection of its own.
+
+    The replica isn't part of the session's transaction, so its failure
+    can't roll back the writes pending on the primary. The rows are
+    buffered, and the connection is returned to the pool right away.
+    """
+    with bind.connect() as connection:
+        if isinstance(sql, Statement):
+            sql = statements.resolve(sql, connection)
+
+        return connection.execute(sql, params).freeze()()
+
+
+def get_read_bind() -> Engine | None:
+    """Return the replica to read from, or None to read from the primary.
+
+    The client's reads go to the primary for a while after it has written,
+    so that e.g. the redirect after submitting a reply shows the reply.
+    """
+    if not has_request_context() or session.get(PRIMARY_UNTIL, 0) < time.time():
+        return replica_router.get_bind()
+    return None
+
+
+def execute_read(sql: TextClause | Statement, params: dict | None = None) -> Result:
+    """Execute read-only statement, on a replica if one is available.
+
+    If the replica fails, it's skipped and the statement is run on the
+    primary. Rows read from a replica are buffered, so statements whose
+    rows should be streamed are run with stream_read() instead.
+    """
+    bind = get_read_bind()
+    if bind is None:
+        return execute(sql, params)
+
+    try:
+        return execute_on_replica(sql, params, bind)
+    except OperationalError:
+        replica_router.mark_unhealthy(bind)
+        return execute(sql, params)
+
+
+def stream_read(sql: TextClause, params: dict | None = None) -> Generator[Row, None, None]:
+    """Yield the rows of a read-only statement as they're fetched, on a replica if one is available.
+
+    The statement sets stream_results and yield_per itself. A replica
+    connection is held until the rows have been read or the iterator is
+    closed. If the replica fails before returning rows, the statement is
+    run on the primary.
+    """
+    bind = get_read_bind()
+    connection = None
+    result : Result | None = None
+
+    if bind is not None:
+        try:
+            connection = bind.connect()
+            result = connection.execute(sql, params)
+        except OperationalError:
+            if connection is not None:
+                connection.close()
+                connection = None
+            replica_router.mark_unhealthy(bind)
+
+    if result is None:
+        result = execute(sql, params)
+
+    try:
+        yield from result
+    finally:
+        result.close()
+        if connection is not None:
+            connection.close()
+
+
+def commit() -> None:
+    """Commit the transaction and stick the client's reads to the primary.
+
+    Thread events queued with publish_thread_event() are published after the commit.
+    Cache entries invalidated with invalidate() are evicted in this process right
+    after the commit, and in the other processes when they're notified of it.
+    The client also bypasses the stale page cache for a while, so that it sees its write.
+    """
+    keys = db.session.info.pop('invalidations', set())
+    if keys and not IS_SQLITE:
+        publish_invalidations(keys)
+
+    db.session.commit()
+
+    for key in keys:
+        invalidation_bus.evict(key)
+
+    for event in db.session.info.pop('thread_events', []):
+        thread_event_hub.publish(event)
+
+    if has_request_context():
+        session[PRIMARY_UNTIL] = time.time() + REPLICA_STICKY_SECONDS
+
+
+def array_table(name: str, sql_type: str) -> str:
+    """Return a FROM item that has the elements of the list parameter `name` in its `value` column."""
+    if IS_SQLITE:
+        return f"json_each(:{name}) AS {name}"
+    return f"unnest(CAST(:{name} AS {sql_type}[])) AS {name}(value)"
+
+
+def array_param(values: list) -> list | str:
+    """Return list as a parameter for array_table()."""
+    return json.dumps(values) if IS_SQLITE else values
+
+
+###############################################################################
+#                                   CACHING                                   #
+###############################################################################
+
+def invalidate(key: str) -> None:
+    """Invalidate cache entries of the key in all worker processes once the transaction commits.
+
+    The key is a cache namespace such as `content`, or `namespace:id`, see InvalidationBus.
+    """
+    db.session.info.setdefault('invalidations', set()).add(key)
+
+
+def publish_invalidations(keys: set[str]) -> None:
+    """Bump the generations of the keys' namespaces and notify the other processes of the keys.
+
+    The generation rows are locked in a fixed order until the transaction
+    commits, so the generations are notified in the same order they're bumped.
+    """
+    sql = text("UPDATE cache_generations "
+               "SET generation = generation + 1 "
+               "WHERE namespace IN (SELECT namespace "
+               "                    FROM cache_generations "
+               "                    WHERE namespace IN :namespaces "
+               "                    ORDER BY namespace "
+               "                    FOR UPDATE) "
+               "RETURNING namespace, generation"
+               ).bindparams(bindparam('namespaces', expanding=True))
+    generations = dict(db.session.execute(sql, {'namespaces': sorted({key.partition(':')[0] for key in keys})}).fetchall())
+
+    sql = text("SELECT pg_notify(:channel, payloads.value) "
+               f"FROM {array_table('payloads', 'TEXT')}")
+    db.session.execute(sql, {'channel'  : CACHE_INVALIDATION_CHANNEL,
+                             'payloads' : array_param([f"{key}@{generations[key.partition(':')[0]]}"
+                                                       for key in sorted(keys)])})
+
+
+def check_cache_generations() -> None:
+    """Compare the cache generations with the database every CACHE_CHECK_SECONDS to catch missed notifications."""
+    if IS_SQLITE or health_monitor.read_only or not invalidation_bus.check_due():
+        return
+
+    thread_event_hub.start()
+
+    sql = text("SELECT namespace, generation "
+               "FROM cache_generations")
+    invalidation_bus.check(dict(db.session.execute(sql).fetchall()))
+
+
+def cached_read(cache      : LRUCache,
+                generation : Generation,
+                key        : Hashable,
+                load       : Callable[[], Any]
+                ) -> Any:
+    """Return the cached value of the key, or load and cache it.
+
+    A lagging replica may not yet have the latest writes, so values
+    aren't cached until the replicas have had time to catch up. A value
+    isn't cached either if the namespace changed while it was loaded,
+    as the invalidation may have evicted the key before the value was put.
+    """
+    check_cache_generations()
+
+    current, changes = generation.value, generation.changes
+    value = cache.get(key, current)
+    if value is not None:
+        return value
+
+    value = load()
+    if generation.changes == changes and (not replica_router.engines or generation.age() >= REPLICA_STICKY_SECONDS):
+        cache.put(key, current, value)
+    return value
+
+
+def stale_read(cache      : StaleCache,
+               generation : Generation,
+               key        : Hashable,
+               load       : Callable[[], Any]
+               ) -> Any:
+    """Return the cached value of the key, refreshing it if it's stale.
+
+    An expired value is served right away and refreshed in the background.
+    An outdated value is reloaded, as the content is known to have changed.
+    While the database is unhealthy, or if loading fails, the last known
+    good value is served instead. A client that has just written always
+    gets a fresh value.
+    """
+    current, changes = generation.value, generation.changes
+    value, state = cache.get(key, current)
+    own_write = has_request_context() and session.get(PRIMARY_UNTIL, 0) >= time.time()
+
+    if value is not None and not own_write:
+        if state == FRESH or health_monitor.read_only:
+            return value
+
+        if state == EXPIRED:
+            if cache.begin_refresh(key):
+                threading.Thread(target=refresh_stale_value, args=(cache, generation, key, load), daemon=True).start()
+            return value
+
+    try:
+        check_cache_generations()
+        loaded = load()
+    except OperationalError as error:
+        db.session.rollback()
+        health_monitor.record_error(error)
+        if value is None:
+            raise
+        return value
+
+    # A page loaded from the database proves it's reachable, without waiting for the next check
+    health_monitor.record_page_load()
+
+    # An invalidation during the load may have marked the key outdated before the value was put
+    if generation.changes == changes:
+        cache.put(key, current, loaded)
+    return loaded
+
+
+def refresh_stale_value(cache      : StaleCache,
+                        generation : Generation,
+                        key        : Hashable,
+                        load       : Callable[[], Any]
+                        ) -> None:
+    """Load the value of the key into the cache in a background thread."""
+    current, changes = generation.value, generation.changes
+
+    with app.app_context():
+        try:
+            loaded = load()
+            if generation.changes == changes:
+                cache.put(key, current, loaded)
+            health_monitor.record_page_load()
+        except SQLAlchemyError as error:
+            logging.exception("Refreshing stale %s entry failed", cache.name)
+            health_monitor.record_error(error)
+        finally:
+            cache.end_refresh(key)
+
 
 ###############################################################################
 #                                     INIT                                    #
@@ -45,59 +415,337 @@ db = SQLAlchemy(app)
 def create_tables():
     """Create databae tables."""
     sql = text("CREATE TABLE IF NOT EXISTS users ("
-               "  user_id SERIAL PRIMARY KEY, "
+               f" user_id {SERIAL_PRIMARY_KEY}, "
                "  username TEXT, "
-               "  join_tstamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+               f" join_tstamp TIMESTAMP NOT NULL DEFAULT {CURRENT_TSTAMP}, "
                "  is_admin BOOLEAN DEFAULT FALSE, "
                "  password_hash TEXT)")
     db.session.execute(sql)
     db.session.commit()
 
     sql = text("CREATE TABLE IF NOT EXISTS categories ("
-               "  category_id SERIAL PRIMARY KEY, "
+               f" category_id {SERIAL_PRIMARY_KEY}, "
                "  restricted BOOLEAN DEFAULT FALSE, "
-               "  name TEXT)")
+               "  name TEXT, "
+               "  content_version INTEGER NOT NULL DEFAULT 0)")
     db.session.execute(sql)
     db.session.commit()
 
     sql = text("CREATE TABLE IF NOT EXISTS permissions ("
-               "  permission_id SERIAL PRIMARY KEY, "
-               "  user_id INTEGER NOT NULL, "
-               "FOREIGN KEY (user_id) REFERENCES users(user_id), "
-               "  category_id INTEGER NOT NULL, "
-               "FOREIGN KEY (category_id) REFERENCES categories(category_id))")
+               f" permission_id {SERIAL_PRIMARY_KEY}, "
+               "  user_id INTEGER NOT NULL REFERENCES users(user_id), "
+               "  category_id INTEGER NOT NULL REFERENCES categories(category_id))")
+    db.session.execute(sql)
+    db.session.commit()
+
+    # SQLite databases are always created with the current schema
+    if not IS_SQLITE:
+        migrate_permissions()
+
+    sql = text("CREATE TABLE IF NOT EXISTS user_groups ("
+               f" group_id {SERIAL_PRIMARY_KEY}, "
+               "  name TEXT NOT NULL UNIQUE)")
+    db.session.execute(sql)
+    db.session.commit()
+
+    sql = text("CREATE TABLE IF NOT EXISTS group_members ("
+               "  group_id INTEGER NOT NULL REFERENCES user_groups(group_id), "
+               "  user_id INTEGER NOT NULL REFERENCES users(user_id), "
+               "PRIMARY KEY (group_id, user_id))")
+    db.session.execute(sql)
+    db.session.commit()
+
+    sql = text("CREATE TABLE IF NOT EXISTS group_permissions ("
+               "  category_id INTEGER NOT NULL REFERENCES categories(category_id), "
+               "  group_id INTEGER NOT NULL REFERENCES user_groups(group_id), "
+               "PRIMARY KEY (category_id, group_id))")
     db.session.execute(sql)
     db.session.commit()
 
     sql = text("CREATE TABLE IF NOT EXISTS threads ("
-               "  thread_id SERIAL PRIMARY KEY, "
-               "  category_id INTEGER NOT NULL, "
-               "FOREIGN KEY (category_id) REFERENCES categories(category_id), "
-               "  user_id INTEGER NOT NULL, "
-               "FOREIGN KEY (user_id) REFERENCES users(user_id), "
-               "  thread_tstamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+               f" thread_id {SERIAL_PRIMARY_KEY}, "
+               "  category_id INTEGER NOT NULL REFERENCES categories(category_id), "
+               "  user_id INTEGER NOT NULL REFERENCES users(user_id), "
+               f" thread_tstamp TIMESTAMP NOT NULL DEFAULT {CURRENT_TSTAMP}, "
                "  title TEXT,"
-               "  content TEXT)")
+               "  content TEXT, "
+               "  content_html TEXT, "
+               "  render_version INTEGER, "
+               "  last_reply_id INTEGER)")
     db.session.execute(sql)
     db.session.commit()
 
     sql = text("CREATE TABLE IF NOT EXISTS replies ("
-               "  reply_id SERIAL PRIMARY KEY, "
-               "  thread_id INTEGER NOT NULL, "
-               "FOREIGN KEY (thread_id) REFERENCES threads(thread_id), "
-               "  user_id INTEGER NOT NULL, "
-               "FOREIGN KEY (user_id) REFERENCES users(user_id), "
-               "  reply_tstamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, "
-               "  content TEXT)")
+               f" reply_id {SERIAL_PRIMARY_KEY}, "
+               "  thread_id INTEGER NOT NULL REFERENCES threads(thread_id), "
+               "  user_id INTEGER NOT NULL REFERENCES users(user_id), "
+               f" reply_tstamp TIMESTAMP NOT NULL DEFAULT {CURRENT_TSTAMP}, "
+               "  content TEXT, "
+               "  like_count INTEGER NOT NULL DEFAULT 0, "
+               "  content_html TEXT, "
+               "  render_version INTEGER)")
     db.session.execute(sql)
     db.session.commit()
 
     sql = text("CREATE TABLE IF NOT EXISTS likes ("
-               "  like_id SERIAL PRIMARY KEY, "
-               "  reply_id INTEGER NOT NULL, "
-               "FOREIGN KEY (reply_id) REFERENCES replies(reply_id), "
-               "  user_id INTEGER NOT NULL, "
-               "FOREIGN KEY (user_id) REFERENCES users(user_id))")
+               "  reply_id INTEGER NOT NULL REFERENCES replies(reply_id), "
+               "  user_id INTEGER NOT NULL REFERENCES users(user_id), "
+               "  reply_tstamp TIMESTAMP NOT NULL, "
+               f" like_tstamp TIMESTAMP NOT NULL DEFAULT {CURRENT_TSTAMP}, "
+               "PRIMARY KEY (reply_id, user_id))")
+    db.session.execute(sql)
+    db.session.commit()
+
+    sql = text("CREATE TABLE IF NOT EXISTS thread_reads ("
+               "  user_id INTEGER NOT NULL REFERENCES users(user_id), "
+               "  thread_id INTEGER NOT NULL REFERENCES threads(thread_id), "
+               "  last_read_reply_id INTEGER NOT NULL, "
+               "PRIMARY KEY (user_id, thread_id))")
+    db.session.execute(sql)
+    db.session.commit()
+
+    sql = text("CREATE TABLE IF NOT EXISTS jobs ("
+               f" job_id {SERIAL_PRIMARY_KEY}, "
+               "  job_type TEXT NOT NULL, "
+               "  payload TEXT NOT NULL, "
+               "  state TEXT NOT NULL DEFAULT 'queued', "
+               "  attempts INTEGER NOT NULL DEFAULT 0, "
+               "  max_attempts INTEGER NOT NULL, "
+               "  run_after TIMESTAMP NOT NULL, "
+               "  locked_until TIMESTAMP, "
+               "  last_error TEXT, "
+               "  recurring BOOLEAN NOT NULL DEFAULT FALSE, "
+               f" created TIMESTAMP NOT NULL DEFAULT {CURRENT_TSTAMP})")
+    db.session.execute(sql)
+    db.session.commit()
+
+    sql = text("CREATE TABLE IF NOT EXISTS cache_generations ("
+               "  namespace TEXT PRIMARY KEY, "
+               "  generation BIGINT NOT NULL DEFAULT 0)")
+    db.session.execute(sql)
+
+    sql = text("INSERT INTO cache_generations (namespace) "
+               "SELECT namespaces.value "
+               f"FROM {array_table('namespaces', 'TEXT')} "
+               "WHERE true "
+               "ON CONFLICT DO NOTHING")
+    db.session.execute(sql, {'namespaces': array_param(list(invalidation_bus.generations))})
+    db.session.commit()
+
+    if not IS_SQLITE:
+        migrate_likes()
+        migrate_likes_reply_tstamp()
+        migrate_likes_like_tstamp()
+        migrate_last_reply_ids()
+
+        # Rendered content is filled in by `manage.py rerender`
+        for table in ['threads', 'replies']:
+            sql = text(f"ALTER TABLE {table} "
+                       "ADD COLUMN IF NOT EXISTS content_html TEXT, "
+                       "ADD COLUMN IF NOT EXISTS render_version INTEGER")
+            db.session.execute(sql)
+
+        # Feeds are cached by the content version of their category
+        sql = text("ALTER TABLE categories "
+                   "ADD COLUMN IF NOT EXISTS content_version INTEGER NOT NULL DEFAULT 0")
+        db.session.execute(sql)
+
+        sql = text("ALTER TABLE jobs "
+                   "ADD COLUMN IF NOT EXISTS recurring BOOLEAN NOT NULL DEFAULT FALSE")
+        db.session.execute(sql)
+        db.session.commit()
+
+    # Index that bulk grants rely on with ON CONFLICT
+    sql = text("CREATE UNIQUE INDEX IF NOT EXISTS permissions_category_id_user_id_idx "
+               "ON permissions (category_id, user_id)")
+    db.session.execute(sql)
+
+    # Index for the prefix search of the user picker
+    sql = text("CREATE INDEX IF NOT EXISTS users_username_idx "
+               f"ON users ((username{BYTEWISE_COLLATION}))")
+    db.session.execute(sql)
+
+    # Index for checking group permissions by user
+    sql = text("CREATE INDEX IF NOT EXISTS group_members_user_id_idx "
+               "ON group_members (user_id)")
+    db.session.execute(sql)
+
+    # Indexes for loading the threads of a category and the replies of a thread
+    sql = text("CREATE INDEX IF NOT EXISTS threads_category_id_idx "
+               "ON threads (category_id)")
+    db.session.execute(sql)
+    sql = text("CREATE INDEX IF NOT EXISTS replies_thread_id_idx "
+               "ON replies (thread_id, reply_tstamp)")
+    db.session.execute(sql)
+
+    # Indexes for reading the newest threads of the forum and of a category for the feeds
+    sql = text("CREATE INDEX IF NOT EXISTS threads_thread_tstamp_idx "
+               "ON threads (thread_tstamp)")
+    db.session.execute(sql)
+    sql = text("CREATE INDEX IF NOT EXISTS threads_category_id_thread_tstamp_idx "
+               "ON threads (category_id, thread_tstamp)")
+    db.session.execute(sql)
+
+    # Indexes for finding the recent activity that trending threads are scored by
+    sql = text("CREATE INDEX IF NOT EXISTS replies_reply_tstamp_idx "
+               "ON replies (reply_tstamp)")
+    db.session.execute(sql)
+    sql = text("CREATE INDEX IF NOT EXISTS likes_like_tstamp_idx "
+               "ON likes (like_tstamp)")
+    db.session.execute(sql)
+
+    # Index for claiming the next job of a type. Failed jobs are kept only for inspection.
+    sql = text("CREATE INDEX IF NOT EXISTS jobs_job_type_run_after_idx "
+               "ON jobs (job_type, run_after, job_id) "
+               "WHERE state <> 'failed'")
+    db.session.execute(sql)
+
+    # Index that keeps a recurring job to a single schedule
+    sql = text("CREATE UNIQUE INDEX IF NOT EXISTS jobs_recurring_job_type_idx "
+               "ON jobs (job_type) "
+               "WHERE recurring")
+    db.session.execute(sql)
+    db.session.commit()
+
+    create_trending_view()
+    create_title_index()
+
+
+def migrate_likes():
+    """Migrate likes from the surrogate like_id key to the (reply_id, user_id) key.
+
+    Duplicate likes and likes to one's own replies are removed, and
+    the per-reply like counters are filled in.
+    """
+    sql = text("ALTER TABLE replies "
+               "ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0")
+    db.session.execute(sql)
+    db.session.commit()
+
+    sql = text("SELECT 1 "
+               "FROM information_schema.columns "
+               "WHERE table_name = 'likes' "
+               "      AND "
+               "      column_name = 'like_id'")
+    if db.session.execute(sql).first() is None:
+        return
+
+    for sql in [text("DELETE FROM likes AS duplicate "
+                     "USING likes "
+                     "WHERE duplicate.reply_id = likes.reply_id "
+                     "      AND "
+                     "      duplicate.user_id = likes.user_id "
+                     "      AND "
+                     "      duplicate.like_id > likes.like_id"),
+                text("DELETE FROM likes "
+                     "USING replies "
+                     "WHERE likes.reply_id = replies.reply_id "
+                     "      AND "
+                     "      likes.user_id = replies.user_id"),
+                text("ALTER TABLE likes DROP COLUMN like_id"),
+                text("ALTER TABLE likes ADD PRIMARY KEY (reply_id, user_id)"),
+                text("UPDATE replies "
+                     "SET like_count = (SELECT COUNT(*) "
+                     "                  FROM likes "
+                     "                  WHERE likes.reply_id = replies.reply_id)")]:
+        db.session.execute(sql)
+    db.session.commit()
+
+
+def migrate_permissions():
+    """Make permissions unique per category and user.
+
+    Duplicate permissions are removed before the unique index
+    that bulk grants rely on with ON CONFLICT is created.
+    """
+    sql = text("SELECT to_regclass('permissions_category_id_user_id_idx')")
+    if db.session.execute(sql).scalar() is not None:
+        return
+
+    for sql in [text("DELETE FROM permissions AS duplicate "
+                     "USING permissions "
+                     "WHERE duplicate.category_id = permissions.category_id "
+                     "      AND "
+                     "      duplicate.user_id = permissions.user_id "
+                     "      AND "
+                     "      duplicate.permission_id > permissions.permission_id"),
+                text("CREATE UNIQUE INDEX permissions_category_id_user_id_idx "
+                     "ON permissions (category_id, user_id)")]:
+        db.session.execute(sql)
+    db.session.commit()
+
+
+def migrate_likes_reply_tstamp():
+    """Copy the timestamp of the liked reply to likes.
+
+    Likes are partitioned by the timestamp of the reply they
+    belong to (see src/partitions.py), so they need a copy of it.
+    """
+    sql = text("SELECT 1 "
+               "FROM information_schema.columns "
+               "WHERE table_name = 'likes' "
+               "      AND "
+               "      column_name = 'reply_tstamp'")
+    if db.session.execute(sql).first() is not None:
+        return
+
+    for sql in [text("ALTER TABLE likes ADD COLUMN reply_tstamp TIMESTAMP"),
+                text("UPDATE likes "
+                     "SET reply_tstamp = replies.reply_tstamp "
+                     "FROM replies "
+                     "WHERE likes.reply_id = replies.reply_id"),
+                text("ALTER TABLE likes ALTER COLUMN reply_tstamp SET NOT NULL")]:
+        db.session.execute(sql)
+    db.session.commit()
+
+
+def migrate_likes_like_tstamp():
+    """Add the time of the like to likes.
+
+    The time of existing likes is unknown, so the time
+    of the reply is used as the best approximation.
+    """
+    sql = text("SELECT 1 "
+               "FROM information_schema.columns "
+               "WHERE table_name = 'likes' "
+               "      AND "
+               "      column_name = 'like_tstamp'")
+    if db.session.execute(sql).first() is not None:
+        return
+
+    for sql in [text("ALTER TABLE likes ADD COLUMN like_tstamp TIMESTAMP"),
+                text("UPDATE likes SET like_tstamp = reply_tstamp"),
+                text("ALTER TABLE likes ALTER COLUMN like_tstamp SET DEFAULT CURRENT_TIMESTAMP"),
+                text("ALTER TABLE likes ALTER COLUMN like_tstamp SET NOT NULL")]:
+        db.session.execute(sql)
+    db.session.commit()
+
+
+def migrate_last_reply_ids():
+    """Add the id of the latest reply to threads.
+
+    Unread threads are found by comparing it to the users' read
+    watermarks, so that replies never need to be counted.
+    """
+    sql = text("SELECT 1 "
+               "FROM information_schema.columns "
+               "WHERE table_name = 'threads' "
+               "      AND "
+               "      column_name = 'last_reply_id'")
+    if db.session.execute(sql).first() is not None:
+        return
+
+    db.session.execute(text("ALTER TABLE threads ADD COLUMN last_reply_id INTEGER"))
+    fill_last_reply_ids()
+
+
+def fill_last_reply_ids() -> None:
+    """Fill in the latest reply of the threads that have none, e.g. after importing an older dump."""
+    sql = text("UPDATE threads "
+               "SET last_reply_id = (SELECT MAX(replies.reply_id) "
+               "                     FROM replies "
+               "                     WHERE replies.thread_id = threads.thread_id) "
+               "WHERE last_reply_id IS NULL")
     db.session.execute(sql)
     db.session.commit()
 
@@ -141,9 +789,9 @@ def mock_db_content():
 
                 for user_id_ in user_ids:
                     # 50% probability to like the reply of another user
-                    if user_id_ == user_id and random.randint(0, 1):
+                    if user_id_ == user_id or random.randint(0, 1):
                         continue
-                    insert_like_to_db(user_id, reply_id)
+                    insert_like_to_db(user_id_, reply_id)
 
 
 ###############################################################################
@@ -169,7 +817,7 @@ def insert_admin_account_into_db():
     db.session.execute(sql, {'username'      : 'admin',
                              'is_admin'      : True,
                              'password_hash' : password_hash})
-    db.session.commit()
+    commit()
 
 
 def insert_new_user_into_db(username: str, password: str) -> int:
@@ -187,35 +835,65 @@ def insert_new_user_into_db(username: str, password: str) -> int:
                "RETURNING user_id")
     user_id = db.session.execute(sql, {'username'      : username,
                                        'is_admin'      : False,
-                                       'password_hash' : password_hash})
-    db.session.commit()
+                                       'password_hash' : password_hash}).scalar()
+    commit()
     return user_id
 
 
+def insert_users_into_db(usernames: list[str], password: str) -> int:
+    """Insert users that share a password into the database. Return the number of new users.
+
+    The password is hashed only once, so that large numbers of synthetic
+    users can be created for load testing. Existing usernames are skipped.
+    """
+    password_hash = argon2.PasswordHasher().hash(password=password,
+                                                 salt=os.getrandom(32, flags=0))
+
+    sql = text("INSERT INTO users (username, password_hash) "
+               "SELECT usernames.value, :password_hash "
+               f"FROM {array_table('usernames', 'TEXT')} "
+               "WHERE NOT EXISTS (SELECT 1 "
+               "                  FROM users "
+               "                  WHERE users.username = usernames.value)")
+    inserted = db.session.execute(sql, {'usernames'     : array_param(usernames),
+                                        'password_hash' : password_hash}).rowcount
+    commit()
+    return inserted
+
+
+USER_ID_BY_USERNAME = statements.register('user_id_by_username',
+                                          "SELECT users.user_id "
+                                          "FROM users "
+                                          "WHERE username=(:username)",
+                                          prepare=True)
+
+
 def get_user_id_for_session() -> int:
-    """Get user's user_id by session username."""
-    sql = text("SELECT users.user_id "
-               "FROM users "
-               "WHERE username=(:username)")
-    user_id = db.session.execute(sql, {'username': session[USERNAME]}).fetchone()[0]
+    """Get user's user_id, stored in the session at login, or by session username for older sessions."""
+    if USER_ID in session:
+        return session[USER_ID]
+
+    user_id = execute_read(USER_ID_BY_USERNAME, {'username': session[USERNAME]}).fetchone()[0]
     return user_id
 
 
 def get_user_id_by_username(username: str) -> int:
     """Get user's user_id by username."""
-    sql = text("SELECT users.user_id "
-               "FROM users "
-               "WHERE username=(:username)")
-    user_id = db.session.execute(sql, {'username': username}).fetchone()[0]
+    user_id = execute_read(USER_ID_BY_USERNAME, {'username': username}).fetchone()[0]
     return user_id
 
 
+USERNAME_BY_USER_ID = statements.register('username_by_user_id',
+                                          "SELECT username "
+                                          "FROM users "
+                                          "WHERE user_id = :user_id ",
+                                          prepare=True)
+
+
 def get_username_by_user_id(user_id: int) -> str:
-    """Get user's username by user_id.'"""
-    sql = text("SELECT username "
-               "FROM users "
-               "WHERE user_id = :user_id ")
-    user = db.session.execute(sql, {'user_id': user_id}).fetchone()[0]
+    """Get user's username by user_id. Usernames never change, so they're cached."""
+    user = cached_read(username_cache, username_generation, user_id,
+                       lambda: execute_read(USERNAME_BY_USER_ID, {'user_id': user_id}).fetchone()[0])
     return user
 
 
@@ -223,7 +901,7 @@ def get_user_ids_and_names(include_admin: bool = False) -> tuple[int, str]:
     """Get users' user_ids and names."""
     sql = text("SELECT user_id, username "
                "FROM users")
-    results = db.session.execute(sql).fetchall()
+    results = execute_read(sql).fetchall()
 
     if not include_admin:
         results = [t for t in results if t[1] != ADMIN]
@@ -231,6 +909,33 @@ def get_user_ids_and_names(include_admin: bool = False) -> tuple[int, str]:
     return results
 
 
+def search_users(prefix : str,
+                 after  : str = '',
+                 limit  : int = USER_SEARCH_PAGE_SIZE
+                 ) -> list[dict]:
+    """Get a page of users whose name starts with prefix, ordered by name.
+
+    The next page starts after the last username of the previous one. Names
+    are compared bytewise so that both the prefix match and the ordering can
+    be served by the users_username_idx index. The admin is left out.
+    """
+    escaped_prefix = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+    sql = text("SELECT user_id, username "
+               "FROM users "
+               f"WHERE username{BYTEWISE_COLLATION} LIKE :pattern ESCAPE '\\' "
+               "      AND "
+               f"     username{BYTEWISE_COLLATION} > :after "
+               "      AND "
+               "      is_admin IS NOT TRUE "
+               f"ORDER BY username{BYTEWISE_COLLATION} "
+               "LIMIT :limit")
+    users = execute_read(sql, {'pattern' : escaped_prefix + '%',
+                               'after'   : after,
+                               'limit'   : limit}).mappings().fetchall()
+    return [dict(user) for user in users]
+
+
 def get_username_by_reply_id(reply_id: int) -> str:
     """Get username by reply_id."""
     sql = text("SELECT users.username "
@@ -238,7 +943,7 @@ def get_username_by_reply_id(reply_id: int) -> str:
                "WHERE users.user_id = replies.user_id "
                "      AND "
                "      replies.reply_id = :reply_id")
-    username = db.session.execute(sql, {'reply_id': reply_id}).fetchone()[0]
+    username = execute_read(sql, {'reply_id': reply_id}).fetchone()[0]
     return username
 
 
@@ -250,7 +955,7 @@ def get_username_by_thread_id(thread_id: int) -> str:
                "  users.user_id = threads.user_id "
                "  AND "
                "  threads.thread_id = :thread_id")
-    username = db.session.execute(sql, {'thread_id': thread_id}).fetchone()[0]
+    username = execute_read(sql, {'thread_id': thread_id}).fetchone()[0]
     return username
 
 
@@ -267,42 +972,47 @@ def insert_category_to_db(category_name: str, restricted: bool = False) -> int:
     category_id = db.session.execute(sql, {'category_name': category_name,
                                            'restricted': restricted}).fetchone()[0]
 
-    db.session.commit()
+    invalidate('content')
+    commit()
     return category_id
 
 
-def delete_category_from_db(category_id: int) -> None:
-    """Delete category from database."""
-    sql = text("DELETE "
-               "FROM categories "
-               "WHERE category_id = :category_id")
-    db.session.execute(sql, {'category_id': category_id})
-    db.session.commit()
-
-
 def category_exists_in_db(category_name: str) -> bool:
     """Return true if the category exists in the database."""
     sql = text("SELECT category_id "
                "FROM categories "
                "WHERE name=:category")
-    result = db.session.execute(sql, {'category': category_name}).fetchall()
+    result = execute_read(sql, {'category': category_name}).fetchall()
     return len(result) > 0
 
 
+CATEGORY_IS_RESTRICTED = statements.register('category_is_restricted',
+                                             "SELECT restricted "
+                                             "FROM categories "
+                                             "WHERE category_id = :category_id ",
+                                             prepare=True)
+
+
 def category_is_restricted(category_id: int) -> bool:
     """Return true if the category is restricted."""
-    sql = text("SELECT restricted "
-               "FROM categories "
-               "WHERE category_id = :category_id ")
-    is_restricted = db.session.execute(sql, {'category_id': category_id}).fetchone()[0]
+    is_restricted = cached_read(category_cache, category_generation, category_id,
+                                lambda: execute_read(CATEGORY_IS_RESTRICTED, {'category_id': category_id}).fetchone()[0])
     return is_restricted
 
 
+def get_category_name(category_id: int) -> str | None:
+    """Get name of a category, or None if the category doesn't exist."""
+    sql = text("SELECT name "
+               "FROM categories "
+               "WHERE category_id = :category_id")
+    return execute_read(sql, {'category_id': category_id}).scalar()
+
+
 def get_list_of_category_ids_and_names() -> list[tuple[int, str]]:
     """Get list of categories (category_id and name)."""
     sql = text("SELECT category_id, name "
                "FROM categories")
-    ids_and_categories = db.session.execute(sql).fetchall()
+    ids_and_categories = execute_read(sql).fetchall()
     return ids_and_categories
 
 
@@ -310,16 +1020,45 @@ def get_category_data() -> list[tuple[int, str]]:
     """Get category data."""
     sql = text("SELECT category_id, restricted, name "
                "FROM categories")
-    ids_and_categories = db.session.execute(sql).fetchall()
+    ids_and_categories = execute_read(sql).fetchall()
     return ids_and_categories
 
 
+def get_category_summaries(user_id: int) -> list[dict]:
+    """Get summaries of the categories the user has access to.
+
+    Each summary contains the number of threads and posts in the
+    category, and the timestamp of the most recent post.
+    """
+    sql = text("SELECT "
+               "  categories.category_id, "
+               "  categories.name, "
+               "  categories.restricted, "
+               "  COUNT(DISTINCT threads.thread_id) AS threads, "
+               "  COUNT(DISTINCT threads.thread_id) + COUNT(replies.reply_id) AS posts, "
+               "  CASE WHEN MAX(replies.reply_tstamp) > MAX(threads.thread_tstamp) "
+               "       THEN MAX(replies.reply_tstamp) "
+               "       ELSE MAX(threads.thread_tstamp) "
+               "  END AS most_recent_post "
+               "FROM categories "
+               "  LEFT JOIN threads ON threads.category_id = categories.category_id "
+               "  LEFT JOIN replies ON replies.thread_id = threads.thread_id "
+               "                       AND "
+               "                       replies.reply_tstamp >= threads.thread_tstamp "
+               f"WHERE {PERMITTED_CATEGORY_CONDITION} "
+               "GROUP BY categories.category_id "
+               "ORDER BY categories.category_id"
+               ).columns(restricted=Boolean, most_recent_post=DateTime)
+    summaries = execute_read(sql, {'user_id': user_id}).mappings().fetchall()
+    return [dict(summary) for summary in summaries]
+
+
 def get_list_of_thread_ids_by_category_id(category_id: int) -> list[int]:
     """Get list of thread_ids from database that match category_id."""
     sql = text("SELECT threads.thread_id "
                "FROM threads "
                "WHERE threads.category_id = :category_id")
-    thread_ids = [t[0] for t in db.session.execute(sql, {'category_id': category_id}).fetchall()]
+    thread_ids = [t[0] for t in execute_read(sql, {'category_id': category_id}).fetchall()]
     return thread_ids
 
 
@@ -327,37 +1066,162 @@ def get_list_of_thread_ids_by_category_id(category_id: int) -> list[int]:
 #                                 PERMISSIONS                                 #
 ###############################################################################
 
-def insert_permission_into_db(category_id: int, user_id: int) -> int:
-    """Insert permission into database. Return permission_id.
-
-    The permission controls whether a user is allowed to access a category.
+# SQL condition that matches categories the user `:user_id` has access to.
+# Requires the `categories` table to be part of the query.
+PERMITTED_CATEGORY_CONDITION = ("(categories.restricted IS NOT TRUE "
+                                " OR "
+                                " EXISTS (SELECT 1 "
+                                "         FROM users "
+                                "         WHERE users.user_id = :user_id "
+                                "               AND "
+                                "               users.is_admin) "
+                                " OR "
+                                " EXISTS (SELECT 1 "
+                                "         FROM permissions "
+                                "         WHERE permissions.category_id = categories.category_id "
+                                "               AND "
+                                "               permissions.user_id = :user_id) "
+                                " OR "
+                                " EXISTS (SELECT 1 "
+                                "         FROM group_permissions "
+                                "           JOIN group_members ON group_members.group_id = group_permissions.group_id "
+                                "         WHERE group_permissions.category_id = categories.category_id "
+                                "               AND "
+                                "               group_members.user_id = :user_id))")
+
+
+def grant_permissions(category_id : int,
+                      user_ids    : list[int],
+                      group_ids   : list[int] | None = None
+                      ) -> None:
+    """Grant users and groups access to a category with one statement per table.
+
+    Existing permissions are left as they are.
     """
-    sql = text("INSERT INTO permissions (user_id, category_id)"
-               "VALUES (:user_id, :category_id) "
-               "ON CONFLICT DO NOTHING "
-               "RETURNING permission_id")
-    permission_id = db.session.execute(sql, {'user_id'     : user_id,
-                                             'category_id' : category_id}).fetchone()[0]
-    db.session.commit()
-    return permission_id
-
-
-def delete_permissions_for_category_from_db(category_id: int) -> None:
-    """Delete permissions for category from database."""
-    sql = text("DELETE "
+    if user_ids:
+        # SQLite needs the WHERE clause to tell ON CONFLICT apart from a join condition
+        sql = text("INSERT INTO permissions (category_id, user_id) "
+                   "SELECT :category_id, user_ids.value "
+                   f"FROM {array_table('user_ids', 'INTEGER')} "
+                   "WHERE true "
+                   "ON CONFLICT (category_id, user_id) DO NOTHING")
+        db.session.execute(sql, {'category_id' : category_id,
+                                 'user_ids'    : array_param(user_ids)})
+    if group_ids:
+        sql = text("INSERT INTO group_permissions (category_id, group_id) "
+                   "SELECT :category_id, group_ids.value "
+                   f"FROM {array_table('group_ids', 'INTEGER')} "
+                   "WHERE true "
+                   "ON CONFLICT (category_id, group_id) DO NOTHING")
+        db.session.execute(sql, {'category_id' : category_id,
+                                 'group_ids'   : array_param(group_ids)})
+    invalidate(f'permissions:{category_id}')
+    commit()
+
+
+def revoke_permissions(category_id : int,
+                       user_ids    : list[int],
+                       group_ids   : list[int] | None = None
+                       ) -> None:
+    """Revoke access to a category from users and groups with one statement per table."""
+    if user_ids:
+        sql = text("DELETE "
+                   "FROM permissions "
+                   "WHERE category_id = :category_id "
+                   "      AND "
+                   f"     user_id IN (SELECT user_ids.value FROM {array_table('user_ids', 'INTEGER')})")
+        db.session.execute(sql, {'category_id' : category_id,
+                                 'user_ids'    : array_param(user_ids)})
+    if group_ids:
+        sql = text("DELETE "
+                   "FROM group_permissions "
+                   "WHERE category_id = :category_id "
+                   "      AND "
+                   f"     group_id IN (SELECT group_ids.value FROM {array_table('group_ids', 'INTEGER')})")
+        db.session.execute(sql, {'category_id' : category_id,
+                                 'group_ids'   : array_param(group_ids)})
+    invalidate(f'permissions:{category_id}')
+    commit()
+
+
+def get_permission_summary(category_id: int) -> tuple[int, list[int]]:
+    """Return the number of users granted access to a category, and the ids of the groups granted access."""
+    sql = text("SELECT COUNT(*) "
                "FROM permissions "
                "WHERE category_id = :category_id")
-    db.session.execute(sql, {'category_id': category_id})
-    db.session.commit()
+    user_count = execute_read(sql, {'category_id': category_id}).scalar()
+
+    sql = text("SELECT group_id "
+               "FROM group_permissions "
+               "WHERE category_id = :category_id")
+    group_ids = [group_id for group_id, in execute_read(sql, {'category_id': category_id}).fetchall()]
+    return user_count, group_ids
+
+
+USER_IS_WHITELISTED = statements.register('user_is_whitelisted',
+                                          "SELECT "
+                                          "  EXISTS (SELECT 1 "
+                                          "          FROM permissions "
+                                          "          WHERE category_id = :category_id "
+                                          "                AND "
+                                          "                user_id = :user_id) "
+                                          "  OR "
+                                          "  EXISTS (SELECT 1 "
+                                          "          FROM group_permissions "
+                                          "            JOIN group_members "
+                                          "              ON group_members.group_id = group_permissions.group_id "
+                                          "          WHERE group_permissions.category_id = :category_id "
+                                          "                AND "
+                                          "                group_members.user_id = :user_id)",
+                                          prepare=True)
 
 
 def user_is_whitelisted(category_id: int, user_id: int) -> bool:
-    """Return true if the user is whitelisted."""
-    sql = text("SELECT user_id "
-               "FROM permissions "
-               "WHERE category_id = :category_id ")
-    permission_ids = [t[0] for t in db.session.execute(sql, {'category_id': category_id}).fetchall()]
-    return user_id in permission_ids
+    """Return true if the user or one of their groups is whitelisted."""
+    return cached_read(permission_cache, permission_generation, (category_id, user_id),
+                       lambda: execute_read(USER_IS_WHITELISTED, {'category_id' : category_id,
+                                                                  'user_id'     : user_id}).scalar())
+
+
+###############################################################################
+#                                    GROUPS                                   #
+###############################################################################
+
+def group_exists_in_db(name: str) -> bool:
+    """Return True if a user group with the name exists."""
+    sql = text("SELECT EXISTS (SELECT 1 FROM user_groups WHERE name = :name)")
+    return execute_read(sql, {'name': name}).scalar()
+
+
+def insert_group_into_db(name: str, user_ids: list[int]) -> int:
+    """Insert user group with its members into the database. Return group_id."""
+    sql = text("INSERT INTO user_groups (name) "
+               "VALUES (:name) "
+               "RETURNING group_id")
+    group_id = db.session.execute(sql, {'name': name}).scalar()
+
+    sql = text("INSERT INTO group_members (group_id, user_id) "
+               "SELECT :group_id, user_ids.value "
+               f"FROM {array_table('user_ids', 'INTEGER')} "
+               "WHERE true "
+               "ON CONFLICT DO NOTHING")
+    db.session.execute(sql, {'group_id' : group_id,
+                             'user_ids' : array_param(user_ids)})
+    commit()
+    return group_id
+
+
+def get_groups() -> list[tuple[int, str, int]]:
+    """Get user groups as (group_id, name, member_count) tuples."""
+    sql = text("SELECT "
+               "  user_groups.group_id, "
+               "  user_groups.name, "
+               "  (SELECT COUNT(*) "
+               "   FROM group_members "
+               "   WHERE group_members.group_id = user_groups.group_id) "
+               "FROM user_groups "
+               "ORDER BY user_groups.name")
+    return execute_read(sql).fetchall()
 
 
 def user_has_permission_to_category(category_id: int, user_id: int) -> bool:
@@ -381,17 +1245,22 @@ def insert_thread_into_db(category_id : int,
                           title       : str,
                           content     : str
                           ) -> int:
-    """Insert new thread into the database."""
-    sql = text("INSERT INTO threads (category_id, user_id, title, content) "
-               "VALUES (:category_id, :user_id, :title, :content) "
+    """Insert new thread into the database with its content rendered into HTML."""
+    sql = text("INSERT INTO threads (category_id, user_id, title, content, content_html, render_version) "
+               "VALUES (:category_id, :user_id, :title, :content, :content_html, :render_version) "
                "ON CONFLICT DO NOTHING "
                "RETURNING thread_id")
-    thread_id = db.session.execute(sql, {'category_id' : category_id,
-                                         'user_id'     : user_id,
-                                         'title'       : title,
-                                         'content'     : content}).fetchone()[0]
-
-    db.session.commit()
+    thread_id = db.session.execute(sql, {'category_id'    : category_id,
+                                         'user_id'        : user_id,
+                                         'title'          : title,
+                                         'content'        : content,
+                                         'content_html'   : render(content),
+                                         'render_version' : RENDERER_VERSION}).fetchone()[0]
+
+    bump_content_version_by_thread_id(thread_id)
+    invalidate('content')
+    invalidate('titles')
+    commit()
     return thread_id
 
 
@@ -399,89 +1268,262 @@ def update_thread_in_db(thread_id : int,
                         title     : str,
                         message   : str
                         ) -> None:
-    """Update thread in database."""
+    """Update thread in database with its content rendered into HTML."""
     sql = text("UPDATE threads "
                "SET "
                "  title = :title, "
-               "  content = :content "
+               "  content = :content, "
+               "  content_html = :content_html, "
+               "  render_version = :render_version "
                "WHERE threads.thread_id = :thread_id ")
-    db.session.execute(sql, {'thread_id' : thread_id,
-                             'title'     : title,
-                             'content'   : message})
-    db.session.commit()
+    db.session.execute(sql, {'thread_id'      : thread_id,
+                             'title'          : title,
+                             'content'        : message,
+                             'content_html'   : render(message),
+                             'render_version' : RENDERER_VERSION})
+    bump_content_version_by_thread_id(thread_id)
+    invalidate('content')
+    invalidate('titles')
+    commit()
 
 
 def delete_thread_from_db(thread_id: int) -> None:
-    """Delete thread from database."""
-    sql = text("DELETE "
-               "FROM threads "
-               "WHERE threads.thread_id = :thread_id")
+    """Delete thread from database with the users' read watermarks of it."""
+    bump_content_version_by_thread_id(thread_id)
+
+    for table in ['thread_reads', 'threads']:
+        sql = text("DELETE "
+                   f"FROM {table} "
+                   "WHERE thread_id = :thread_id")
+        db.session.execute(sql, {'thread_id': thread_id})
+    invalidate('content')
+    invalidate('titles')
+    invalidate(f'threads:{thread_id}')
+    commit()
+
+
+def bump_content_version_by_thread_id(thread_id: int) -> None:
+    """Increment the content version of the thread's category, which invalidates its cached feeds."""
+    sql = text("UPDATE categories "
+               "SET content_version = content_version + 1 "
+               "WHERE category_id = (SELECT category_id "
+               "                     FROM threads "
+               "                     WHERE thread_id = :thread_id)")
     db.session.execute(sql, {'thread_id': thread_id})
-    db.session.commit()
 
 
-def get_thread_by_thread_id(thread_id: int) -> Thread:
-    """Get Thread object generated from database with thread_id."""
+def bump_content_version_by_reply_id(reply_id: int) -> None:
+    """Increment the content version of the reply's category, which invalidates its cached feeds."""
+    sql = text("UPDATE categories "
+               "SET content_version = content_version + 1 "
+               "WHERE category_id = (SELECT threads.category_id "
+               "                     FROM replies "
+               "                       JOIN threads ON threads.thread_id = replies.thread_id "
+               "                     WHERE replies.reply_id = :reply_id)")
+    db.session.execute(sql, {'reply_id': reply_id})
+
+
+CATEGORY_ID_BY_THREAD_ID = statements.register('category_id_by_thread_id',
+                                               "SELECT category_id "
+                                               "FROM threads "
+                                               "WHERE thread_id = :thread_id",
+                                               prepare=True)
+
+
+def get_category_id_by_thread_id(thread_id: int) -> int | None:
+    """Get category_id of a thread by thread_id, or None if the thread doesn't exist."""
+    category_id = cached_read(thread_cache, thread_generation, thread_id,
+                              lambda: execute_read(CATEGORY_ID_BY_THREAD_ID, {'thread_id': thread_id}).scalar())
+    return category_id
+
+
+THREAD_BY_THREAD_ID = statements.register('thread_by_thread_id',
+                                          "SELECT "
+                                          "  threads.thread_id, "
+                                          "  threads.category_id, "
+                                          "  threads.user_id, "
+                                          "  users.username, "
+                                          "  threads.thread_tstamp, "
+                                          "  threads.title, "
+                                          "  threads.content, "
+                                          "  threads.content_html "
+                                          "FROM threads, users "
+                                          "WHERE "
+                                          "  threads.user_id = users.user_id "
+                                          "  AND"
+                                          "  threads.thread_id = :thread_id "
+                                          "ORDER BY thread_tstamp",
+                                          prepare=True)
+
+
+def get_thread_by_thread_id(thread_id: int, include_replies: bool = True) -> Thread:
+    """Get Thread object generated from database with thread_id.
+
+    With include_replies=False only OP's message is loaded, e.g. when
+    the replies are streamed separately.
+    """
+    thread_data = execute_read(THREAD_BY_THREAD_ID, {'thread_id': thread_id}).fetchone()
+    thread = Thread(*thread_data)
+
+    if include_replies:
+        for reply in get_list_of_replies_by_thread_id(thread_id):
+            thread.replies[reply.reply_id] = reply
+
+    return thread
+
+
+def get_thread_summaries_by_thread_ids(thread_ids: list[int], user_id: int) -> list[dict]:
+    """Get summaries of threads by thread_ids with a single query.
+
+    Threads the user has no access to are left out. Each summary contains
+    OP's message, the number of posts, and the timestamp of the most recent post.
+    """
     sql = text("SELECT "
                "  threads.thread_id, "
                "  threads.category_id, "
                "  threads.user_id, "
                "  users.username, "
-               "  threads.thread_tstamp, "
+               "  threads.thread_tstamp AS created, "
                "  threads.title, "
-               "  threads.content "
-               "FROM threads, users "
-               "WHERE "
-               "  threads.user_id = users.user_id "
-               "  AND"
-               "  threads.thread_id = :thread_id "
-               "ORDER BY thread_tstamp")
-
-    thread_data = db.session.execute(sql, {'thread_id': thread_id}).fetchone()
-    thread = Thread(*thread_data)
-
-    for reply in get_list_of_replies_by_thread_id(thread_id):
-        thread.replies[reply.reply_id] = reply
-
-    return thread
+               "  threads.content, "
+               "  threads.content_html, "
+               "  COUNT(replies.reply_id) + 1 AS posts, "
+               "  COALESCE(MAX(replies.reply_tstamp), threads.thread_tstamp) AS most_recent_post "
+               "FROM threads "
+               "  JOIN users ON users.user_id = threads.user_id "
+               "  JOIN categories ON categories.category_id = threads.category_id "
+               "  LEFT JOIN replies ON replies.thread_id = threads.thread_id "
+               "                       AND "
+               "                       replies.reply_tstamp >= threads.thread_tstamp "
+               "WHERE threads.thread_id IN :thread_ids "
+               "      AND "
+               f"     {PERMITTED_CATEGORY_CONDITION} "
+               "GROUP BY threads.thread_id, users.username "
+               "ORDER BY threads.thread_id"
+               ).bindparams(bindparam('thread_ids', expanding=True)).columns(most_recent_post=DateTime)
+    summaries = execute_read(sql, {'thread_ids' : thread_ids,
+                                         'user_id'    : user_id}).mappings().fetchall()
+    return [dict(summary) for summary in summaries]
 
 
 ###############################################################################
 #                                   REPLIES                                   #
 ###############################################################################
 
+# Replies are never older than their thread. Stating it in queries by thread
+# lets PostgreSQL skip the older partitions of replies and likes when the
+# tables have been partitioned by timestamp (see src/partitions.py).
+THREAD_REPLIES_CONDITION = ("replies.thread_id = :thread_id "
+                            "AND "
+                            "replies.reply_tstamp >= (SELECT threads.thread_tstamp "
+                            "                         FROM threads "
+                            "                         WHERE threads.thread_id = :thread_id)")
+
+
+def publish_thread_event(event: dict) -> None:
+    """Publish event to the thread's live subscribers in this process once the transaction commits.
+
+    This replaces NOTIFY on SQLite, which is only used by single-process installs.
+    """
+    db.session.info.setdefault('thread_events', []).append(event)
+
+
+def notify_reply_event(reply_id: int, event: str) -> None:
+    """Queue notification about a reply to the thread's live subscribers.
+
+    The notification is delivered when the current transaction commits.
+    """
+    if IS_SQLITE:
+        sql = text("SELECT thread_id, like_count "
+                   "FROM replies "
+                   "WHERE reply_id = :reply_id")
+        thread_id, like_count = db.session.execute(sql, {'reply_id': reply_id}).fetchone()
+        publish_thread_event({'thread_id' : thread_id,
+                              'reply_id'  : reply_id,
+                              'event'     : event,
+                              'likes'     : like_count})
+        return
+
+    sql = text("SELECT pg_notify(:channel, "
+               "                 json_build_object('thread_id', replies.thread_id, "
+               "                                   'reply_id',  replies.reply_id, "
+               "                                   'event',     CAST(:event AS TEXT), "
+               "                                   'likes',     replies.like_count)::text) "
+               "FROM replies "
+               "WHERE replies.reply_id = :reply_id")
+    db.session.execute(sql, {'channel'  : THREAD_EVENT_CHANNEL,
+                             'reply_id' : reply_id,
+                             'event'    : event})
+
+
 def insert_reply_into_db(thread_id : int,
                          user_id   : int,
                          content   : str
                          ) -> int:
-    """Insert reply to replies table. Return reply_id."""
-    sql = text("INSERT INTO replies (thread_id, user_id, content)"
-               "VALUES (:thread_id, :user_id, :content)"
+    """Insert reply to replies table with its content rendered into HTML. Return reply_id."""
+    sql = text("INSERT INTO replies (thread_id, user_id, content, content_html, render_version)"
+               "VALUES (:thread_id, :user_id, :content, :content_html, :render_version)"
                "ON CONFLICT DO NOTHING "
                "RETURNING replies.reply_id ")
-    reply_id = db.session.execute(sql, {'thread_id' : thread_id,
-                                        'user_id'   : user_id,
-                                        'content'   : content}).fetchone()[0]
-    db.session.commit()
+    reply_id = db.session.execute(sql, {'thread_id'      : thread_id,
+                                        'user_id'        : user_id,
+                                        'content'        : content,
+                                        'content_html'   : render(content),
+                                        'render_version' : RENDERER_VERSION}).fetchone()[0]
+
+    # Reply ids are taken in insert order but the transactions may commit in another order,
+    # so a concurrent reply with a higher id may already have updated the thread
+    sql = text("UPDATE threads "
+               f"SET last_reply_id = {GREATEST}(COALESCE(last_reply_id, 0), :reply_id) "
+               "WHERE thread_id = :thread_id")
+    db.session.execute(sql, {'thread_id': thread_id, 'reply_id': reply_id})
+
+    bump_content_version_by_thread_id(thread_id)
+    notify_reply_event(reply_id, 'reply')
+    invalidate('content')
+    commit()
     return reply_id
 
 
 def update_reply_in_db(reply_id: int, message: str) -> None:
-    """Update reply in database."""
+    """Update reply in database with its content rendered into HTML."""
     sql = text("UPDATE replies "
-               "SET content = :content "
+               "SET "
+               "  content = :content, "
+               "  content_html = :content_html, "
+               "  render_version = :render_version "
                "WHERE replies.reply_id = :reply_id ")
-    db.session.execute(sql, {'reply_id' : reply_id,
-                             'content'  : message})
-    db.session.commit()
+    db.session.execute(sql, {'reply_id'       : reply_id,
+                             'content'        : message,
+                             'content_html'   : render(message),
+                             'render_version' : RENDERER_VERSION})
+    bump_content_version_by_reply_id(reply_id)
+    notify_reply_event(reply_id, 'reply_edited')
+    invalidate('content')
+    commit()
 
 
 def delete_reply_from_db(reply_id: int) -> None:
     """Delete reply from database."""
+    bump_content_version_by_reply_id(reply_id)
+    notify_reply_event(reply_id, 'reply_deleted')
+
+    sql = text("DELETE FROM likes "
+               "WHERE likes.reply_id = :reply_id")
+    db.session.execute(sql, {'reply_id': reply_id})
+
     sql = text("DELETE FROM replies "
                "WHERE replies.reply_id = :reply_id")
     db.session.execute(sql, {'reply_id': reply_id})
-    db.session.commit()
+
+    sql = text("UPDATE threads "
+               "SET last_reply_id = (SELECT MAX(replies.reply_id) "
+               "                     FROM replies "
+               "                     WHERE replies.thread_id = threads.thread_id) "
+               "WHERE last_reply_id = :reply_id")
+    db.session.execute(sql, {'reply_id': reply_id})
+    invalidate('content')
+    commit()
 
 
 def get_reply_by_id(reply_id: int) -> Reply:
@@ -492,111 +1534,1201 @@ def get_reply_by_id(reply_id: int) -> Reply:
                "  replies.user_id, "
                "  users.username, "
                "  replies.reply_tstamp, "
-               "  replies.content "
+               "  replies.content, "
+               "  replies.like_count, "
+               "  replies.content_html "
                "FROM replies, users "
                "WHERE "
                "  replies.user_id = users.user_id "
                "  AND "
                "  replies.reply_id = :reply_id "
                "ORDER BY replies.reply_tstamp")
-    reply_data = db.session.execute(sql, {'reply_id': reply_id}).fetchone()
+    reply_data = execute_read(sql, {'reply_id': reply_id}).fetchone()
     return Reply(*reply_data)
 
 
+REPLIES_BY_THREAD_ID = statements.register('replies_by_thread_id',
+                                           "SELECT "
+                                           "  replies.reply_id, "
+                                           "  replies.thread_id, "
+                                           "  replies.user_id, "
+                                           "  users.username, "
+                                           "  replies.reply_tstamp, "
+                                           "  replies.content, "
+                                           "  replies.like_count, "
+                                           "  replies.content_html "
+                                           "FROM replies, users "
+                                           "WHERE "
+                                           "  replies.user_id = users.user_id "
+                                           "  AND "
+                                           f" {THREAD_REPLIES_CONDITION} "
+                                           "ORDER BY replies.reply_tstamp",
+                                           prepare=True)
+
+
 def get_list_of_replies_by_thread_id(thread_id: int) -> list[Reply]:
     """Get list of Reply objects by thread_id."""
+    replies_data = execute_read(REPLIES_BY_THREAD_ID, {'thread_id': thread_id}).fetchall()
+    replies = {reply_data[0]: Reply(*reply_data) for reply_data in replies_data}
+
+    for reply_id, like in get_likes_by_thread_id(thread_id):
+        replies[reply_id].likes[like.user_id] = like
+
+    return list(replies.values())
+
+
+def iterate_replies_by_thread_id(thread_id: int, user_id: int) -> Iterator[Reply]:
+    """Yield Reply objects of a thread through a server-side cursor.
+
+    Only REPLY_STREAM_BATCH rows are held in memory at a time. Instead of
+    all likes, each Reply only has the like of the user, if they've liked it.
+    """
     sql = text("SELECT "
                "  replies.reply_id, "
                "  replies.thread_id, "
                "  replies.user_id, "
                "  users.username, "
                "  replies.reply_tstamp, "
-               "  replies.content "
+               "  replies.content, "
+               "  replies.like_count, "
+               "  replies.content_html, "
+               "  EXISTS (SELECT 1 "
+               "          FROM likes "
+               "          WHERE likes.reply_id = replies.reply_id "
+               "                AND "
+               "                likes.reply_tstamp = replies.reply_tstamp "
+               "                AND "
+               "                likes.user_id = :user_id) "
                "FROM replies, users "
                "WHERE "
                "  replies.user_id = users.user_id "
                "  AND "
-               "  replies.thread_id = :thread_id "
-               "ORDER BY replies.reply_tstamp")
-    replies_data = db.session.execute(sql, {'thread_id': thread_id}).fetchall()
-    list_of_replies = [Reply(*reply_data) for reply_data in replies_data]
+               f" {THREAD_REPLIES_CONDITION} "
+               "ORDER BY replies.reply_tstamp"
+               ).execution_options(stream_results=True, yield_per=REPLY_STREAM_BATCH)
+    rows = stream_read(sql, {'thread_id' : thread_id,
+                             'user_id'   : user_id})
+    try:
+        for *reply_data, has_liked in rows:
+            reply = Reply(*reply_data)
+            if has_liked:
+                reply.likes[user_id] = Like(user_id, reply.reply_id)
+            yield reply
+    finally:
+        rows.close()
+
+
+PAGE_OF_REPLIES_BY_THREAD_ID = statements.register('page_of_replies_by_thread_id',
+                                                   "SELECT "
+                                                   "  replies.reply_id, "
+                                                   "  replies.user_id, "
+                                                   "  users.username, "
+                                                   "  replies.reply_tstamp AS created, "
+                                                   "  replies.content, "
+                                                   "  replies.content_html, "
+                                                   "  replies.like_count AS likes "
+                                                   "FROM replies "
+                                                   "  JOIN users ON users.user_id = replies.user_id "
+                                                   f"WHERE {THREAD_REPLIES_CONDITION} "
+                                                   "ORDER BY replies.reply_tstamp, replies.reply_id "
+                                                   "LIMIT :limit OFFSET :offset",
+                                                   prepare=True)
+
+
+def get_page_of_replies_by_thread_id(thread_id : int,
+                                     page      : int,
+                                     page_size : int
+                                     ) -> list[dict]:
+    """Get a page of the thread's replies with their like counts."""
+    replies = execute_read(PAGE_OF_REPLIES_BY_THREAD_ID, {'thread_id' : thread_id,
+                                                          'limit'     : page_size,
+                                                          'offset'    : (page - 1) * page_size}).mappings().fetchall()
+    return [dict(reply) for reply in replies]
+
+
+###############################################################################
+#                                    LIKES                                    #
+###############################################################################
+
+# Tail of the like toggle statements: the `counted` CTE returns the new like
+# count and notifies the thread's live subscribers about it.
+LIKE_COUNT_RETURNING = ("RETURNING replies.like_count, "
+                        "          pg_notify(:channel, "
+                        "                    json_build_object('thread_id', replies.thread_id, "
+                        "                                      'reply_id',  replies.reply_id, "
+                        "                                      'event',     'like', "
+                        "                                      'likes',     replies.like_count)::text)")
+
+LIKE_RESULT = ("SELECT target.user_id = :user_id, "
+               "       (SELECT counted.like_count FROM counted), "
+               "       target.thread_id "
+               "FROM target")
+
+
+# SQLite has no data-modifying CTEs, so it toggles likes with toggle_like_in_sqlite() instead
+if not IS_SQLITE:
+    INSERT_LIKE = statements.register('insert_like',
+                                      "WITH target AS ("
+                                      "  SELECT replies.reply_id, replies.user_id, replies.reply_tstamp, replies.thread_id "
+                                      "  FROM replies "
+                                      "  WHERE replies.reply_id = :reply_id"
+                                      "), inserted AS ("
+                                      "  INSERT INTO likes (reply_id, user_id, reply_tstamp) "
+                                      "  SELECT target.reply_id, :user_id, target.reply_tstamp "
+                                      "  FROM target "
+                                      "  WHERE target.user_id <> :user_id "
+                                      "  ON CONFLICT DO NOTHING "
+                                      "  RETURNING likes.reply_id, likes.reply_tstamp"
+                                      "), counted AS ("
+                                      "  UPDATE replies "
+                                      "  SET like_count = replies.like_count + 1 "
+                                      "  FROM inserted "
+                                      "  WHERE replies.reply_id = inserted.reply_id "
+                                      "        AND "
+                                      "        replies.reply_tstamp = inserted.reply_tstamp "
+                                      f" {LIKE_COUNT_RETURNING}"
+                                      ") "
+                                      f"{LIKE_RESULT}",
+                                      prepare=True)
+
+    DELETE_LIKE = statements.register('delete_like',
+                                      "WITH target AS ("
+                                      "  SELECT replies.reply_id, replies.user_id, replies.reply_tstamp, replies.thread_id "
+                                      "  FROM replies "
+                                      "  WHERE replies.reply_id = :reply_id"
+                                      "), deleted AS ("
+                                      "  DELETE "
+                                      "  FROM likes "
+                                      "  USING target "
+                                      "  WHERE likes.reply_id = target.reply_id "
+                                      "        AND "
+                                      "        likes.reply_tstamp = target.reply_tstamp "
+                                      "        AND "
+                                      "        likes.user_id = :user_id "
+                                      "  RETURNING likes.reply_id, likes.reply_tstamp"
+                                      "), counted AS ("
+                                      "  UPDATE replies "
+                                      "  SET like_count = replies.like_count - 1 "
+                                      "  FROM deleted "
+                                      "  WHERE replies.reply_id = deleted.reply_id "
+                                      "        AND "
+                                      "        replies.reply_tstamp = deleted.reply_tstamp "
+                                      f" {LIKE_COUNT_RETURNING}"
+                                      ") "
+                                      f"{LIKE_RESULT}",
+                                      prepare=True)
+
+
+def insert_like_to_db(user_id: int, reply_id: int) -> tuple[bool, int | None] | None:
+    """Insert like to the database with a single statement.
+
+    Returns a tuple (is_own_reply, like_count), or None if the reply
+    doesn't exist. The like is only inserted if the reply isn't the
+    user's own and the user hasn't liked it yet, in which case
+    like_count is the reply's new like count, otherwise None.
+    Live subscribers of the thread are notified of the new count,
+    and its cached page is marked outdated.
+    """
+    if IS_SQLITE:
+        result = toggle_like_in_sqlite(user_id, reply_id, liked=True)
+        commit()
+        return result
+
+    result = execute(INSERT_LIKE, {'reply_id' : reply_id,
+                                   'user_id'  : user_id,
+                                   'channel'  : THREAD_EVENT_CHANNEL}).fetchone()
+    if result is not None and result[1] is not None:
+        invalidate(f'content:{result[2]}')
+    commit()
+    return (result[0], result[1]) if result is not None else None
+
+
+def delete_like_from_db(user_id: int, reply_id: int) -> tuple[bool, int | None] | None:
+    """Remove like from the database with a single statement.
+
+    Returns a tuple (is_own_reply, like_count), or None if the reply
+    doesn't exist. If the user had liked the reply, like_count is the
+    reply's new like count, otherwise None.
+    Live subscribers of the thread are notified of the new count,
+    and its cached page is marked outdated.
+    """
+    if IS_SQLITE:
+        result = toggle_like_in_sqlite(user_id, reply_id, liked=False)
+        commit()
+        return result
+
+    result = execute(DELETE_LIKE, {'reply_id' : reply_id,
+                                   'user_id'  : user_id,
+                                   'channel'  : THREAD_EVENT_CHANNEL}).fetchone()
+    if result is not None and result[1] is not None:
+        invalidate(f'content:{result[2]}')
+    commit()
+    return (result[0], result[1]) if result is not None else None
+
+
+def flush_likes_to_db(likes   : list[tuple[int, int]],
+                      unlikes : list[tuple[int, int]]
+                      ) -> None:
+    """Write a batch of buffered like toggles as (reply_id, user_id) tuples.
+
+    The toggles are written with executemany in a single transaction, the
+    threads' live subscribers are notified once per affected reply, and the
+    cached pages of the threads are marked outdated.
+    """
+    if IS_SQLITE:
+        for reply_id, user_id in likes:
+            toggle_like_in_sqlite(user_id, reply_id, liked=True)
+        for reply_id, user_id in unlikes:
+            toggle_like_in_sqlite(user_id, reply_id, liked=False)
+        commit()
+        return
+
+    if likes:
+        sql = text("WITH inserted AS ("
+                   "  INSERT INTO likes (reply_id, user_id, reply_tstamp) "
+                   "  SELECT replies.reply_id, :user_id, replies.reply_tstamp "
+                   "  FROM replies "
+                   "  WHERE replies.reply_id = :reply_id "
+                   "        AND "
+                   "        replies.user_id <> :user_id "
+                   "  ON CONFLICT DO NOTHING "
+                   "  RETURNING likes.reply_id"
+                   ") "
+                   "UPDATE replies "
+                   "SET like_count = replies.like_count + 1 "
+                   "FROM inserted "
+                   "WHERE replies.reply_id = inserted.reply_id")
+        db.session.execute(sql, [{'reply_id': reply_id, 'user_id': user_id} for reply_id, user_id in likes])
+
+    if unlikes:
+        sql = text("WITH deleted AS ("
+                   "  DELETE "
+                   "  FROM likes "
+                   "  WHERE likes.reply_id = :reply_id "
+                   "        AND "
+                   "        likes.user_id = :user_id "
+                   "  RETURNING likes.reply_id"
+                   ") "
+                   "UPDATE replies "
+                   "SET like_count = replies.like_count - 1 "
+                   "FROM deleted "
+                   "WHERE replies.reply_id = deleted.reply_id")
+        db.session.execute(sql, [{'reply_id': reply_id, 'user_id': user_id} for reply_id, user_id in unlikes])
+
+    sql = text("SELECT "
+               "  replies.thread_id, "
+               "  pg_notify(:channel, "
+               "            json_build_object('thread_id', replies.thread_id, "
+               "                              'reply_id',  replies.reply_id, "
+               "                              'event',     'like', "
+               "                              'likes',     replies.like_count)::text) "
+               "FROM replies "
+               "WHERE replies.reply_id IN :reply_ids"
+               ).bindparams(bindparam('reply_ids', expanding=True))
+    notified = db.session.execute(sql, {'channel'   : THREAD_EVENT_CHANNEL,
+                                        'reply_ids' : list({reply_id for reply_id, _ in likes + unlikes})}).fetchall()
+    for thread_id in {row.thread_id for row in notified}:
+        invalidate(f'content:{thread_id}')
+    commit()
+
+
+def toggle_like_in_sqlite(user_id: int, reply_id: int, liked: bool) -> tuple[bool, int | None] | None:
+    """Like (liked=True) or unlike a reply one statement at a time, as SQLite has no data-modifying CTEs.
+
+    Returns the same (is_own_reply, like_count) tuple, or None, as insert_like_to_db().
+    The caller commits the transaction.
+    """
+    sql = text("SELECT user_id, reply_tstamp "
+               "FROM replies "
+               "WHERE reply_id = :reply_id")
+    target = db.session.execute(sql, {'reply_id': reply_id}).fetchone()
+
+    if target is None:
+        return None
+    if target.user_id == user_id:
+        return True, None
+
+    if liked:
+        sql = text("INSERT INTO likes (reply_id, user_id, reply_tstamp) "
+                   "VALUES (:reply_id, :user_id, :reply_tstamp) "
+                   "ON CONFLICT DO NOTHING")
+    else:
+        sql = text("DELETE "
+                   "FROM likes "
+                   "WHERE reply_id = :reply_id "
+                   "      AND "
+                   "      user_id = :user_id")
+    changed = db.session.execute(sql, {'reply_id'     : reply_id,
+                                       'user_id'      : user_id,
+                                       'reply_tstamp' : target.reply_tstamp}).rowcount
+    if not changed:
+        return False, None
+
+    sql = text("UPDATE replies "
+               "SET like_count = like_count + :change "
+               "WHERE reply_id = :reply_id "
+               "RETURNING thread_id, like_count")
+    thread_id, like_count = db.session.execute(sql, {'reply_id' : reply_id,
+                                                     'change'   : 1 if liked else -1}).fetchone()
+    publish_thread_event({'thread_id' : thread_id,
+                          'reply_id'  : reply_id,
+                          'event'     : 'like',
+                          'likes'     : like_count})
+    invalidate(f'content:{thread_id}')
+    return False, like_count
+
+
+def user_has_liked_reply(user_id: int, reply_id: int) -> bool:
+    """Check if user has liked a reply."""
+    sql = text("SELECT EXISTS (SELECT 1 "
+               "               FROM likes "
+               "               WHERE user_id=:user_id "
+               "                     AND "
+               "                     reply_id=:reply_id)")
+    has_liked = execute_read(sql, {'user_id'  : user_id,
+                                   'reply_id' : reply_id}).fetchone()[0]
+    return has_liked
+
+
+def get_likes_by_reply_id(reply_id: int) -> dict[int, Like]:
+    """Return likes for reply as {user_id : Like} dictionary."""
+    sql = text("SELECT user_id "
+               "FROM likes "
+               "WHERE reply_id = :reply_id")
+    likes_data = execute_read(sql, {'reply_id': reply_id}).fetchall()
+    return {user_id: Like(user_id, reply_id) for user_id, in likes_data}
+
 
-    for reply in list_of_replies:
-        reply.likes = get_likes_by_reply_id(reply.reply_id)
+LIKES_BY_THREAD_ID = statements.register('likes_by_thread_id',
+                                         "SELECT likes.reply_id, likes.user_id "
+                                         "FROM likes, replies "
+                                         "WHERE likes.reply_id = replies.reply_id "
+                                         "      AND "
+                                         "      likes.reply_tstamp = replies.reply_tstamp "
+                                         "      AND "
+                                         f"     {THREAD_REPLIES_CONDITION}",
+                                         prepare=True)
 
-    return list_of_replies
+
+def get_likes_by_thread_id(thread_id: int) -> list[tuple[int, Like]]:
+    """Return likes for the replies of a thread as a list of (reply_id, Like) tuples."""
+    likes_data = execute_read(LIKES_BY_THREAD_ID, {'thread_id': thread_id}).fetchall()
+    return [(reply_id, Like(user_id, reply_id)) for reply_id, user_id in likes_data]
 
 
 ###############################################################################
-#                                    LIKES                                    #
+#                                    READS                                    #
+###############################################################################
+
+def flush_thread_reads_to_db(reads: list[tuple[int, int, int]]) -> None:
+    """Write a batch of buffered read watermarks as (user_id, thread_id, last_read_reply_id) tuples.
+
+    The watermarks are upserted with executemany in a single transaction,
+    in key order so that concurrent flushes don't deadlock. A watermark
+    never moves backwards, and watermarks of deleted threads are skipped.
+    """
+    sql = text("INSERT INTO thread_reads (user_id, thread_id, last_read_reply_id) "
+               "SELECT :user_id, threads.thread_id, :last_read_reply_id "
+               "FROM threads "
+               "WHERE threads.thread_id = :thread_id "
+               "ON CONFLICT (user_id, thread_id) DO UPDATE "
+               "SET last_read_reply_id = excluded.last_read_reply_id "
+               "WHERE excluded.last_read_reply_id > thread_reads.last_read_reply_id")
+    db.session.execute(sql, [{'user_id'            : user_id,
+                              'thread_id'          : thread_id,
+                              'last_read_reply_id' : last_read_reply_id}
+                             for user_id, thread_id, last_read_reply_id in sorted(reads)])
+    commit()
+
+
+THREAD_READ_STATE = statements.register('thread_read_state',
+                                        "SELECT "
+                                        "  COALESCE(threads.last_reply_id, 0), "
+                                        "  thread_reads.last_read_reply_id "
+                                        "FROM threads "
+                                        "  LEFT JOIN thread_reads ON thread_reads.thread_id = threads.thread_id "
+                                        "                            AND "
+                                        "                            thread_reads.user_id = :user_id "
+                                        "WHERE threads.thread_id = :thread_id",
+                                        prepare=True)
+
+
+def get_thread_read_state(thread_id: int, user_id: int) -> tuple[int, int | None]:
+    """Get the latest reply id of a thread, and the user's read watermark of it.
+
+    The latest reply id is 0 if the thread has no replies, and
+    the watermark is None if the user hasn't read the thread.
+    """
+    last_reply_id, last_read_reply_id = execute_read(THREAD_READ_STATE, {'thread_id' : thread_id,
+                                                                         'user_id'   : user_id}).fetchone()
+    return last_reply_id, last_read_reply_id
+
+
+def get_unread_thread_ids(user_id: int, thread_ids: list[int]) -> dict[int, int]:
+    """Get the threads of `thread_ids` with posts the user hasn't read, as a {thread_id: last_reply_id} dictionary.
+
+    A thread is unread if the user has never read it, or if its latest
+    reply is newer than the user's read watermark. Both are compared
+    in a single query, without counting the replies. Only the threads
+    being rendered are looked up, so the result stays bounded by what
+    the user can see.
+    """
+    if not thread_ids:
+        return dict()
+
+    sql = text("SELECT "
+               "  threads.thread_id, "
+               "  COALESCE(threads.last_reply_id, 0) "
+               f"FROM {array_table('thread_ids', 'INTEGER')} "
+               "  JOIN threads ON threads.thread_id = thread_ids.value "
+               "  LEFT JOIN thread_reads ON thread_reads.thread_id = threads.thread_id "
+               "                            AND "
+               "                            thread_reads.user_id = :user_id "
+               "WHERE thread_reads.last_read_reply_id IS NULL "
+               "      OR "
+               "      COALESCE(threads.last_reply_id, 0) > thread_reads.last_read_reply_id")
+    return dict(execute_read(sql, {'user_id'    : user_id,
+                                   'thread_ids' : array_param(thread_ids)}).fetchall())
+
+
+###############################################################################
+#                                  RENDERING                                  #
 ###############################################################################
 
-def insert_like_to_db(user_id: int, reply_id: int) -> None:
-    """Insert like to the database."""
-    sql = text("INSERT INTO likes (reply_id, user_id) "
-               "VALUES (:reply_id, :user_id)")
-    db.session.execute(sql, {'reply_id': reply_id,
-                             'user_id': user_id})
+def rerender_stale_content(batch_size: int = 1000) -> int:
+    """Render the content of threads and replies rendered by an older renderer.
+
+    Rows are walked in primary key order and updated in batches, each in
+    its own transaction, so the forum stays usable meanwhile. Each batch
+    invalidates the cached content, so the new HTML is shown as soon as
+    it's committed. Returns the number of re-rendered posts.
+    """
+    rendered = 0
+
+    for table, key, columns in [('threads', 'thread_id', 'thread_id'),
+                                ('replies', 'reply_id',  'reply_id, reply_tstamp')]:
+        last_id = 0
+        while True:
+            sql = text(f"SELECT {columns}, content "
+                       f"FROM {table} "
+                       f"WHERE {key} > :last_id "
+                       "      AND "
+                       "      render_version IS DISTINCT FROM :render_version "
+                       f"ORDER BY {key} "
+                       "LIMIT :limit")
+            rows = db.session.execute(sql, {'last_id'        : last_id,
+                                            'render_version' : RENDERER_VERSION,
+                                            'limit'          : batch_size}).fetchall()
+            if not rows:
+                break
+
+            # Partitioned replies are located by their timestamp too
+            condition = f"{key} = :id" + (" AND reply_tstamp = :tstamp" if table == 'replies' else "")
+            sql = text(f"UPDATE {table} "
+                       "SET "
+                       "  content_html = :content_html, "
+                       "  render_version = :render_version "
+                       f"WHERE {condition}")
+            db.session.execute(sql, [{'id'             : row[0],
+                                      'tstamp'         : row[1] if table == 'replies' else None,
+                                      'content_html'   : render(row[-1]),
+                                      'render_version' : RENDERER_VERSION}
+                                     for row in rows])
+
+            # Cached pages and search results of the batch have the old HTML
+            invalidate('content')
+            commit()
+
+            rendered += len(rows)
+            last_id = rows[-1][0]
+
+    # The re-rendered posts may be in any category's feed
+    if rendered:
+        db.session.execute(text("UPDATE categories SET content_version = content_version + 1"))
+        db.session.commit()
+
+    return rendered
+
+
+###############################################################################
+#                                   TRENDING                                  #
+###############################################################################
+
+# Each reply, like, and new thread adds to the thread's score a weight that
+# halves every TRENDING_HALF_LIFE_HOURS. Activity older than the window is ignored.
+TRENDING_WINDOW_DAYS     = 7
+TRENDING_HALF_LIFE_HOURS = 24
+TRENDING_POST_WEIGHT     = 1.0
+TRENDING_LIKE_WEIGHT     = 0.5
+
+
+def get_trending_scores_query() -> str:
+    """Return the query that scores the threads with recent activity."""
+    if IS_SQLITE:
+        age_hours = "(julianday('now', 'localtime') - julianday(activity.tstamp)) * 24"
+        window_start = f"datetime('now', 'localtime', '-{TRENDING_WINDOW_DAYS} days')"
+    else:
+        age_hours = "EXTRACT(EPOCH FROM LOCALTIMESTAMP - activity.tstamp) / 3600"
+        window_start = f"LOCALTIMESTAMP - INTERVAL '{TRENDING_WINDOW_DAYS} days'"
+
+    return ("SELECT "
+            "  threads.thread_id, "
+            "  threads.category_id, "
+            f" CAST(SUM(activity.weight * power(0.5, {age_hours} / {TRENDING_HALF_LIFE_HOURS})) "
+            "       AS DOUBLE PRECISION) AS score "
+            "FROM threads "
+            "  JOIN (SELECT threads.thread_id, "
+            "               threads.thread_tstamp AS tstamp, "
+            f"              {TRENDING_POST_WEIGHT} AS weight "
+            "        FROM threads "
+            f"       WHERE threads.thread_tstamp > {window_start} "
+            "        UNION ALL "
+            "        SELECT replies.thread_id, "
+            "               replies.reply_tstamp, "
+            f"              {TRENDING_POST_WEIGHT} "
+            "        FROM replies "
+            f"       WHERE replies.reply_tstamp > {window_start} "
+            "        UNION ALL "
+            "        SELECT replies.thread_id, "
+            "               likes.like_tstamp, "
+            f"              {TRENDING_LIKE_WEIGHT} "
+            "        FROM likes "
+            "          JOIN replies ON replies.reply_id = likes.reply_id "
+            "                          AND "
+            "                          replies.reply_tstamp = likes.reply_tstamp "
+            f"       WHERE likes.like_tstamp > {window_start}"
+            "       ) AS activity ON activity.thread_id = threads.thread_id "
+            "GROUP BY threads.thread_id")
+
+
+def create_trending_view() -> None:
+    """Create the materialized view of trending thread scores.
+
+    The scores are computed when the view is refreshed, not per request.
+    Changing the constants above requires dropping the view first. SQLite
+    has no materialized views, so a table that is refilled is used instead.
+    """
+    if IS_SQLITE:
+        sql = text("CREATE TABLE IF NOT EXISTS trending_threads ("
+                   "  thread_id INTEGER PRIMARY KEY, "
+                   "  category_id INTEGER NOT NULL, "
+                   "  score DOUBLE PRECISION NOT NULL)")
+        db.session.execute(sql)
+        db.session.commit()
+        refresh_trending()
+    else:
+        sql = text(f"CREATE MATERIALIZED VIEW IF NOT EXISTS trending_threads AS {get_trending_scores_query()}")
+        db.session.execute(sql)
+
+        # The unique index is required for refreshing the view concurrently
+        sql = text("CREATE UNIQUE INDEX IF NOT EXISTS trending_threads_thread_id_idx "
+                   "ON trending_threads (thread_id)")
+        db.session.execute(sql)
+
+    sql = text("CREATE INDEX IF NOT EXISTS trending_threads_score_idx "
+               "ON trending_threads (score DESC)")
+    db.session.execute(sql)
+    sql = text("CREATE INDEX IF NOT EXISTS trending_threads_category_id_score_idx "
+               "ON trending_threads (category_id, score DESC)")
+    db.session.execute(sql)
+    db.session.commit()
+
+
+def refresh_trending() -> None:
+    """Recompute the trending thread scores.
+
+    The view is refreshed concurrently, so reads aren't blocked meanwhile.
+    On SQLite the table is refilled in one transaction.
+    """
+    if IS_SQLITE:
+        db.session.execute(text("DELETE FROM trending_threads"))
+        db.session.execute(text(f"INSERT INTO trending_threads (thread_id, category_id, score) "
+                                f"{get_trending_scores_query()}"))
+    else:
+        db.session.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY trending_threads"))
     db.session.commit()
 
 
-def delete_like_from_db(user_id: int, reply_id: int) -> None:
-    """Remove like from the database."""
-    sql = text("DELETE "
-               "FROM likes "
-               "WHERE user_id=:user_id "
+def get_trending_threads(user_id     : int,
+                         category_id : int | None = None,
+                         limit       : int = TRENDING_LIMIT
+                         ) -> list[dict]:
+    """Get the top trending threads in a category, or forum-wide if category_id is None.
+
+    Threads in categories the user has no access to are left out.
+    """
+    category_condition = "trending_threads.category_id = :category_id AND " if category_id is not None else ""
+
+    sql = text("SELECT "
+               "  threads.thread_id, "
+               "  threads.category_id, "
+               "  categories.name AS category_name, "
+               "  users.username, "
+               "  threads.thread_tstamp AS created, "
+               "  threads.title, "
+               "  trending_threads.score "
+               "FROM trending_threads "
+               "  JOIN threads ON threads.thread_id = trending_threads.thread_id "
+               "  JOIN users ON users.user_id = threads.user_id "
+               "  JOIN categories ON categories.category_id = trending_threads.category_id "
+               f"WHERE {category_condition}"
+               f"     {PERMITTED_CATEGORY_CONDITION} "
+               "ORDER BY trending_threads.score DESC "
+               "LIMIT :limit")
+    threads = execute_read(sql, {'user_id'     : user_id,
+                                 'category_id' : category_id,
+                                 'limit'       : limit}).mappings().fetchall()
+    return [dict(thread) for thread in threads]
+
+
+###############################################################################
+#                                     JOBS                                    #
+###############################################################################
+
+def enqueue_job(job_type     : str,
+                payload      : dict | None = None,
+                delay        : float = 0.0,
+                max_attempts : int = JOB_MAX_ATTEMPTS
+                ) -> int:
+    """Queue a job for `manage.py worker` to run after `delay` seconds. Return job_id."""
+    sql = text("INSERT INTO jobs (job_type, payload, max_attempts, run_after) "
+               "VALUES (:job_type, :payload, :max_attempts, :run_after) "
+               "RETURNING job_id")
+    job_id = db.session.execute(sql, {'job_type'     : job_type,
+                                      'payload'      : json.dumps(payload or {}),
+                                      'max_attempts' : max_attempts,
+                                      'run_after'    : datetime.now() + timedelta(seconds=delay)}).scalar()
+    commit()
+    return job_id
+
+
+def enqueue_recurring_job(job_type : str,
+                          payload  : dict | None = None,
+                          delay    : float = 0.0
+                          ) -> int | None:
+    """Queue a recurring job unless the type is already scheduled. Return job_id, or None if it was.
+
+    A recurring job keeps a single row that is queued again after each run,
+    see reschedule_job(). The unique index on the recurring rows makes
+    workers that start at the same time agree on a single schedule.
+    """
+    sql = text("INSERT INTO jobs (job_type, payload, max_attempts, run_after, recurring) "
+               "VALUES (:job_type, :payload, :max_attempts, :run_after, TRUE) "
+               "ON CONFLICT (job_type) WHERE recurring DO NOTHING "
+               "RETURNING job_id")
+    job_id = db.session.execute(sql, {'job_type'     : job_type,
+                                      'payload'      : json.dumps(payload or {}),
+                                      'max_attempts' : JOB_MAX_ATTEMPTS,
+                                      'run_after'    : datetime.now() + timedelta(seconds=delay)}).scalar()
+    commit()
+    return job_id
+
+
+def claim_job(job_type      : str,
+              limit         : int | None,
+              lease_seconds : float
+              ) -> tuple[int, dict, int, int, bool] | None:
+    """Claim the next due job of the type as (job_id, payload, attempts, max_attempts, recurring), or return None.
+
+    The job is leased for `lease_seconds`. If its worker dies, the job is
+    claimed again once the lease has expired, unless it has run out of
+    attempts, in which case it's marked failed, or queued again with its
+    attempts reset if it's recurring. Concurrent workers skip the
+    rows locked by each other. With `limit` set, no job is claimed while
+    that many jobs of the type are running. On PostgreSQL the claims of
+    the type are serialized with an advisory lock for the count to hold,
+    on SQLite the single writer does the same.
+    """
+    now = datetime.now()
+    params = {'job_type'     : job_type,
+              'now'          : now,
+              'locked_until' : now + timedelta(seconds=lease_seconds),
+              'limit'        : limit}
+
+    if limit is not None and not IS_SQLITE:
+        sql = text("SELECT pg_advisory_xact_lock(hashtext('jobs'), hashtext(:job_type))")
+        db.session.execute(sql, params)
+
+    # A job that keeps losing its lease, e.g. by crashing its worker, isn't retried forever.
+    # Recurring jobs are never failed, as nothing would queue them again.
+    sql = text("UPDATE jobs "
+               "SET "
+               "  state = CASE WHEN recurring THEN 'queued' ELSE 'failed' END, "
+               "  attempts = CASE WHEN recurring THEN 0 ELSE attempts END, "
+               "  locked_until = NULL, "
+               "  last_error = 'Lease expired after the last attempt' "
+               "WHERE job_type = :job_type "
+               "      AND "
+               "      state = 'running' "
                "      AND "
-               "      reply_id=:reply_id")
-    db.session.execute(sql, {'user_id'  : user_id,
-                             'reply_id' : reply_id})
+               "      locked_until < :now "
+               "      AND "
+               "      attempts >= max_attempts")
+    db.session.execute(sql, params)
+
+    limit_condition = ("AND "
+                       "(SELECT COUNT(*) "
+                       " FROM jobs "
+                       " WHERE job_type = :job_type "
+                       "       AND "
+                       "       state = 'running' "
+                       "       AND "
+                       "       locked_until >= :now) < :limit ") if limit is not None else ""
+
+    sql = text("UPDATE jobs "
+               "SET "
+               "  state = 'running', "
+               "  attempts = attempts + 1, "
+               "  locked_until = :locked_until "
+               "WHERE job_id = (SELECT job_id "
+               "                FROM jobs "
+               "                WHERE job_type = :job_type "
+               "                      AND "
+               "                      (state = 'queued' AND run_after <= :now "
+               "                       OR "
+               "                       state = 'running' AND locked_until < :now AND attempts < max_attempts) "
+               "                ORDER BY run_after, job_id "
+               "                LIMIT 1"
+               f"               {'' if IS_SQLITE else 'FOR UPDATE SKIP LOCKED'}) "
+               f"{limit_condition}"
+               "RETURNING job_id, payload, attempts, max_attempts, recurring")
+    job = db.session.execute(sql, params).fetchone()
     db.session.commit()
 
+    if job is None:
+        return None
+    return job.job_id, json.loads(job.payload), job.attempts, job.max_attempts, bool(job.recurring)
 
-def user_has_liked_reply(user_id: int, reply_id: int) -> bool:
-    """Check if user has liked a reply."""
-    sql = text("SELECT COUNT(*) "
-               "FROM likes "
-               "WHERE user_id=:user_id "
+
+def renew_job_lease(job_id: int, lease_seconds: float) -> bool:
+    """Extend the lease of a running job by `lease_seconds` from now. Return False if the job isn't running."""
+    sql = text("UPDATE jobs "
+               "SET locked_until = :locked_until "
+               "WHERE job_id = :job_id "
                "      AND "
-               "      reply_id=:reply_id")
-    likes_data = db.session.execute(sql, {'user_id'  : user_id,
-                                          'reply_id' : reply_id}).fetchone()
-    return bool(likes_data[0])
+               "      state = 'running' "
+               "RETURNING job_id")
+    renewed = db.session.execute(sql, {'job_id'       : job_id,
+                                       'locked_until' : datetime.now() + timedelta(seconds=lease_seconds)}).fetchone()
+    db.session.commit()
+    return renewed is not None
 
 
-def get_likes_by_reply_id(reply_id: int) -> dict[int, Like]:
-    """Return likes for reply as {like_id : Like} dictionary."""
-    sql = text("SELECT like_id, user_id "
+def finish_job(job_id: int) -> None:
+    """Remove a successfully run job from the queue."""
+    sql = text("DELETE "
+               "FROM jobs "
+               "WHERE job_id = :job_id")
+    db.session.execute(sql, {'job_id': job_id})
+    db.session.commit()
+
+
+def fail_job(job_id: int, error: str, retry_delay: float | None) -> None:
+    """Record the error of a job and retry it after `retry_delay` seconds, or mark it failed if the delay is None."""
+    sql = text("UPDATE jobs "
+               "SET "
+               "  state = :state, "
+               "  run_after = :run_after, "
+               "  locked_until = NULL, "
+               "  last_error = :error "
+               "WHERE job_id = :job_id")
+    db.session.execute(sql, {'job_id'    : job_id,
+                             'state'     : 'failed' if retry_delay is None else 'queued',
+                             'run_after' : datetime.now() + timedelta(seconds=retry_delay or 0),
+                             'error'     : error})
+    db.session.commit()
+
+
+def reschedule_job(job_id: int, delay: float, error: str | None = None) -> None:
+    """Queue the next run of a recurring job after `delay` seconds with its attempts reset."""
+    sql = text("UPDATE jobs "
+               "SET "
+               "  state = 'queued', "
+               "  attempts = 0, "
+               "  run_after = :run_after, "
+               "  locked_until = NULL, "
+               "  last_error = :error "
+               "WHERE job_id = :job_id")
+    db.session.execute(sql, {'job_id'    : job_id,
+                             'run_after' : datetime.now() + timedelta(seconds=delay),
+                             'error'     : error})
+    db.session.commit()
+
+
+def get_job_counts() -> dict[str, dict[str, int]]:
+    """Return the number of jobs in the queue as {job_type: {state: count}}."""
+    sql = text("SELECT job_type, state, COUNT(*) "
+               "FROM jobs "
+               "GROUP BY job_type, state")
+    counts : dict[str, dict[str, int]] = dict()
+    for job_type, state, count in db.session.execute(sql):
+        counts.setdefault(job_type, dict())[state] = count
+    return counts
+
+
+def delete_category_with_content(category_id: int) -> None:
+    """Delete category with its threads, replies, likes and permissions in one transaction."""
+    sql = text("DELETE "
                "FROM likes "
-               "WHERE reply_id = :reply_id")
-    likes_data = db.session.execute(sql, {'reply_id': reply_id}).fetchall()
-    return {like_id: Like(like_id, user_id, reply_id) for like_id, user_id in likes_data}
+               "WHERE reply_id IN (SELECT replies.reply_id "
+               "                   FROM replies "
+               "                     JOIN threads ON threads.thread_id = replies.thread_id "
+               "                   WHERE threads.category_id = :category_id)")
+    db.session.execute(sql, {'category_id': category_id})
+
+    sql = text("DELETE "
+               "FROM replies "
+               "WHERE thread_id IN (SELECT thread_id "
+               "                    FROM threads "
+               "                    WHERE category_id = :category_id)")
+    db.session.execute(sql, {'category_id': category_id})
+
+    sql = text("DELETE "
+               "FROM thread_reads "
+               "WHERE thread_id IN (SELECT thread_id "
+               "                    FROM threads "
+               "                    WHERE category_id = :category_id)")
+    db.session.execute(sql, {'category_id': category_id})
+
+    for table in ['threads', 'permissions', 'group_permissions', 'categories']:
+        sql = text("DELETE "
+                   f"FROM {table} "
+                   "WHERE category_id = :category_id")
+        db.session.execute(sql, {'category_id': category_id})
+
+    invalidate('content')
+    invalidate('threads')
+    invalidate('titles')
+    invalidate(f'categories:{category_id}')
+    invalidate(f'permissions:{category_id}')
+    commit()
+
+
+def repair_like_counts() -> int:
+    """Recount the cached like counts of replies from the likes. Return the number of repaired replies."""
+    sql = text("UPDATE replies "
+               "SET like_count = (SELECT COUNT(*) "
+               "                  FROM likes "
+               "                  WHERE likes.reply_id = replies.reply_id) "
+               "WHERE like_count <> (SELECT COUNT(*) "
+               "                     FROM likes "
+               "                     WHERE likes.reply_id = replies.reply_id)")
+    repaired = db.session.execute(sql).rowcount
+    db.session.commit()
+    return repaired
+
+
+###############################################################################
+#                                 SUGGESTIONS                                 #
+###############################################################################
+
+_has_trigram_index : bool | None = None
+
+
+def create_title_index() -> None:
+    """Create the trigram index of thread titles if the pg_trgm extension is available.
+
+    Without it, title suggestions fall back to an in-process trie.
+    """
+    global _has_trigram_index
+
+    if IS_SQLITE:
+        return
+
+    try:
+        db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+
+        # A GiST index returns the nearest titles in order, which a GIN index can't,
+        # so the GIN index of earlier versions is replaced
+        sql = text("CREATE INDEX IF NOT EXISTS threads_title_trgm_gist_idx "
+                   "ON threads USING gist (title gist_trgm_ops)")
+        db.session.execute(sql)
+        db.session.execute(text("DROP INDEX IF EXISTS threads_title_trgm_idx"))
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+
+    _has_trigram_index = None
+
+
+def has_trigram_index() -> bool:
+    """Return True if thread titles have a trigram index. The result is cached per process."""
+    global _has_trigram_index
+
+    if _has_trigram_index is None:
+        if IS_SQLITE:
+            _has_trigram_index = False
+        else:
+            sql = text("SELECT EXISTS (SELECT 1 "
+                       "               FROM pg_indexes "
+                       "               WHERE indexname = 'threads_title_trgm_gist_idx')")
+            _has_trigram_index = db.session.execute(sql).scalar()
+    return _has_trigram_index
+
+
+def suggest_titles(query: str, user_id: int, limit: int) -> list[dict]:
+    """Return up to `limit` threads the user has access to whose title matches the query, best first.
+
+    With pg_trgm the titles nearest to the query by word similarity are read
+    in order from the trigram index, and a query that exceeds SUGGEST_TIMEOUT_MS returns no
+    suggestions. Otherwise they're looked up from the title trie.
+    """
+    if has_trigram_index():
+        return suggest_titles_by_trigram(query, user_id, limit)
+    return suggest_titles_by_trie(query, user_id, limit)
+
+
+def suggest_titles_by_trigram(query: str, user_id: int, limit: int) -> list[dict]:
+    """Return title suggestions ranked by trigram word similarity.
+
+    The index scan stops after `limit` permitted titles, instead of ranking every title that matches.
+    """
+    sql = text("SELECT current_setting('statement_timeout'), "
+               "       set_config('statement_timeout', :timeout, true)")
+    previous_timeout, _ = db.session.execute(sql, {'timeout': f'{SUGGEST_TIMEOUT_MS}ms'}).fetchone()
+
+    sql = text("SELECT "
+               "  threads.thread_id, "
+               "  threads.title, "
+               "  threads.category_id, "
+               "  categories.name AS category_name "
+               "FROM threads "
+               "  JOIN categories ON categories.category_id = threads.category_id "
+               "WHERE :query <% threads.title "
+               "      AND "
+               f"     {PERMITTED_CATEGORY_CONDITION} "
+               "ORDER BY :query <<-> threads.title, threads.thread_id DESC "
+               "LIMIT :limit")
+    try:
+        suggestions = db.session.execute(sql, {'query'   : query,
+                                               'user_id' : user_id,
+                                               'limit'   : limit}).mappings().fetchall()
+    except OperationalError:
+        # Cancelled by the statement timeout
+        db.session.rollback()
+        return []
+
+    sql = text("SELECT set_config('statement_timeout', :timeout, true)")
+    db.session.execute(sql, {'timeout': previous_timeout})
+    return [dict(suggestion) for suggestion in suggestions]
+
+
+def get_titles_for_trie() -> list[tuple[int, str, int, str]]:
+    """Return the (thread_id, title, category_id, category_name) tuples of all threads."""
+    sql = text("SELECT threads.thread_id, threads.title, threads.category_id, categories.name "
+               "FROM threads "
+               "  JOIN categories ON categories.category_id = threads.category_id")
+    return [tuple(row) for row in execute(sql).fetchall()]  # type: ignore
+
+
+def rebuild_title_trie(generation: int) -> None:
+    """Rebuild the title trie in a background thread."""
+    with app.app_context():
+        try:
+            title_trie.build(get_titles_for_trie(), generation)
+        except SQLAlchemyError:
+            logging.exception("Rebuilding the title trie failed")
+        finally:
+            title_trie.end_rebuild()
+
+
+def suggest_titles_by_trie(query: str, user_id: int, limit: int) -> list[dict]:
+    """Return title suggestions from the title trie.
+
+    The trie is built on the first suggestion. After titles have changed,
+    it's rebuilt in a background thread, and the previous trie keeps
+    serving suggestions until the new one is ready.
+    """
+    check_cache_generations()
+
+    generation = title_generation.value
+    if title_trie.generation is None:
+        title_trie.build(get_titles_for_trie(), generation)
+
+    elif title_trie.generation != generation and title_trie.begin_rebuild():
+        threading.Thread(target=rebuild_title_trie, args=(generation,), daemon=True).start()
+
+    permitted : dict[int, bool] = dict()
+    suggestions = []
+
+    for thread_id, title, category_id, category_name in title_trie.search(query):
+        if category_id not in permitted:
+            permitted[category_id] = user_has_permission_to_category(category_id, user_id)
+
+        if permitted[category_id]:
+            suggestions.append({'thread_id'     : thread_id,
+                                'title'         : title,
+                                'category_id'   : category_id,
+                                'category_name' : category_name})
+            if len(suggestions) == limit:
+                break
+
+    return suggestions
+
+
+###############################################################################
+#                                    FEEDS                                    #
+###############################################################################
+
+def get_feed_version(category_id: int | None) -> tuple[int, ...] | None:
+    """Get the content version of a category's feed, or of the forum-wide feed if category_id is None.
+
+    The version changes whenever a post in the feed changes. Returns
+    None if the category doesn't exist or is restricted, as feeds are public.
+    """
+    if category_id is not None:
+        sql = text("SELECT content_version "
+                   "FROM categories "
+                   "WHERE category_id = :category_id "
+                   "      AND "
+                   "      categories.restricted IS NOT TRUE")
+        version = execute_read(sql, {'category_id': category_id}).fetchone()
+        return tuple(version) if version is not None else None
+
+    # The category count and largest id change when a category is deleted or created
+    sql = text("SELECT "
+               "  COALESCE(SUM(content_version), 0), "
+               "  COUNT(*), "
+               "  COALESCE(MAX(category_id), 0) "
+               "FROM categories "
+               "WHERE categories.restricted IS NOT TRUE")
+    return tuple(execute_read(sql).fetchone())
+
+
+def get_feed_entries(category_id: int | None, limit: int) -> list[FeedEntry]:
+    """Get the newest threads and replies of an unrestricted category, or of all of them.
+
+    The newest threads and the newest replies are both limited before
+    they are merged, so that each is a backward scan of a timestamp index:
+    threads_category_id_thread_tstamp_idx or threads_thread_tstamp_idx for
+    the threads, and replies_reply_tstamp_idx for the replies.
+    """
+    condition = "categories.restricted IS NOT TRUE"
+    if category_id is not None:
+        condition += " AND threads.category_id = :category_id"
+
+    sql = text("SELECT * "
+               "FROM (SELECT * "
+               "      FROM (SELECT "
+               "              threads.thread_id, "
+               "              CAST(NULL AS INTEGER) AS reply_id, "
+               "              categories.category_id, "
+               "              categories.name, "
+               "              users.username, "
+               "              threads.title, "
+               "              threads.thread_tstamp AS published, "
+               "              threads.content, "
+               "              threads.content_html "
+               "            FROM threads "
+               "              JOIN users ON users.user_id = threads.user_id "
+               "              JOIN categories ON categories.category_id = threads.category_id "
+               f"           WHERE {condition} "
+               "            ORDER BY threads.thread_tstamp DESC "
+               "            LIMIT :limit) AS new_threads "
+               "      UNION ALL "
+               "      SELECT * "
+               "      FROM (SELECT "
+               "              replies.thread_id, "
+               "              replies.reply_id, "
+               "              categories.category_id, "
+               "              categories.name, "
+               "              users.username, "
+               "              threads.title, "
+               "              replies.reply_tstamp AS published, "
+               "              replies.content, "
+               "              replies.content_html "
+               "            FROM replies "
+               "              JOIN threads ON threads.thread_id = replies.thread_id "
+               "              JOIN users ON users.user_id = replies.user_id "
+               "              JOIN categories ON categories.category_id = threads.category_id "
+               f"           WHERE {condition} "
+               "            ORDER BY replies.reply_tstamp DESC "
+               "            LIMIT :limit) AS new_replies"
+               "     ) AS entries "
+               "ORDER BY published DESC "
+               "LIMIT :limit")
+    rows = execute_read(sql, {'category_id' : category_id,
+                              'limit'       : limit}).fetchall()
+    return [FeedEntry(*row) for row in rows]
 
 
 ###############################################################################
 #                                    OTHER                                    #
 ###############################################################################
 
-def search_from_db(query: str) -> list[int]:
-    """Get list of thread ids from database that match a search term."""
+def search_from_db(query: str) -> tuple[int, ...]:
+    """Get tuple of thread ids from database that match a search term.
 
-    # Search threads (title and content of OP's message)
+    Threads match by the title and content of OP's message, or by the content of any reply.
+    The results are cached per query until threads or replies are modified. They're not
+    filtered by permission, so that the cached results can be shared by all users, and
+    they're immutable, so that a caller can't modify the shared results.
+    """
     sql = text("SELECT threads.thread_id "
-               "FROM threads, replies "
+               "FROM threads "
                "WHERE threads.title LIKE :query "
                "      OR "
-               "      threads.content LIKE :query")
-    thread_ids = [t[0] for t in db.session.execute(sql, {'query': f'%{query}%'}).fetchall()]
-
-    # Search content of replies
-    sql = text("SELECT threads.thread_id "
-               "FROM threads, replies "
-               "WHERE replies.content LIKE :query "
+               "      threads.content LIKE :query "
+               "UNION "
+               "SELECT replies.thread_id "
+               "FROM replies "
+               "WHERE replies.content LIKE :query")
+    return cached_read(search_cache, content_generation, query,
+                       lambda: tuple(t[0] for t in execute_read(sql, {'query': f'%{query}%'}).fetchall()))
+
+
+def get_search_results(thread_ids : tuple[int, ...],
+                       user_id    : int,
+                       query      : str,
+                       page       : int = 1,
+                       page_size  : int = SEARCH_PAGE_SIZE
+                       ) -> tuple[list[SearchResult], int]:
+    """Hydrate matched threads into SearchResult objects.
+
+    Only threads in categories the user has access to are returned. The
+    snippet source is OP's message if it matches the query, otherwise the
+    oldest matching reply. Returns the requested page of results and the
+    total number of permitted results.
+    """
+    sql = text("SELECT "
+               "  threads.thread_id, "
+               "  threads.category_id, "
+               "  categories.name, "
+               "  users.username, "
+               "  threads.thread_tstamp, "
+               "  threads.title, "
+               "  COALESCE((SELECT MAX(replies.reply_tstamp) "
+               "            FROM replies "
+               "            WHERE replies.thread_id = threads.thread_id), "
+               "           threads.thread_tstamp) AS most_recent_post, "
+               "  CASE WHEN threads.content LIKE :query THEN threads.content "
+               "       ELSE COALESCE((SELECT replies.content "
+               "                      FROM replies "
+               "                      WHERE replies.thread_id = threads.thread_id "
+               "                            AND "
+               "                            replies.content LIKE :query "
+               "                      ORDER BY replies.reply_tstamp "
+               "                      LIMIT 1), "
+               "                     threads.content) "
+               "  END, "
+               "  COUNT(*) OVER () "
+               "FROM threads "
+               "  JOIN users ON users.user_id = threads.user_id "
+               "  JOIN categories ON categories.category_id = threads.category_id "
+               "WHERE threads.thread_id IN :thread_ids "
                "      AND "
-               "      replies.thread_id = threads.thread_id")
-    thread_ids += [t[0] for t in db.session.execute(sql, {'query': f'%{query}%'}).fetchall()]
-
-    return list(set(thread_ids))
+               f"     {PERMITTED_CATEGORY_CONDITION} "
+               "ORDER BY threads.thread_tstamp DESC "
+               "LIMIT :limit OFFSET :offset"
+               ).bindparams(bindparam('thread_ids', expanding=True)).columns(most_recent_post=DateTime)
+    results_data = execute_read(sql, {'thread_ids' : thread_ids,
+                                            'user_id'    : user_id,
+                                            'query'      : f'%{query}%',
+                                            'limit'      : page_size,
+                                            'offset'     : (page - 1) * page_size}).fetchall()
+
+    total_results = results_data[0][-1] if results_data else 0
+    return [SearchResult(*result_data[:-1]) for result_data in results_data], total_results
 
 
 def get_forum_category_dict() -> dict[int, Category]:
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import io
+
+from typing import Any, BinaryIO, Iterable
+
+import orjson
+
+from sqlalchemy import text
+
+from src.db import db, create_tables, fill_last_reply_ids, refresh_trending, IS_SQLITE
+
+# Tables in an order in which foreign keys only refer to earlier tables
+DUMP_TABLES = ['users', 'categories', 'permissions', 'user_groups', 'group_members', 'group_permissions',
+               'threads', 'replies', 'likes', 'thread_reads']
+
+DUMP_BATCH_SIZE = 50_000
+
+
+###############################################################################
+#                                    EXPORT                                   #
+###############################################################################
+
+def get_columns(cursor: Any, table: str) -> list[str]:
+    """Return the column names of a table in their physical order."""
+    if IS_SQLITE:
+        cursor.execute(f"SELECT name FROM pragma_table_info('{table}') ORDER BY cid")
+        return [column for column, in cursor.fetchall()]
+
+    cursor.execute("SELECT column_name "
+                   "FROM information_schema.columns "
+                   "WHERE table_schema = current_schema() "
+                   "      AND "
+                   "      table_name = %s "
+                   "ORDER BY ordinal_position", (table,))
+    return [column for column, in cursor.fetchall()]
+
+
+def export_forum(output: BinaryIO, batch_size: int = DUMP_BATCH_SIZE) -> dict[str, int]:
+    """Write the whole forum to output as NDJSON.
+
+    Each table starts with a header line {"table": ..., "columns": [...]},
+    followed by one JSON array per row. Rows are read through server-side
+    cursors `batch_size` rows at a time, so memory use doesn't depend on
+    the size of the forum. All tables are read from the same snapshot.
+    Returns the number of rows exported per table. An SQLite database can
+    be exported too, e.g. to move the forum into PostgreSQL.
+    """
+    connection = db.engine.raw_connection()
+    counts = dict()
+
+    try:
+        cursor = connection.cursor()
+        cursor.execute("BEGIN" if IS_SQLITE else "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+
+        for table in DUMP_TABLES:
+            columns = get_columns(cursor, table)
+            output.write(orjson.dumps({'table': table, 'columns': columns}) + b'\n')
+
+            # SQLite cursors fetch rows lazily by themselves
+            rows = connection.cursor() if IS_SQLITE else connection.cursor(name=f'export_{table}')
+            rows.arraysize = batch_size
+            rows.execute(f"SELECT {', '.join(columns)} FROM {table}")
+
+            counts[table] = 0
+            while batch := rows.fetchmany(batch_size):
+                output.write(b''.join(orjson.dumps(row) + b'\n' for row in batch))
+                counts[table] += len(batch)
+            rows.close()
+
+        connection.rollback()
+    finally:
+        connection.close()
+
+    return counts
+
+
+###############################################################################
+#                                    IMPORT                                   #
+###############################################################################
+
+def csv_value(value: Any) -> str:
+    """Return value as a field of PostgreSQL's CSV format, where an unquoted empty field is NULL."""
+    if value is None:
+        return ''
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, (int, float)):
+        return str(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def copy_rows(cursor  : Any,
+              table   : str,
+              columns : list[str],
+              rows    : list[list[Any]]
+              ) -> None:
+    """Bulk load rows into table with COPY."""
+    data = io.StringIO(''.join(','.join(map(csv_value, row)) + '\n' for row in rows))
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", data)
+
+
+def create_like_staging_table(cursor: Any) -> None:
+    """Create the temporary table that likes from a dump without likes.reply_tstamp are loaded into."""
+    cursor.execute("CREATE TEMPORARY TABLE likes_import ("
+                   "  reply_id INTEGER NOT NULL, "
+                   "  user_id INTEGER NOT NULL, "
+                   "  like_tstamp TIMESTAMP)")
+
+
+def insert_staged_likes(cursor: Any) -> None:
+    """Insert the staged likes with the timestamp of the liked reply, and drop the staging table.
+
+    Dumps made before likes were partitioned lack likes.reply_tstamp, which
+    partitioned likes are routed by. The likes are joined to the replies
+    once all of them are loaded, so the replies are read only once. Likes
+    without a time get the time of the reply, as in migrate_likes_like_tstamp().
+    """
+    cursor.execute("INSERT INTO likes (reply_id, user_id, reply_tstamp, like_tstamp) "
+                   "SELECT "
+                   "  likes_import.reply_id, "
+                   "  likes_import.user_id, "
+                   "  replies.reply_tstamp, "
+                   "  COALESCE(likes_import.like_tstamp, replies.reply_tstamp) "
+                   "FROM likes_import "
+                   "  JOIN replies ON replies.reply_id = likes_import.reply_id")
+    cursor.execute("DROP TABLE likes_import")
+
+
+def drop_foreign_keys_and_indexes(cursor: Any) -> list[str]:
+    """Drop the foreign keys and secondary indexes of the dumped tables.
+
+    Checking and indexing millions of rows one by one is much slower than
+    doing it once after loading. Returns the statements that restore the
+    foreign keys. The indexes are restored by create_tables().
+    """
+    cursor.execute("SELECT "
+                   "  pg_class.relname, "
+                   "  pg_constraint.conname, "
+                   "  pg_get_constraintdef(pg_constraint.oid) "
+                   "FROM pg_constraint "
+                   "  JOIN pg_class ON pg_class.oid = pg_constraint.conrelid "
+                   "WHERE pg_constraint.contype = 'f' "
+                   "      AND "
+                   "      pg_constraint.conparentid = 0 "
+                   "      AND "
+                   "      pg_class.relname = ANY(%s)", (DUMP_TABLES,))
+    foreign_keys = cursor.fetchall()
+
+    cursor.execute("SELECT index_class.relname "
+                   "FROM pg_index "
+                   "  JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid "
+                   "  JOIN pg_class AS table_class ON table_class.oid = pg_index.indrelid "
+                   "WHERE NOT pg_index.indisunique "
+                   "      AND "
+                   "      table_class.relname = ANY(%s) "
+                   "      AND "
+                   "      NOT index_class.relispartition", (DUMP_TABLES,))
+    indexes = [index for index, in cursor.fetchall()]
+
+    for table, constraint, _ in foreign_keys:
+        cursor.execute(f"ALTER TABLE {table} DROP CONSTRAINT {constraint}")
+    for index in indexes:
+        cursor.execute(f"DROP INDEX {index}")
+
+    return [f"ALTER TABLE {table} ADD CONSTRAINT {constraint} {definition}"
+            for table, constraint, definition in foreign_keys]
+
+
+def import_forum(lines: Iterable[bytes], batch_size: int = DUMP_BATCH_SIZE) -> dict[str, int]:
+    """Load a forum exported with export_forum() into an empty database.
+
+    Rows are loaded with COPY, and each batch of `batch_size` rows is
+    committed in its own transaction. Foreign keys and secondary indexes
+    are dropped for the duration of the load, so if it fails, the import
+    should be restarted from a new empty database. Columns the database
+    doesn't have are skipped, so older and newer dumps can be imported.
+    Likes of a dump without likes.reply_tstamp are staged and get the
+    timestamp of their reply. Finally the SERIAL sequences are moved past
+    the imported ids. Returns the number of rows imported per table.
+    """
+    if IS_SQLITE:
+        raise ValueError("Importing requires PostgreSQL.")
+
+    create_tables()
+
+    connection = db.engine.raw_connection()
+    counts : dict[str, int] = dict()
+
+    try:
+        cursor = connection.cursor()
+
+        for table in DUMP_TABLES:
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table})")
+            if cursor.fetchone()[0]:
+                raise ValueError(f"Table {table} is not empty, import requires an empty database.")
+
+        foreign_keys = drop_foreign_keys_and_indexes(cursor)
+        connection.commit()
+
+        table, columns, indexes, batch = None, [], [], []
+        staging_likes = staged_likes = False
+
+        def flush() -> None:
+            if batch:
+                # A failed batch is rolled back, and the dump can be imported again into an empty database
+                cursor.execute("SET LOCAL synchronous_commit = off")
+                copy_rows(cursor, 'likes_import' if staging_likes else table, [columns[i] for i in indexes], batch)
+                connection.commit()
+                counts[table] += len(batch)
+                batch.clear()
+
+        for line in lines:
+            if line.startswith(b'{'):
+                flush()
+                header = orjson.loads(line)
+                table, columns = header['table'], header['columns']
+
+                if table not in DUMP_TABLES:
+                    raise ValueError(f"Unknown table {table} in dump.")
+
+                existing = set(get_columns(cursor, table))
+                indexes = [i for i, column in enumerate(columns) if column in existing]
+                counts[table] = 0
+
+                staging_likes = table == 'likes' and 'reply_tstamp' not in columns
+                if staging_likes:
+                    create_like_staging_table(cursor)
+                    staged_likes = True
+
+            elif line.strip():
+                row = orjson.loads(line)
+                batch.append([row[i] for i in indexes])
+                if len(batch) >= batch_size:
+                    flush()
+        flush()
+
+        if staged_likes:
+            insert_staged_likes(cursor)
+            connection.commit()
+
+        for sql in foreign_keys:
+            cursor.execute(sql)
+
+        for table in counts:
+            for column in get_columns(cursor, table):
+                cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", (table, column))
+                sequence = cursor.fetchone()[0]
+                if sequence is not None:
+                    cursor.execute(f"SELECT setval(%s, COALESCE(MAX({column}), 0) + 1, false) FROM {table}",
+                                   (sequence,))
+        connection.commit()
+    finally:
+        connection.close()
+
+    create_tables()
+    fill_last_reply_ids()
+    if counts:
+        db.session.execute(text(f"ANALYZE {', '.join(counts)}"))
+        db.session.commit()
+    refresh_trending()
+
+    return counts
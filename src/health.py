@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import logging
+import sqlite3
+import threading
+import time
+
+from typing import Any
+
+from sqlalchemy        import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc    import DBAPIError, SQLAlchemyError
+
+# SQLSTATE prefixes of lost connections (08xxx) and of the server shutting down (57P0x)
+CONNECTION_FAILURE_SQLSTATES = ('08', '57P0')
+
+# SQLite errors that mean the database file can't be used at all
+CONNECTION_FAILURE_SQLITE_CODES = {sqlite3.SQLITE_CANTOPEN, sqlite3.SQLITE_IOERR, sqlite3.SQLITE_NOTADB}
+
+
+def is_connection_failure(error: SQLAlchemyError) -> bool:
+    """Return True if the error means the database is unreachable.
+
+    Statement and lock timeouts, serialization failures and other errors
+    of a single statement return False, as the database itself is fine.
+    """
+    if not isinstance(error, DBAPIError):
+        return False
+
+    if error.connection_invalidated:
+        return True
+
+    if isinstance(error.orig, sqlite3.Error):
+        return getattr(error.orig, 'sqlite_errorcode', None) in CONNECTION_FAILURE_SQLITE_CODES
+
+    # The driver raises errors without a SQLSTATE when it can't reach the server at all
+    sqlstate = getattr(error.orig, 'pgcode', None)
+    return sqlstate is None or sqlstate.startswith(CONNECTION_FAILURE_SQLSTATES)
+
+
+class HealthMonitor:
+
+    def __init__(self,
+                 engine            : Engine,
+                 check_seconds     : float,
+                 failure_threshold : int,
+                 max_latency       : float,
+                 forced            : bool
+                 ) -> None:
+        """Create new HealthMonitor object.
+
+        The primary database is checked every `check_seconds` with a
+        trivial query. A check that fails or takes longer than
+        `max_latency` seconds is a failure, and so is a request that
+        loses its connection to the database. After `failure_threshold` consecutive
+        failures the forum is read-only: cached pages are served and
+        writes are rejected, until a check succeeds again. A page
+        missing from the cache that is loaded from the database also
+        ends it, unless the latest failure was a slow check, as a slow
+        database still answers queries. With
+        `forced`, the forum is read-only regardless of the checks,
+        e.g. during maintenance.
+        """
+        self.engine = engine
+        self.check_seconds = check_seconds
+        self.failure_threshold = failure_threshold
+        self.max_latency = max_latency
+        self.forced = forced
+        self.failures = 0
+        self.slow = False
+        self.checks = 0
+        self.latency = 0.0
+        self.degraded_since : float | None = None
+        self.checker : threading.Thread | None = None
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"  HealthMonitor ({'read-only' if self.read_only else 'read-write'}, {self.failures} failures)"
+
+    @property
+    def read_only(self) -> bool:
+        """Return True if writes should be rejected."""
+        return self.forced or self.degraded_since is not None
+
+    def start(self) -> None:
+        """Start the checks if they aren't running.
+
+        The checker is started lazily so that it runs in the worker process.
+        """
+        with self.lock:
+            if self.checker is None or not self.checker.is_alive():
+                self.checker = threading.Thread(target=self.run, daemon=True)
+                self.checker.start()
+
+    def check(self) -> bool:
+        """Check the database once. Return True if it's healthy."""
+        start = time.monotonic()
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        except SQLAlchemyError:
+            self.record_failure()
+            return False
+
+        with self.lock:
+            self.checks += 1
+            self.latency = time.monotonic() - start
+
+        if self.latency > self.max_latency:
+            self.record_failure(slow=True)
+            return False
+
+        self.record_success()
+        return True
+
+    def record_failure(self, slow: bool = False) -> None:
+        """Count a failed or slow check, or a failed request, and switch to read-only mode at the threshold."""
+        with self.lock:
+            self.failures += 1
+            self.slow = slow
+            if self.failures >= self.failure_threshold and self.degraded_since is None:
+                self.degraded_since = time.time()
+                logging.warning("Database is unhealthy, switching to read-only mode")
+
+    def record_error(self, error: SQLAlchemyError) -> None:
+        """Count the error of a request as a failure if it's a connection failure."""
+        if is_connection_failure(error):
+            self.record_failure()
+
+    def record_success(self) -> None:
+        """Reset the failures after a successful check, and leave read-only mode."""
+        with self.lock:
+            self.reset()
+
+    def record_page_load(self) -> None:
+        """Reset the failures after a page load, unless the latest failure was a slow check."""
+        with self.lock:
+            if not self.slow:
+                self.reset()
+
+    def reset(self) -> None:
+        """Reset the failures and leave read-only mode. The lock must be held."""
+        self.failures = 0
+        self.slow = False
+        if self.degraded_since is not None:
+            self.degraded_since = None
+            logging.warning("Database has recovered, leaving read-only mode")
+
+    def run(self) -> None:
+        """Check the database periodically."""
+        while True:
+            self.check()
+            time.sleep(self.check_seconds)
+
+    def stats(self) -> dict[str, Any]:
+        """Return health statistics."""
+        with self.lock:
+            return {'read_only'      : self.read_only,
+                    'forced'         : self.forced,
+                    'failures'       : self.failures,
+                    'checks'         : self.checks,
+                    'latency_ms'     : round(self.latency * 1000, 1),
+                    'degraded_since' : self.degraded_since}
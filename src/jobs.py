@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import logging
+import os
+import random
+import threading
+import time
+
+from typing import Any, Callable
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from app            import app
+from src.db         import (db, claim_job, renew_job_lease, finish_job, fail_job, reschedule_job,
+                            delete_category_with_content, refresh_trending, repair_like_counts,
+                            rerender_stale_content)
+from src.partitions import PARTITION_MONTHS_AHEAD, create_partitions
+
+JOB_LEASE_SECONDS      = float(os.getenv('JOB_LEASE_SECONDS', 600))
+JOB_RENEW_SECONDS      = float(os.getenv('JOB_RENEW_SECONDS', JOB_LEASE_SECONDS / 3))
+JOB_POLL_SECONDS       = float(os.getenv('JOB_POLL_SECONDS', 1))
+JOB_RETRY_BASE_SECONDS = float(os.getenv('JOB_RETRY_BASE_SECONDS', 10))
+JOB_RETRY_MAX_SECONDS  = float(os.getenv('JOB_RETRY_MAX_SECONDS', 3600))
+JOB_ERROR_MAX_SECONDS  = float(os.getenv('JOB_ERROR_MAX_SECONDS', 60))
+
+# Partitions are created months ahead, so a daily check leaves plenty of time to notice failures
+PARTITION_CHECK_SECONDS = float(os.getenv('PARTITION_CHECK_SECONDS', 24 * 60 * 60))
+
+
+def delete_category(payload: dict) -> None:
+    """Delete category with its content."""
+    delete_category_with_content(payload['category_id'])
+
+
+def refresh_trending_threads(_: dict) -> None:
+    """Recompute trending thread scores."""
+    refresh_trending()
+
+
+def repair_likes(_: dict) -> None:
+    """Recount the like counts of replies."""
+    repaired = repair_like_counts()
+    if repaired:
+        logging.warning(f"Repaired the like counts of {repaired} replies")
+
+
+def rerender(payload: dict) -> None:
+    """Re-render posts rendered by an older renderer version."""
+    rerender_stale_content(payload.get('batch_size', 1000))
+
+
+def create_monthly_partitions(payload: dict) -> None:
+    """Create the partitions of the coming months."""
+    created = create_partitions(payload.get('months_ahead', PARTITION_MONTHS_AHEAD))
+    if created:
+        logging.info(f"Created partitions {', '.join(created)}")
+
+
+# Job type -> (handler, default number of jobs of the type that may run at once in all workers).
+# Handlers must be idempotent, as a job whose worker dies mid-job is run again.
+JOB_TYPES : dict[str, tuple[Callable[[dict], Any], int | None]] = {
+    'delete_category'    : (delete_category,           1),
+    'refresh_trending'   : (refresh_trending_threads,  1),
+    'repair_like_counts' : (repair_likes,              1),
+    'rerender'           : (rerender,                  1),
+    'create_partitions'  : (create_monthly_partitions, 1)}
+
+# Recurring job type -> seconds between runs. A worker schedules them on startup if they aren't
+# scheduled yet, and queues the next run after each run, also after the last failed attempt.
+RECURRING_JOB_TYPES : dict[str, float] = {
+    'create_partitions' : PARTITION_CHECK_SECONDS}
+
+
+def retry_delay(attempts: int) -> float:
+    """Return the exponential backoff with jitter before retrying a job that has failed `attempts` times."""
+    return min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+
+class JobWorker:
+
+    def __init__(self, threads: int, limits: dict[str, int | None]) -> None:
+        """Create new JobWorker object.
+
+        Each thread claims due jobs of the types in `limits` in turn and
+        runs them. A failed job is retried with exponential backoff until
+        it runs out of attempts. At most `limits[job_type]` jobs of a type
+        run at once across all workers, None meaning no limit.
+        """
+        self.threads = threads
+        self.limits = limits
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+
+    def __repr__(self) -> str:
+        return f"  JobWorker ({self.threads} threads, {len(self.limits)} job types)"
+
+    def run(self) -> None:
+        """Run jobs until stop() is called."""
+        workers = [threading.Thread(target=self.work, args=(index,), daemon=True) for index in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def stop(self) -> None:
+        """Stop claiming jobs. Running jobs are finished first."""
+        self.stopping.set()
+
+    def work(self, index: int) -> None:
+        """Claim and run jobs in a worker thread."""
+        job_types = list(self.limits)
+
+        errors = 0
+
+        with app.app_context():
+            while not self.stopping.is_set():
+                try:
+                    # Threads start from different types so that one type doesn't starve the rest
+                    ran = False
+                    for offset in range(len(job_types)):
+                        job_type = job_types[(index + offset) % len(job_types)]
+                        if self.run_next(job_type):
+                            ran = True
+                            break
+                    errors = 0
+
+                except SQLAlchemyError:
+                    # E.g. the database is restarting, the thread waits for it instead of dying
+                    errors += 1
+                    delay = min(JOB_ERROR_MAX_SECONDS, JOB_POLL_SECONDS * 2 ** errors)
+                    logging.exception(f"Job queue unavailable, retrying in {delay:.0f} s")
+                    try:
+                        db.session.rollback()
+                    except SQLAlchemyError:
+                        pass
+                    self.stopping.wait(delay)
+                    continue
+
+                if not ran:
+                    self.stopping.wait(JOB_POLL_SECONDS)
+
+    def run_next(self, job_type: str) -> bool:
+        """Run the next due job of the type. Return False if there was none."""
+        job = claim_job(job_type, self.limits[job_type], JOB_LEASE_SECONDS)
+        if job is None:
+            return False
+
+        job_id, payload, attempts, max_attempts, recurring = job
+        handler, _ = JOB_TYPES[job_type]
+        start = time.monotonic()
+
+        # The lease is renewed while the handler runs, so that a job longer than the lease isn't claimed twice
+        done = threading.Event()
+        renewer = threading.Thread(target=self.renew_lease, args=(job_id, done), daemon=True)
+        renewer.start()
+
+        try:
+            try:
+                handler(payload)
+            finally:
+                done.set()
+                renewer.join()
+        except Exception as error:
+            db.session.rollback()
+
+            if attempts < max_attempts:
+                delay = retry_delay(attempts)
+                logging.exception(f"Job {job_id} ({job_type}) failed, retrying in {delay:.0f} s")
+                fail_job(job_id, repr(error), delay)
+                with self.lock:
+                    self.retried += 1
+            elif recurring:
+                delay = RECURRING_JOB_TYPES[job_type]
+                logging.exception(f"Job {job_id} ({job_type}) failed after {attempts} attempts, "
+                                  f"next run in {delay:.0f} s")
+                reschedule_job(job_id, delay, repr(error))
+                with self.lock:
+                    self.failed += 1
+            else:
+                logging.exception(f"Job {job_id} ({job_type}) failed after {attempts} attempts")
+                fail_job(job_id, repr(error), None)
+                with self.lock:
+                    self.failed += 1
+            return True
+
+        if recurring:
+            reschedule_job(job_id, RECURRING_JOB_TYPES[job_type])
+        else:
+            finish_job(job_id)
+        logging.info(f"Job {job_id} ({job_type}) done in {time.monotonic() - start:.2f} s")
+        with self.lock:
+            self.succeeded += 1
+        return True
+
+    def renew_lease(self, job_id: int, done: threading.Event) -> None:
+        """Renew the lease of a running job every JOB_RENEW_SECONDS until `done` is set."""
+        with app.app_context():
+            while not done.wait(JOB_RENEW_SECONDS):
+                try:
+                    if not renew_job_lease(job_id, JOB_LEASE_SECONDS):
+                        return
+                except SQLAlchemyError:
+                    # The next renewal may still make it before the lease expires
+                    logging.exception(f"Renewing the lease of job {job_id} failed")
+                    db.session.rollback()
+
+    def stats(self) -> dict[str, Any]:
+        """Return worker statistics."""
+        with self.lock:
+            return {'succeeded' : self.succeeded,
+                    'retried'   : self.retried,
+                    'failed'    : self.failed}
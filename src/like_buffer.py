@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import copy
+import os
+
+from typing import Iterable, Iterator
+
+from src.classes      import Like, Reply
+from src.db           import flush_likes_to_db
+from src.write_buffer import WriteBuffer, create_buffer
+
+
+class LikeBuffer(WriteBuffer[tuple[int, int], bool]):
+
+    def __init__(self, flush_seconds: float, max_events: int, max_pending: int) -> None:
+        """Create new LikeBuffer object.
+
+        Like toggles are keyed by reply and user. Only the latest toggle of
+        each user and reply is kept, so opposite toggles net out before
+        they reach the database.
+        """
+        super().__init__('like toggles', flush_seconds, max_events, max_pending)
+
+    def merge(self, older: bool, newer: bool) -> bool:
+        """Keep the latest toggle."""
+        return newer
+
+    def write(self, pending: dict[tuple[int, int], bool]) -> None:
+        """Write the likes and unlikes to the database."""
+        flush_likes_to_db([key for key, liked in pending.items() if liked],
+                          [key for key, liked in pending.items() if not liked])
+
+    def toggle(self, user_id: int, reply_id: int, liked: bool) -> bool:
+        """Queue like (liked=True) or unlike (liked=False) of a reply by the user. Return False if it was dropped."""
+        return self.add((reply_id, user_id), liked)
+
+    def apply_pending(self, user_id: int, replies: Iterable[Reply]) -> Iterator[Reply]:
+        """Yield replies with the user's pending toggles applied to them.
+
+        This keeps the user's own view consistent with their clicks
+        until the toggles have been flushed to the database.
+        """
+        with self.lock:
+            pending = {reply_id: liked for (reply_id, user_id_), liked in self.pending.items() if user_id_ == user_id}
+
+        for reply in replies:
+            liked = pending.get(reply.reply_id)
+
+            if liked is not None and reply.user_id != user_id and reply.has_been_liked_by(user_id) != liked:
+                # The reply may be shared through the page cache, so a copy is modified
+                reply = copy.copy(reply)
+                reply.likes = dict(reply.likes)
+
+                if liked:
+                    reply.likes[user_id] = Like(user_id, reply.reply_id)
+                    reply.like_count += 1
+                else:
+                    del reply.likes[user_id]
+                    reply.like_count -= 1
+
+            yield reply
+
+
+like_buffer = None
+
+if os.getenv('LIKE_BUFFER', '').lower() in ['1', 'true', 'yes']:
+    like_buffer = create_buffer(LikeBuffer, 'LIKE_BUFFER', flush_ms=500)
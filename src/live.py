@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+from typing import Any, Callable, Iterator
+
+import psycopg2
+
+from sqlalchemy.engine import make_url
+
+THREAD_EVENT_CHANNEL       = 'thread_events'
+CACHE_INVALIDATION_CHANNEL = 'cache_invalidation'
+
+KEEPALIVE_SECONDS   = 15
+RECONNECT_SECONDS   = 5
+SUBSCRIBER_MAX_SIZE = 100
+
+
+class ThreadEventHub:
+
+    def __init__(self, database_url: str) -> None:
+        """Create new ThreadEventHub object.
+
+        The hub holds a single LISTEN connection per worker process and fans
+        the notifications out to the clients subscribed to each thread, so
+        that clients never poll the database themselves.
+        """
+        self.database_url = database_url
+        # Events of an SQLite database are published in-process only
+        self.listens = not database_url.startswith('sqlite')
+        self.subscribers : dict[int, set[queue.Queue]] = dict()
+        self.lock = threading.Lock()
+        self.listener : threading.Thread | None = None
+        self.channels : dict[str, Callable[[str], None]] = {THREAD_EVENT_CHANNEL: self.publish_notification}
+        self.on_listen : list[Callable[[], None]] = []
+
+    def __repr__(self) -> str:
+        return f"  ThreadEventHub ({sum(map(len, self.subscribers.values()))} subscribers)"
+
+    def subscribe(self, thread_id: int) -> queue.Queue:
+        """Subscribe to events of a thread. Return the queue of events."""
+        events : queue.Queue = queue.Queue(maxsize=SUBSCRIBER_MAX_SIZE)
+
+        with self.lock:
+            self.subscribers.setdefault(thread_id, set()).add(events)
+
+        self.start()
+        return events
+
+    def add_channel(self,
+                    channel   : str,
+                    handler   : Callable[[str], None],
+                    on_listen : Callable[[], None]
+                    ) -> None:
+        """Pass the payloads of another channel's notifications to the handler.
+
+        `on_listen` is called whenever the listener has (re)connected,
+        as notifications sent while it was disconnected are lost.
+        """
+        with self.lock:
+            self.channels[channel] = handler
+            self.on_listen.append(on_listen)
+
+    def start(self) -> None:
+        """Start the listener unless it's running.
+
+        The listener is started lazily so that it runs in the worker process.
+        """
+        with self.lock:
+            if self.listens and (self.listener is None or not self.listener.is_alive()):
+                self.listener = threading.Thread(target=self.listen, daemon=True)
+                self.listener.start()
+
+    def unsubscribe(self, thread_id: int, events: queue.Queue) -> None:
+        """Remove subscription to events of a thread."""
+        with self.lock:
+            subscribers = self.subscribers.get(thread_id, set())
+            subscribers.discard(events)
+            if not subscribers:
+                self.subscribers.pop(thread_id, None)
+
+    def publish(self, event: dict[str, Any]) -> None:
+        """Deliver event to the subscribers of the event's thread."""
+        with self.lock:
+            subscribers = list(self.subscribers.get(event['thread_id'], set()))
+
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                pass  # Slow client, it'll have to reload the page
+
+    def publish_notification(self, payload: str) -> None:
+        """Deliver event notification to the subscribers of the event's thread."""
+        self.publish(json.loads(payload))
+
+    def listen(self) -> None:
+        """Listen to notifications from the database."""
+        dsn = make_url(self.database_url).set(drivername='postgresql').render_as_string(hide_password=False)
+
+        while True:
+            connection = None
+            try:
+                connection = psycopg2.connect(dsn)
+                connection.set_session(autocommit=True)
+                for channel in self.channels:
+                    connection.cursor().execute(f"LISTEN {channel}")
+
+                for callback in self.on_listen:
+                    callback()
+
+                while True:
+                    if select.select([connection], [], [], KEEPALIVE_SECONDS) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        notification = connection.notifies.pop(0)
+                        # A bad notification mustn't stop the listener thread
+                        try:
+                            self.channels[notification.channel](notification.payload)
+                        except Exception:
+                            logging.exception(f"Handling notification on {notification.channel} failed")
+
+            except psycopg2.Error:
+                if connection is not None:
+                    connection.close()
+                time.sleep(RECONNECT_SECONDS)
+
+    def stream(self, thread_id: int) -> Iterator[str]:
+        """Yield events of a thread in the Server-Sent Events format."""
+        events = self.subscribe(thread_id)
+        try:
+            yield f"retry: {RECONNECT_SECONDS * 1000}\n\n"
+            while True:
+                try:
+                    event = events.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            self.unsubscribe(thread_id, events)
+
+
+thread_event_hub = ThreadEventHub(os.getenv('DATABASE_URL'))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import re
+
+from markupsafe import escape
+
+# Bump when the output of render() changes, so that `manage.py rerender`
+# re-renders the stored content.
+RENDERER_VERSION = 2
+
+# The patterns are applied to escaped text, so they match e.g. &gt; instead of >
+CODE   = re.compile(r"`([^`\n]+)`")
+LINK   = re.compile(r"\[([^\]\n]+)\]\((https?://[^\s)]+)\)")
+URL    = re.compile(r"(?<![\"=>])\bhttps?://[^\s<]+[^\s<.,;:!?)]")
+BOLD   = re.compile(r"\*\*(?=\S)(.+?)(?<=\S)\*\*")
+ITALIC = re.compile(r"(?<![*\w])\*(?=\S)(.+?)(?<=\S)\*(?![*\w])")
+QUOTE  = re.compile(r"^&gt; ?")
+ITEM   = re.compile(r"^[-*] ")
+
+# Finished HTML is set aside behind placeholders of NUL-delimited indexes.
+# NUL characters are removed from the source, so a placeholder can't be forged.
+PLACEHOLDER = re.compile("\x00(\\d+)\x00")
+
+
+def render_emphasis(text: str) -> str:
+    """Render the bold and italic text of an escaped string."""
+    text = BOLD.sub(r"<strong>\1</strong>", text)
+    return ITALIC.sub(r"<em>\1</em>", text)
+
+
+def render_inline(text: str) -> str:
+    """Render code, links, bold and italic text of an escaped line."""
+    stashed : list[str] = []
+
+    def stash(html: str) -> str:
+        stashed.append(html)
+        return f"\x00{len(stashed) - 1}\x00"
+
+    # Code spans and finished links are set aside so that nothing inside them,
+    # e.g. an asterisk in a URL, is formatted. Link labels aren't autolinked.
+    text = CODE.sub(lambda match: stash(f"<code>{match.group(1)}</code>"), text)
+    text = LINK.sub(lambda match: stash(f'<a href="{match.group(2)}" rel="nofollow noopener">'
+                                        f'{render_emphasis(match.group(1))}</a>'), text)
+    text = URL.sub(lambda match: stash(f'<a href="{match.group(0)}" rel="nofollow noopener">{match.group(0)}</a>'),
+                   text)
+    text = render_emphasis(text)
+
+    # A link label may contain code spans, so placeholders are restored until none are left
+    while PLACEHOLDER.search(text):
+        text = PLACEHOLDER.sub(lambda match: stashed[int(match.group(1))], text)
+    return text
+
+
+def render_block(lines: list[str]) -> str:
+    """Render a block of consecutive escaped lines as a quote, list or paragraph."""
+    if all(QUOTE.match(line) for line in lines):
+        return f"<blockquote>{render_block([QUOTE.sub('', line) for line in lines])}</blockquote>"
+
+    if all(ITEM.match(line) for line in lines):
+        items = ''.join(f"<li>{render_inline(ITEM.sub('', line))}</li>" for line in lines)
+        return f"<ul>{items}</ul>"
+
+    return f"<p>{'<br>'.join(render_inline(line) for line in lines)}</p>"
+
+
+def render(source: str) -> str:
+    """Render post source into sanitized HTML.
+
+    Supports a Markdown subset: paragraphs, line breaks, `> ` quotes,
+    `- ` lists, **bold**, *italic*, `code`, [links](https://...) and
+    bare http(s) URLs. All other markup in the source is escaped.
+    """
+    blocks : list[list[str]] = [[]]
+
+    for line in str(escape((source or '').replace('\x00', ''))).replace('\r\n', '\n').split('\n'):
+        if line.strip():
+            blocks[-1].append(line.rstrip())
+        elif blocks[-1]:
+            blocks.append([])
+
+    return ''.join(render_block(lines) for lines in blocks if lines)
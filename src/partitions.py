@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import re
+
+from datetime import datetime
+
+from sqlalchemy     import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from src.db import db, create_tables, IS_SQLITE
+
+# Likes are partitioned by the timestamp of the reply they belong to, so
+# that a reply and its likes always end up in partitions of the same month.
+PARTITIONED_TABLES = ['replies', 'likes']
+
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', 3))
+
+PARTITION_BOUND = re.compile(r"FROM \((.+)\) TO \((.+)\)")
+
+
+###############################################################################
+#                                   HELPERS                                   #
+###############################################################################
+
+def add_months(month: datetime, months: int) -> datetime:
+    """Return the first day of the month `months` after `month`."""
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def get_current_month() -> datetime:
+    """Return the first moment of the current month in database time."""
+    return db.session.execute(text("SELECT date_trunc('month', LOCALTIMESTAMP)")).scalar()
+
+
+def partition_name(table: str, month: datetime) -> str:
+    """Return the name of the table's partition for a month."""
+    return f"{table}_p{month:%Y%m}"
+
+
+def is_partitioned(table: str = 'replies') -> bool:
+    """Return True if the table is partitioned."""
+    if IS_SQLITE:
+        return False
+
+    sql = text("SELECT EXISTS (SELECT 1 "
+               "               FROM pg_partitioned_table, pg_class "
+               "               WHERE pg_partitioned_table.partrelid = pg_class.oid "
+               "                     AND "
+               "                     pg_class.relname = :table)")
+    return db.session.execute(sql, {'table': table}).scalar()
+
+
+def get_partitions(table: str) -> list[tuple[str, datetime | None, datetime, int]]:
+    """Return the partitions of a table as (name, lower_bound, upper_bound, estimated_rows) tuples.
+
+    The lower bound of the archive partition is None.
+    """
+    sql = text("SELECT "
+               "  child.relname, "
+               "  pg_get_expr(child.relpartbound, child.oid), "
+               "  GREATEST(child.reltuples, 0)::BIGINT "
+               "FROM pg_inherits "
+               "  JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent "
+               "  JOIN pg_class AS child  ON child.oid  = pg_inherits.inhrelid "
+               "WHERE parent.relname = :table")
+
+    partitions = []
+    for name, bound, rows in db.session.execute(sql, {'table': table}).fetchall():
+        lower, upper = [None if value == 'MINVALUE' else datetime.fromisoformat(value.strip("'"))
+                        for value in PARTITION_BOUND.search(bound).groups()]
+        partitions.append((name, lower, upper, rows))
+
+    return sorted(partitions, key=lambda partition: partition[2])
+
+
+def create_partition(table: str, month: datetime, parent: str | None = None) -> None:
+    """Create the table's partition for a month if it doesn't exist."""
+    sql = text(f"CREATE TABLE IF NOT EXISTS {partition_name(table, month)} "
+               f"PARTITION OF {parent or table} "
+               f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{add_months(month, 1):%Y-%m-%d}')")
+    db.session.execute(sql)
+
+
+###############################################################################
+#                                  MANAGEMENT                                 #
+###############################################################################
+
+def create_partitions(months_ahead: int = PARTITION_MONTHS_AHEAD) -> list[str]:
+    """Create partitions for the current month and `months_ahead` months after it.
+
+    Inserting a reply fails if there's no partition for its timestamp, so
+    this must run at least every `months_ahead` months. It's run on startup,
+    daily by the `create_partitions` job and by `manage.py partitions create`.
+    Returns the names of the partitions that were created. Does nothing if
+    the tables haven't been partitioned.
+    """
+    if not is_partitioned():
+        return []
+
+    current_month = get_current_month()
+    created = []
+
+    for table in PARTITIONED_TABLES:
+        existing = {name for name, *_ in get_partitions(table)}
+        for months in range(months_ahead + 1):
+            month = add_months(current_month, months)
+            if partition_name(table, month) not in existing:
+                create_partition(table, month)
+                created.append(partition_name(table, month))
+
+    db.session.commit()
+    return created
+
+
+def partition_tables(months_ahead: int = PARTITION_MONTHS_AHEAD) -> bool:
+    """Convert replies and likes into tables partitioned by the month of the reply.
+
+    The data is copied into the new tables in a single transaction that
+    holds an exclusive lock, so the forum should be stopped meanwhile.
+    Returns False if the tables were already partitioned.
+    """
+    if IS_SQLITE:
+        raise ValueError("Partitioning requires PostgreSQL.")
+
+    if is_partitioned():
+        return False
+
+    db.session.execute(text("LOCK TABLE replies, likes IN ACCESS EXCLUSIVE MODE"))
+
+    current_month = get_current_month()
+    first_month = db.session.execute(text("SELECT date_trunc('month', MIN(reply_tstamp)) FROM replies")).scalar()
+    first_month = min(first_month or current_month, current_month)
+
+    for table in PARTITIONED_TABLES:
+        sql = text(f"CREATE TABLE {table}_partitioned ("
+                   f"  LIKE {table} INCLUDING DEFAULTS INCLUDING STORAGE INCLUDING COMPRESSION"
+                   ") PARTITION BY RANGE (reply_tstamp)")
+        db.session.execute(sql)
+
+        month = first_month
+        while month <= add_months(current_month, months_ahead):
+            create_partition(table, month, parent=f"{table}_partitioned")
+            month = add_months(month, 1)
+
+        db.session.execute(text(f"INSERT INTO {table}_partitioned SELECT * FROM {table}"))
+
+    # The old tables own the reply_id sequence and are referenced by the views
+    # and indexes of create_tables(), which are recreated below.
+    for sql in [text("ALTER SEQUENCE replies_reply_id_seq OWNED BY NONE"),
+                text("DROP TABLE likes, replies CASCADE"),
+                text("ALTER TABLE replies_partitioned RENAME TO replies"),
+                text("ALTER TABLE likes_partitioned RENAME TO likes"),
+                text("ALTER SEQUENCE replies_reply_id_seq OWNED BY replies.reply_id"),
+
+                # Unique constraints of a partitioned table must include the partition key
+                text("ALTER TABLE replies "
+                     "ADD CONSTRAINT replies_pkey PRIMARY KEY (reply_id, reply_tstamp), "
+                     "ADD CONSTRAINT replies_thread_id_fkey FOREIGN KEY (thread_id) REFERENCES threads(thread_id), "
+                     "ADD CONSTRAINT replies_user_id_fkey FOREIGN KEY (user_id) REFERENCES users(user_id)"),
+                text("ALTER TABLE likes "
+                     "ADD CONSTRAINT likes_pkey PRIMARY KEY (reply_id, user_id, reply_tstamp), "
+                     "ADD CONSTRAINT likes_reply_id_fkey FOREIGN KEY (reply_id, reply_tstamp) "
+                     "                                   REFERENCES replies(reply_id, reply_tstamp), "
+                     "ADD CONSTRAINT likes_user_id_fkey FOREIGN KEY (user_id) REFERENCES users(user_id)")]:
+        db.session.execute(sql)
+    db.session.commit()
+
+    create_tables()
+    db.session.execute(text("ANALYZE replies, likes"))
+    db.session.commit()
+    return True
+
+
+def archive_partitions(before: datetime) -> int:
+    """Merge the monthly partitions older than `before` into the archive partitions.
+
+    The archive partitions replies_archive and likes_archive cover everything
+    older than the cutoff, so old threads remain readable and searchable, but
+    queries by recent threads skip them. Their pages are packed full, and reply
+    contents are compressed (with lz4 if the server supports it). Returns the
+    number of replies in the archive.
+    """
+    cutoff = datetime(before.year, before.month, 1)
+
+    if cutoff > get_current_month():
+        raise ValueError("The current month can't be archived.")
+
+    if any(lower is None and upper >= cutoff for _, lower, upper, _ in get_partitions('replies')):
+        return db.session.execute(text("SELECT COUNT(*) FROM replies_archive")).scalar()
+
+    partitions = {table: [partition for partition in get_partitions(table) if partition[2] <= cutoff]
+                  for table in PARTITIONED_TABLES}
+
+    for table in PARTITIONED_TABLES:
+        # Rows of TOAST-able values longer than toast_tuple_target bytes are compressed
+        sql = text(f"CREATE TABLE {table}_archive_new ("
+                   f"  LIKE {table} INCLUDING DEFAULTS"
+                   ") WITH (fillfactor = 100, toast_tuple_target = 128)")
+        db.session.execute(sql)
+
+        if table == 'replies':
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(text("ALTER TABLE replies_archive_new ALTER COLUMN content SET COMPRESSION lz4"))
+            except SQLAlchemyError:
+                pass  # Server was built without lz4, use the default pglz
+
+        order = 'thread_id, reply_tstamp' if table == 'replies' else 'reply_id'
+        sql = text(f"INSERT INTO {table}_archive_new "
+                   f"SELECT * FROM {table} WHERE reply_tstamp < '{cutoff:%Y-%m-%d}' "
+                   f"ORDER BY {order}")
+        db.session.execute(sql)
+
+    # Likes reference replies, so they're dropped first
+    for name, *_ in partitions['likes']:
+        db.session.execute(text(f"DROP TABLE {name}"))
+    for name, *_ in partitions['replies']:
+        db.session.execute(text(f"ALTER TABLE replies DETACH PARTITION {name}"))
+        db.session.execute(text(f"DROP TABLE {name}"))
+
+    for table in PARTITIONED_TABLES:
+        db.session.execute(text(f"ALTER TABLE {table}_archive_new RENAME TO {table}_archive"))
+        db.session.execute(text(f"ALTER TABLE {table} "
+                                f"ATTACH PARTITION {table}_archive "
+                                f"FOR VALUES FROM (MINVALUE) TO ('{cutoff:%Y-%m-%d}')"))
+
+    db.session.execute(text("ANALYZE replies_archive, likes_archive"))
+    db.session.commit()
+
+    return db.session.execute(text("SELECT COUNT(*) FROM replies_archive")).scalar()
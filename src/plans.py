@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import inspect
+import json
+import threading
+
+from typing import Any, Callable
+
+from sqlalchemy import event, text
+
+import src.db
+
+from src.db      import (db, IS_SQLITE, statements, invalidation_bus, create_tables, invalidate, commit, insert_users_into_db,
+                         fill_last_reply_ids, refresh_trending, get_user_id_by_username, get_username_by_user_id, category_is_restricted,
+                         user_is_whitelisted, get_category_id_by_thread_id, get_thread_by_thread_id,
+                         iterate_replies_by_thread_id, get_page_of_replies_by_thread_id, get_thread_read_state,
+                         get_thread_summaries_by_thread_ids, get_likes_by_reply_id, user_has_liked_reply,
+                         get_category_summaries, get_unread_thread_ids, get_trending_threads, get_feed_version,
+                         get_feed_entries, search_from_db, get_search_results, search_users, get_username_by_reply_id,
+                         get_username_by_thread_id, get_category_name, category_exists_in_db,
+                         user_has_permission_to_category, get_permission_summary, get_list_of_thread_ids_by_category_id,
+                         get_reply_by_id, get_list_of_replies_by_thread_id, get_likes_by_thread_id)
+from src.markup  import RENDERER_VERSION
+from src.statics import FEED_LIMIT
+
+# Fewer replies than this, and the planner rightly reads whole tables sequentially
+PLAN_MIN_REPLIES = 10_000
+
+# Estimated cost that the plans of single-row and single-thread statements must stay under
+PLAN_MAX_COST = 1000.0
+
+# Public functions of src/db.py with these prefixes read the database, and each must be run by a plan check
+READ_FUNCTION_PREFIXES = ('get_', 'iterate_', 'search_', 'suggest_', 'has_', 'user_', 'category_', 'group_')
+
+# Read functions that no plan check runs, with the reason
+UNCHECKED_READ_FUNCTIONS = {
+    'get_read_bind'                      : "returns the replica engine, runs no statement",
+    'get_user_id_for_session'            : "reads the session, or runs get_user_id_by_username",
+    'get_user_ids_and_names'             : "lists every user for the admin pages",
+    'get_list_of_category_ids_and_names' : "lists every category, a small table",
+    'get_category_data'                  : "lists every category, a small table",
+    'get_forum_category_dict'            : "lists every category, a small table",
+    'group_exists_in_db'                 : "looks up a name in user_groups, a small table",
+    'get_groups'                         : "lists every user group, a small table",
+    'get_trending_scores_query'          : "returns the SQL of the trending view, runs no statement",
+    'get_job_counts'                     : "counts the job queue for the admin statistics",
+    'has_trigram_index'                  : "reads the system catalog",
+    'suggest_titles'                     : "runs suggest_titles_by_trigram or suggest_titles_by_trie",
+    'suggest_titles_by_trigram'          : "needs pg_trgm, and runs under SUGGEST_TIMEOUT_MS",
+    'suggest_titles_by_trie'             : "reads the in-process title trie",
+    'get_titles_for_trie'                : "reads every title to build the title trie, by design"}
+
+SEED_WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipisci', 'velit', 'sed', 'quia',
+              'non', 'numquam', 'eius', 'modi', 'tempora', 'incidunt', 'ut', 'labore', 'et', 'dolore',
+              'magnam', 'aliquam', 'quaerat', 'voluptatem', 'neque', 'porro', 'quisquam', 'est', 'qui', 'dolorem']
+
+
+###############################################################################
+#                                    SEEDING                                  #
+###############################################################################
+
+def random_words(count: int) -> str:
+    """Return SQL expression of `count` random words from the :words array."""
+    return " || ' ' || ".join(["words[1 + floor(random() * cardinality(words))::int]"] * count)
+
+
+def seed_forum(users      : int,
+               categories : int,
+               threads    : int,
+               replies    : int,
+               likes      : int,
+               reads      : int
+               ) -> dict[str, int]:
+    """Fill the database with a large synthetic forum for query plan checks.
+
+    The tables are created if needed. The rows are generated with set-based INSERT ... SELECT statements,
+    one table per transaction. Replies are skewed towards a minority of
+    threads like on a real forum, and every fifth category is restricted.
+    All timestamps fall in the current month, so that a partitioned
+    database has partitions for them. Returns the number of rows
+    inserted per table.
+    """
+    if IS_SQLITE:
+        raise ValueError("Seeding requires PostgreSQL.")
+
+    create_tables()
+
+    counts : dict[str, int] = dict()
+    month_start = "date_trunc('month', LOCALTIMESTAMP)"
+
+    usernames = [f'seed{i}' for i in range(1, users + 1)]
+    counts['users'] = insert_users_into_db(usernames, password='seed')
+    user_ids = [get_user_id_by_username(username) for username in usernames]
+
+    def insert(table: str, sql: str, params: dict[str, Any] | None = None) -> list[int]:
+        """Run seeding statement that returns the new ids, and commit it."""
+        db.session.execute(text("SET LOCAL synchronous_commit = off"))
+        ids = [row[0] for row in db.session.execute(text(sql), {'words'    : SEED_WORDS,
+                                                                'user_ids' : user_ids,
+                                                                **(params or {})})]
+        db.session.commit()
+        counts[table] = len(ids)
+        return ids
+
+    category_ids = insert('categories',
+                          "INSERT INTO categories (name, restricted) "
+                          "SELECT 'Seed ' || " + random_words(2) + ", i % 5 = 0 "
+                          "FROM generate_series(1, :count) AS i, "
+                          "     CAST(:words AS TEXT[]) AS words "
+                          "RETURNING category_id",
+                          {'count': categories})
+
+    insert('permissions',
+           "INSERT INTO permissions (user_id, category_id) "
+           "SELECT DISTINCT user_ids[1 + floor(random() * cardinality(user_ids))::int], categories.category_id "
+           "FROM categories, "
+           "     generate_series(1, 10), "
+           "     CAST(:user_ids AS INTEGER[]) AS user_ids "
+           "WHERE categories.category_id = ANY(:category_ids) "
+           "      AND "
+           "      categories.restricted "
+           "RETURNING permission_id",
+           {'category_ids': category_ids})
+
+    thread_ids = insert('threads',
+                        "INSERT INTO threads (category_id, user_id, thread_tstamp, title, content, "
+                        "                     content_html, render_version) "
+                        "SELECT category_id, user_id, tstamp, title, content, '<p>' || content || '</p>', "
+                        "       :render_version "
+                        "FROM (SELECT "
+                        "        category_ids[1 + floor(random() * cardinality(category_ids))::int] AS category_id, "
+                        "        user_ids[1 + floor(random() * cardinality(user_ids))::int] AS user_id, "
+                        f"       {month_start} + random() * (LOCALTIMESTAMP - {month_start}) AS tstamp, "
+                        f"       {random_words(5)} AS title, "
+                        f"       {random_words(30)} AS content "
+                        "      FROM generate_series(1, :count), "
+                        "           CAST(:words AS TEXT[]) AS words, "
+                        "           CAST(:user_ids AS INTEGER[]) AS user_ids, "
+                        "           CAST(:category_ids AS INTEGER[]) AS category_ids) AS new_threads "
+                        "RETURNING thread_id",
+                        {'count': threads, 'category_ids': category_ids, 'render_version': RENDERER_VERSION})
+
+    # Squaring the random number makes the early threads the busy ones
+    reply_ids = insert('replies',
+                       "INSERT INTO replies (thread_id, user_id, reply_tstamp, content, content_html, render_version) "
+                       "SELECT "
+                       "  threads.thread_id, "
+                       "  picks.user_id, "
+                       "  threads.thread_tstamp + random() * (LOCALTIMESTAMP - threads.thread_tstamp), "
+                       "  picks.content, "
+                       "  '<p>' || picks.content || '</p>', "
+                       "  :render_version "
+                       "FROM (SELECT "
+                       "        thread_ids[1 + floor(power(random(), 2) * cardinality(thread_ids))::int] AS thread_id, "
+                       "        user_ids[1 + floor(random() * cardinality(user_ids))::int] AS user_id, "
+                       f"       {random_words(20)} AS content "
+                       "      FROM generate_series(1, :count), "
+                       "           CAST(:words AS TEXT[]) AS words, "
+                       "           CAST(:user_ids AS INTEGER[]) AS user_ids, "
+                       "           CAST(:thread_ids AS INTEGER[]) AS thread_ids) AS picks "
+                       "  JOIN threads ON threads.thread_id = picks.thread_id "
+                       "RETURNING reply_id",
+                       {'count': replies, 'thread_ids': thread_ids, 'render_version': RENDERER_VERSION})
+
+    if reply_ids:
+        insert('likes',
+               "INSERT INTO likes (reply_id, user_id, reply_tstamp) "
+               "SELECT replies.reply_id, picks.user_id, replies.reply_tstamp "
+               "FROM (SELECT "
+               "        :first_reply_id + floor(random() * :reply_count)::int AS reply_id, "
+               "        user_ids[1 + floor(random() * cardinality(user_ids))::int] AS user_id "
+               "      FROM generate_series(1, :count), "
+               "           CAST(:user_ids AS INTEGER[]) AS user_ids) AS picks "
+               "  JOIN replies ON replies.reply_id = picks.reply_id "
+               "WHERE replies.user_id <> picks.user_id "
+               "ON CONFLICT DO NOTHING "
+               "RETURNING likes.reply_id",
+               {'count'          : likes,
+                'first_reply_id' : min(reply_ids),
+                'reply_count'    : max(reply_ids) - min(reply_ids) + 1})
+
+        sql = text("UPDATE replies "
+                   "SET like_count = like_counts.like_count "
+                   "FROM (SELECT reply_id, COUNT(*) AS like_count "
+                   "      FROM likes "
+                   "      WHERE reply_id BETWEEN :first_reply_id AND :last_reply_id "
+                   "      GROUP BY reply_id) AS like_counts "
+                   "WHERE replies.reply_id = like_counts.reply_id")
+        db.session.execute(sql, {'first_reply_id': min(reply_ids), 'last_reply_id': max(reply_ids)})
+        db.session.commit()
+
+    fill_last_reply_ids()
+
+    insert('thread_reads',
+           "INSERT INTO thread_reads (user_id, thread_id, last_read_reply_id) "
+           "SELECT picks.user_id, threads.thread_id, COALESCE(threads.last_reply_id, 0) "
+           "FROM (SELECT "
+           "        thread_ids[1 + floor(random() * cardinality(thread_ids))::int] AS thread_id, "
+           "        user_ids[1 + floor(random() * cardinality(user_ids))::int] AS user_id "
+           "      FROM generate_series(1, :count), "
+           "           CAST(:user_ids AS INTEGER[]) AS user_ids, "
+           "           CAST(:thread_ids AS INTEGER[]) AS thread_ids) AS picks "
+           "  JOIN threads ON threads.thread_id = picks.thread_id "
+           "ON CONFLICT DO NOTHING "
+           "RETURNING thread_id",
+           {'count': reads, 'thread_ids': thread_ids})
+
+    for key in ['content', 'titles', 'threads', 'categories', 'permissions']:
+        invalidate(key)
+    commit()
+
+    db.session.execute(text("ANALYZE"))
+    db.session.commit()
+    refresh_trending()
+
+    return counts
+
+
+###############################################################################
+#                                    PLANS                                    #
+###############################################################################
+
+def iterate_nodes(plan: dict) -> list[dict]:
+    """Return the nodes of an EXPLAIN (FORMAT JSON) plan tree, the root first."""
+    nodes = [plan]
+    for child in plan.get('Plans', []):
+        nodes.extend(iterate_nodes(child))
+    return nodes
+
+
+def no_seq_scan(*tables: str) -> Callable[[dict], list[str]]:
+    """Return assertion that the plan reads none of the tables, or their partitions, sequentially.
+
+    Scans of empty partitions, e.g. the ones created for future months,
+    cost nothing and are allowed.
+    """
+    def check(plan: dict) -> list[str]:
+        return [f"sequential scan on {node['Relation Name']}"
+                for node in iterate_nodes(plan)
+                if node['Node Type'] == 'Seq Scan'
+                and node['Total Cost'] > 0
+                and any(node['Relation Name'] == table or node['Relation Name'].startswith(table + '_')
+                        for table in tables)]
+    return check
+
+
+def no_cross_join(plan: dict) -> list[str]:
+    """Assert that no nested loop joins every row of one side to every row of the other.
+
+    A nested loop is a cross join if it has no join filter, and its inner
+    side looks up nothing by the outer row. A side of at most one row is
+    allowed, as joining it multiplies nothing.
+    """
+    violations = []
+    for node in iterate_nodes(plan):
+        if node['Node Type'] != 'Nested Loop' or 'Join Filter' in node:
+            continue
+
+        outer, inner = node['Plans'][0], node['Plans'][1]
+        if outer['Plan Rows'] <= 1 or inner['Plan Rows'] <= 1:
+            continue
+
+        if not any(key in inner_node for inner_node in iterate_nodes(inner)
+                   for key in ['Index Cond', 'Recheck Cond', 'Cache Key', 'Hash Cond']):
+            violations.append(f"nested loop cross join of ~{outer['Plan Rows']} x ~{inner['Plan Rows']} rows")
+    return violations
+
+
+def parse_plan(result: Any) -> dict:
+    """Return the root node of an EXPLAIN (FORMAT JSON) result."""
+    plan = json.loads(result) if isinstance(result, str) else result
+    return plan[0]['Plan']
+
+
+def max_cost(limit: float) -> Callable[[dict], list[str]]:
+    """Return assertion that the estimated total cost of the plan is under the limit."""
+    def check(plan: dict) -> list[str]:
+        if plan['Total Cost'] > limit:
+            return [f"estimated cost {plan['Total Cost']:.0f} exceeds {limit:.0f}"]
+        return []
+    return check
+
+
+class PlanRecorder:
+
+    def __init__(self) -> None:
+        """Create new PlanRecorder object.
+
+        While recording, the statements sent to the database are collected
+        with their parameters, so that the plans of exactly the statements
+        that a function of src/db.py runs can be explained afterwards.
+        Statements of other threads, e.g. write buffer flushes, are skipped.
+        """
+        self.executed : list[tuple[str, Any]] = []
+        self.engine = db.engine
+        self.thread_id = threading.get_ident()
+
+    def __repr__(self) -> str:
+        return f"  PlanRecorder ({len(self.executed)} statements)"
+
+    def __enter__(self) -> 'PlanRecorder':
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def record(self, _connection: Any, _cursor: Any, statement: str, parameters: Any, *_: Any) -> None:
+        """Collect a statement that has a plan."""
+        if threading.get_ident() != self.thread_id:
+            return
+        if statement.lstrip().split(None, 1)[0].upper() in ['SELECT', 'WITH', 'EXECUTE', 'INSERT', 'UPDATE', 'DELETE']:
+            self.executed.append((statement, parameters))
+
+    def explain(self) -> list[tuple[str, dict]]:
+        """Return the recorded statements with their plans."""
+        connection = db.session.connection()
+        plans = []
+        for statement, parameters in self.executed:
+            result = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+            plans.append((statement, parse_plan(result)))
+        return plans
+
+
+def sample_parameters() -> dict[str, Any]:
+    """Return the sample values the plans are checked with.
+
+    The sample thread is the busiest one outside the top percent, so
+    that single-thread loads are checked on a long thread, but not on
+    the few threads so long that reading all of their likes sequentially
+    is the right plan. The other samples are its newest reply and
+    category, and a user other than its author.
+    """
+    sample = db.session.execute(text("WITH thread_sizes AS ("
+                                     "  SELECT replies.thread_id, COUNT(*) AS size, MAX(replies.reply_id) AS reply_id "
+                                     "  FROM replies "
+                                     "  GROUP BY replies.thread_id"
+                                     ") "
+                                     "SELECT "
+                                     "  thread_sizes.thread_id, "
+                                     "  thread_sizes.reply_id, "
+                                     "  threads.category_id, "
+                                     "  (SELECT users.user_id "
+                                     "   FROM users "
+                                     "   WHERE users.user_id <> threads.user_id "
+                                     "   ORDER BY users.user_id DESC "
+                                     "   LIMIT 1) AS user_id "
+                                     "FROM thread_sizes "
+                                     "  JOIN threads ON threads.thread_id = thread_sizes.thread_id "
+                                     "ORDER BY thread_sizes.size DESC "
+                                     "OFFSET (SELECT COUNT(*) / 100 FROM thread_sizes) "
+                                     "LIMIT 1")).mappings().fetchone()
+    replies = db.session.execute(text("SELECT COUNT(*) FROM replies")).scalar() or 0
+    if sample is None or sample['user_id'] is None or replies < PLAN_MIN_REPLIES:
+        raise ValueError(f"The plan checks need a database with at least {PLAN_MIN_REPLIES} replies, "
+                         f"run 'manage.py seed' first.")
+
+    # The threads of the sample category stand in for the threads rendered on the index page
+    category_thread_ids = db.session.execute(text("SELECT thread_id "
+                                                  "FROM threads "
+                                                  "WHERE category_id = :category_id "
+                                                  "ORDER BY thread_id "
+                                                  "LIMIT 100"), {'category_id': sample['category_id']}).scalars().all()
+
+    return {**sample,
+            'username'   : get_username_by_user_id(sample['user_id']),
+            'thread_ids' : list(category_thread_ids),
+            'channel'    : 'plans',
+            'limit'      : 20,
+            'offset'     : 0}
+
+
+def get_plan_checks(params    : dict[str, Any],
+                    max_cost_ : float
+                    ) -> list[tuple[str, Callable[[], Any], list[Callable[[dict], list[str]]]]]:
+    """Return the plan checks as (name, function that runs the statements, assertions) tuples."""
+    thread_id, reply_id, category_id, user_id = [params[key] for key in ['thread_id', 'reply_id',
+                                                                           'category_id', 'user_id']]
+    word = SEED_WORDS[0]
+
+    thread_load = [no_seq_scan('replies', 'likes'), max_cost(max_cost_)]
+    lookup      = [no_seq_scan('replies', 'likes', 'threads'), max_cost(max_cost_)]
+    feed        = [no_seq_scan('replies', 'likes', 'threads'), no_cross_join]
+    page_wide: list[Callable[[dict], list[str]]] = [no_cross_join]
+
+    return [
+        ('username lookups',  lambda: (get_user_id_by_username(params['username']),
+                                       get_username_by_user_id(user_id)),                               lookup),
+        ('user search',       lambda: search_users(params['username'][:3]),                             lookup),
+        ('post authors',      lambda: (get_username_by_thread_id(thread_id),
+                                       get_username_by_reply_id(reply_id)),                             lookup),
+        ('category lookups',  lambda: (category_is_restricted(category_id),
+                                       user_is_whitelisted(category_id, user_id),
+                                       user_has_permission_to_category(category_id, user_id),
+                                       category_exists_in_db(get_category_name(category_id) or '')),    lookup),
+        ('category access',   lambda: get_permission_summary(category_id),                              lookup),
+        ('thread category',   lambda: get_category_id_by_thread_id(thread_id),                          lookup),
+        ('reply',             lambda: get_reply_by_id(reply_id),                                        lookup),
+        ('reply likes',       lambda: (get_likes_by_reply_id(reply_id),
+                                       user_has_liked_reply(user_id, reply_id)),                        lookup),
+        ('feed version',      lambda: get_feed_version(category_id),                                    lookup),
+        ('unread threads',    lambda: get_unread_thread_ids(user_id, params['thread_ids']),             lookup),
+        ('thread page',       lambda: (get_thread_by_thread_id(thread_id),
+                                       get_list_of_replies_by_thread_id(thread_id),
+                                       get_likes_by_thread_id(thread_id)),                              thread_load),
+        ('streamed thread',   lambda: list(iterate_replies_by_thread_id(thread_id, user_id)),           thread_load),
+        ('page of replies',   lambda: get_page_of_replies_by_thread_id(thread_id, 1, 20),               thread_load),
+        ('thread read state', lambda: get_thread_read_state(thread_id, user_id),                        thread_load),
+        ('thread summary',    lambda: get_thread_summaries_by_thread_ids([thread_id], user_id),         thread_load),
+        ('category threads',  lambda: get_list_of_thread_ids_by_category_id(category_id),               feed),
+        ('category feed',     lambda: get_feed_entries(category_id, FEED_LIMIT),                        feed),
+        ('forum feed',        lambda: get_feed_entries(None, FEED_LIMIT),                               feed),
+        ('category summary',  lambda: get_category_summaries(user_id),                                  page_wide),
+        ('trending threads',  lambda: get_trending_threads(user_id),                                    page_wide),
+        ('search',            lambda: get_search_results(search_from_db(word)[:1000], user_id, word),   page_wide),
+    ]
+
+
+def get_unchecked_read_functions(checks: list[tuple[str, Callable[[], Any], list]]) -> dict[str, str]:
+    """Return the read functions of src/db.py that no check runs and that aren't exempted, with the problem.
+
+    A check covers the functions its lambda calls by name. Exemptions of
+    functions that no longer exist, or that are checked, are returned too.
+    """
+    read_functions = {name for name, function in inspect.getmembers(src.db, inspect.isfunction)
+                      if function.__module__ == 'src.db' and name.startswith(READ_FUNCTION_PREFIXES)}
+    checked = {name for _, run, _ in checks for name in run.__code__.co_names}
+
+    unchecked = {name: "no plan check runs it, add one or exempt it in UNCHECKED_READ_FUNCTIONS"
+                 for name in read_functions - checked - set(UNCHECKED_READ_FUNCTIONS)}
+    unchecked.update({name: "exempted in UNCHECKED_READ_FUNCTIONS, but isn't an unchecked read function"
+                      for name in set(UNCHECKED_READ_FUNCTIONS) - (read_functions - checked)})
+    return unchecked
+
+
+def check_plans(max_cost_: float = PLAN_MAX_COST) -> list[tuple[str, str, list[str]]]:
+    """Explain the statements that src/db.py runs against the current database and assert plan properties.
+
+    Each check runs its functions once while recording the statements they
+    send, then explains each statement with the same parameters. The
+    registered statements are explained too, with the sample values, so
+    that e.g. the like toggles are checked without running them. Returns
+    (check, statement, violations) tuples for every statement, and for every
+    read function of src/db.py that isn't covered by a check or exempted.
+    """
+    if IS_SQLITE:
+        raise ValueError("Plan checks require PostgreSQL.")
+
+    results = []
+    params = sample_parameters()
+
+    # Cached reads send no statements, so the local caches are cleared first
+    invalidation_bus.clear_all()
+
+    checks = get_plan_checks(params, max_cost_)
+
+    for function, problem in sorted(get_unchecked_read_functions(checks).items()):
+        results.append((f"function {function}", '', [problem]))
+
+    for name, run, assertions in checks:
+        with PlanRecorder() as recorder:
+            run()
+
+        # Cached reads and reads sent to a replica aren't recorded
+        if not recorder.executed:
+            results.append((name, '', ["no statements were recorded, unset DATABASE_REPLICA_URL"]))
+
+        for sql, plan in recorder.explain():
+            violations = [violation for assertion in assertions for violation in assertion(plan)]
+            results.append((name, sql, violations))
+
+    for statement in statements.statements.values():
+        plan = parse_plan(db.session.execute(text("EXPLAIN (FORMAT JSON) " + statement.sql),
+                                             {name: params[name] for name in statement.params}).scalar())
+        violations = no_seq_scan('replies', 'likes')(plan) + max_cost(max_cost_)(plan)
+        results.append((f"statement {statement.name}", statement.sql, violations))
+
+    db.session.rollback()
+    return results
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from typing import Any
+
+from flask import request, session, Response
+
+from app         import app
+from src.statics import USERNAME
+
+# Per-endpoint budgets as (burst, requests per minute). Each client has a
+# bucket per endpoint for both its user and its IP address, and a request
+# must get a token from both. Anonymous clients only have the IP bucket.
+RATE_LIMITS = {'submit_thread' : (5,  2),
+               'submit_reply'  : (10, 6),
+               'like_reply'    : (30, 60),
+               'unlike_reply'  : (30, 60),
+               'register'      : (3,  1),
+               'login'         : (10, 10)}
+
+# How often each process deletes the buckets that have refilled completely
+RATE_LIMIT_PRUNE_SECONDS = 60
+
+
+class RateLimiter:
+
+    def __init__(self, path: str, limits: dict[str, tuple[int, float]]) -> None:
+        """Create new RateLimiter object.
+
+        The token buckets are stored in a SQLite database, so that all
+        worker processes of the server share them. Taking a token is a single
+        UPSERT that refills the bucket by the elapsed time and takes a
+        token only if one is available. A bucket that has been idle long
+        enough to be full again is the same as no bucket, so such rows are
+        deleted every RATE_LIMIT_PRUNE_SECONDS.
+        """
+        self.path = path
+        self.limits = limits
+        self.refill_seconds = max(60 * burst / per_minute for burst, per_minute in limits.values())
+        self.connection : sqlite3.Connection | None = None
+        self.pid : int | None = None
+        self.pruned_at = 0.0
+        self.lock = threading.Lock()
+        self.allowed : dict[str, int] = {endpoint: 0 for endpoint in limits}
+        self.throttled : dict[str, int] = {endpoint: 0 for endpoint in limits}
+
+    def __repr__(self) -> str:
+        return f"  RateLimiter ({self.path})"
+
+    def connect(self) -> sqlite3.Connection:
+        """Return the process's connection to the bucket store. The caller must hold the lock."""
+        # A connection must not be shared with the forked worker processes
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode = WAL")
+            self.connection.execute("PRAGMA synchronous = OFF")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS buckets ("
+                                    "  key TEXT PRIMARY KEY, "
+                                    "  tokens REAL NOT NULL, "
+                                    "  updated REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS buckets_updated_idx "
+                                    "ON buckets (updated)")
+            self.pid = os.getpid()
+        return self.connection
+
+    def take(self, connection: sqlite3.Connection, key: str, burst: int, per_minute: float) -> float:
+        """Take a token from the bucket. Return 0 on success, otherwise the seconds until a token is available."""
+        now = time.time()
+        rate = per_minute / 60
+
+        cursor = connection.execute("INSERT INTO buckets (key, tokens, updated) "
+                                    "VALUES (:key, :burst - 1, :now) "
+                                    "ON CONFLICT (key) DO UPDATE "
+                                    "SET tokens  = MIN(:burst, tokens + (:now - updated) * :rate) - 1, "
+                                    "    updated = :now "
+                                    "WHERE MIN(:burst, tokens + (:now - updated) * :rate) >= 1",
+                                    {'key': key, 'burst': burst, 'now': now, 'rate': rate})
+        if cursor.rowcount:
+            return 0.0
+
+        tokens, updated = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+        return max(0.0, (1 - tokens) / rate - (now - updated))
+
+    def prune(self, connection: sqlite3.Connection) -> None:
+        """Delete the buckets that have refilled completely, at most every RATE_LIMIT_PRUNE_SECONDS."""
+        now = time.time()
+        if now - self.pruned_at < RATE_LIMIT_PRUNE_SECONDS:
+            return
+
+        self.pruned_at = now
+        connection.execute("DELETE FROM buckets WHERE updated < ?", (now - self.refill_seconds,))
+
+    def check(self, endpoint: str, user: str | None, address: str) -> float:
+        """Check request to a rate limited endpoint.
+
+        Return 0 if the request is allowed, otherwise the seconds to wait.
+        The tokens of the IP and user buckets are taken in one transaction,
+        so a request rejected by the user bucket doesn't use up an IP token.
+        """
+        burst, per_minute = self.limits[endpoint]
+
+        with self.lock:
+            connection = self.connect()
+            self.prune(connection)
+
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                wait = self.take(connection, f"{endpoint}:ip:{address}", burst, per_minute)
+                if not wait and user is not None:
+                    wait = self.take(connection, f"{endpoint}:user:{user}", burst, per_minute)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("ROLLBACK" if wait else "COMMIT")
+
+            if wait:
+                self.throttled[endpoint] += 1
+            else:
+                self.allowed[endpoint] += 1
+
+        return wait
+
+    def stats(self) -> dict[str, Any]:
+        """Return limiter statistics of the worker process."""
+        with self.lock:
+            return {endpoint: {'allowed'   : self.allowed[endpoint],
+                               'throttled' : self.throttled[endpoint]}
+                    for endpoint in self.limits}
+
+
+rate_limiter = None
+
+if os.getenv('RATE_LIMIT', '1').lower() not in ['0', 'false', 'no']:
+    rate_limiter = RateLimiter(os.getenv('RATE_LIMIT_DB', os.path.join(tempfile.gettempdir(), 'keskusteluforum-rate-limits.db')),
+                               RATE_LIMITS)
+
+
+@app.before_request
+def throttle() -> Response | None:
+    """Reject requests that exceed the endpoint's budget before they reach the database."""
+    if rate_limiter is None or request.endpoint not in rate_limiter.limits:
+        return None
+
+    wait = rate_limiter.check(request.endpoint, session.get(USERNAME), request.remote_addr or '')
+    if not wait:
+        return None
+
+    return Response("Liian monta pyyntöä, yritä hetken kuluttua uudelleen.\n",
+                    status=429,
+                    mimetype='text/plain',
+                    headers={'Retry-After': str(int(wait) + 1)})
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+from src.db           import flush_thread_reads_to_db
+from src.write_buffer import WriteBuffer, create_buffer
+
+
+class ReadBuffer(WriteBuffer[tuple[int, int], int]):
+
+    def __init__(self, flush_seconds: float, max_events: int, max_pending: int) -> None:
+        """Create new ReadBuffer object.
+
+        Thread views move the user's read watermark of the thread to its
+        latest reply. The watermarks are keyed by user and thread, and
+        only the highest one is kept, so repeated views coalesce into one
+        upsert.
+        """
+        super().__init__('read watermarks', flush_seconds, max_events, max_pending)
+
+    def merge(self, older: int, newer: int) -> int:
+        """Keep the higher watermark, as watermarks never move backwards."""
+        return max(older, newer)
+
+    def write(self, pending: dict[tuple[int, int], int]) -> None:
+        """Upsert the watermarks into the database."""
+        flush_thread_reads_to_db([(user_id, thread_id, reply_id)
+                                  for (user_id, thread_id), reply_id in pending.items()])
+
+    def mark_read(self, user_id: int, thread_id: int, last_read_reply_id: int) -> None:
+        """Queue the user's read watermark of the thread."""
+        self.add((user_id, thread_id), last_read_reply_id)
+
+    def pending_for(self, user_id: int) -> dict[int, int]:
+        """Return the user's pending watermarks as a {thread_id: last_read_reply_id} dictionary.
+
+        This keeps the user's own view consistent with the threads
+        they have read until the watermarks have been flushed.
+        """
+        with self.lock:
+            return {thread_id: reply_id for (user_id_, thread_id), reply_id in self.pending.items()
+                    if user_id_ == user_id}
+
+
+read_buffer = create_buffer(ReadBuffer, 'READ_BUFFER', flush_ms=1000)
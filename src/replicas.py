@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import threading
+import time
+
+from typing import Any
+
+from sqlalchemy        import create_engine, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc    import SQLAlchemyError
+
+
+class ReplicaRouter:
+
+    def __init__(self, urls: list[str], retry_seconds: float) -> None:
+        """Create new ReplicaRouter object.
+
+        Replicas are picked in round-robin order. A replica that fails is
+        skipped until `retry_seconds` have passed and a health check succeeds.
+        """
+        self.engines = [create_engine(url, pool_pre_ping=True) for url in urls]
+        self.retry_seconds = retry_seconds
+        self.unhealthy_until : dict[Engine, float] = dict()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"  ReplicaRouter ({len(self.engines)} replicas, {len(self.unhealthy_until)} unhealthy)"
+
+    def get_bind(self) -> Engine | None:
+        """Return the next healthy replica, or None if there are none."""
+        for _ in range(len(self.engines)):
+            engine = self.engines[next(self.counter) % len(self.engines)]
+
+            with self.lock:
+                until = self.unhealthy_until.get(engine)
+            if until is None:
+                return engine
+
+            if time.monotonic() >= until:
+                if self.is_healthy(engine):
+                    with self.lock:
+                        self.unhealthy_until.pop(engine, None)
+                    return engine
+                self.mark_unhealthy(engine)
+
+        return None
+
+    def mark_unhealthy(self, engine: Engine) -> None:
+        """Skip the replica until the retry period has passed."""
+        with self.lock:
+            self.unhealthy_until[engine] = time.monotonic() + self.retry_seconds
+
+    @staticmethod
+    def is_healthy(engine: Engine) -> bool:
+        """Return True if the replica answers a trivial query."""
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return True
+        except SQLAlchemyError:
+            return False
+
+    def stats(self) -> list[dict[str, Any]]:
+        """Return replica statistics."""
+        with self.lock:
+            return [{'url'     : engine.url.render_as_string(hide_password=True),
+                     'healthy' : engine not in self.unhealthy_until}
+                    for engine in self.engines]
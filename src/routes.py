@@ -20,52 +20,152 @@ You should have received a copy of the GNU General Public License
 along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
 """
 
+import mimetypes
 import os
 
+from datetime import datetime
+
 import argon2
 
-from flask      import render_template, request, flash, session, redirect, url_for, Response
-from sqlalchemy import text
+from flask      import (render_template, stream_template, request, flash, get_flashed_messages, session,
+                        redirect, url_for, Response, jsonify, send_from_directory)
+from sqlalchemy     import text
+from sqlalchemy.exc import OperationalError
 
 from app import app
 
-from src.statics import USERNAME, ADMIN, GET, POST
-from src.db import (db, create_tables, mock_db_content,
+from src.assets      import BUILD_DIR, get_hashed_name
+from src.health      import is_connection_failure
+from src.like_buffer import like_buffer
+from src.live        import thread_event_hub
+from src.partitions  import create_partitions
+from src.rate_limit  import rate_limiter
+from src.read_buffer import read_buffer
+from src.statics     import USERNAME, USER_ID, ADMIN, GET, POST, SEARCH_PAGE_SIZE, FEED_LIMIT
+from src.db import (db, search_cache, category_cache, permission_cache, thread_cache, username_cache, feed_cache,
+                    page_cache, content_generation, invalidation_bus, health_monitor, stale_read,
+                    replica_router, writer_queue, statements, title_trie, create_tables, mock_db_content,
                     insert_admin_account_into_db, insert_new_user_into_db,
-                    get_user_id_for_session, get_user_ids_and_names, get_username_by_reply_id,
+                    get_user_id_for_session, get_username_by_reply_id,
                     get_username_by_thread_id,
-                    insert_category_to_db, delete_category_from_db, category_exists_in_db,
-                    get_list_of_category_ids_and_names,
+                    insert_category_to_db, category_exists_in_db,
+                    get_category_name, get_list_of_category_ids_and_names,
                     insert_thread_into_db, update_thread_in_db, delete_thread_from_db, get_thread_by_thread_id,
+                    get_category_id_by_thread_id, iterate_replies_by_thread_id,
                     insert_reply_into_db, update_reply_in_db, delete_reply_from_db, get_reply_by_id,
-                    insert_like_to_db, delete_like_from_db, user_has_liked_reply,
-                    search_from_db, get_forum_category_dict, insert_permission_into_db, user_has_permission_to_category,
-                    delete_permissions_for_category_from_db)
+                    insert_like_to_db, delete_like_from_db,
+                    search_from_db, get_search_results, get_trending_threads,
+                    get_forum_category_dict, user_has_permission_to_category,
+                    grant_permissions, revoke_permissions, get_permission_summary,
+                    insert_group_into_db, group_exists_in_db, get_groups,
+                    enqueue_job, get_job_counts, get_thread_read_state, get_unread_thread_ids,
+                    get_feed_version, get_feed_entries)
+
+STREAM_THREAD_PAGES = os.getenv('STREAM_THREAD_PAGES', '').lower() in ['1', 'true', 'yes']
+
+FEED_MAX_AGE = int(os.getenv('FEED_MAX_AGE', 60))
+
+# Endpoints that write to the database, rejected in read-only mode
+WRITE_ENDPOINTS = {'create_category', 'delete_category', 'update_category_permissions', 'create_group',
+                   'submit_thread', 'submit_modified_thread', 'delete_thread',
+                   'submit_reply', 'submit_modified_reply', 'delete_reply',
+                   'like_reply', 'unlike_reply', 'register'}
 
 
 ###############################################################################
 #                                     MAIN                                    #
 ###############################################################################
 
+db_initialized = False
+
+
 @app.before_request
 def init_db():
     """Initialize the database tables."""
-    app.before_request_funcs[None].remove(init_db)  # Run only on first request
+    global db_initialized
+    if db_initialized:  # Run only on first request
+        return
+    db_initialized = True
+
     create_tables()
+    create_partitions()
     mock_db_content()
     insert_admin_account_into_db()
 
 
+@app.before_request
+def reject_writes() -> Response | None:
+    """Reject writes gracefully while the forum is in read-only mode."""
+    health_monitor.start()
+
+    if request.endpoint not in WRITE_ENDPOINTS or not health_monitor.read_only:
+        return None
+
+    flash("Foorumi on tilapäisesti vain luku -tilassa. Yritä myöhemmin uudelleen.", category='error')
+
+    if 'thread_id' in request.view_args:
+        return redirect(url_for('thread', thread_id=request.view_args['thread_id']))  # type: ignore
+    return redirect(url_for('index'))  # type: ignore
+
+
+@app.errorhandler(OperationalError)
+def database_unavailable(error: OperationalError) -> Response:
+    """Count a lost connection towards read-only mode, and ask the client to retry.
+
+    Other errors, e.g. statement timeouts, are internal server errors.
+    """
+    db.session.rollback()
+
+    if not is_connection_failure(error):
+        raise error
+    health_monitor.record_failure()
+
+    return Response("Tietokanta ei ole juuri nyt käytettävissä, yritä hetken kuluttua uudelleen.\n",
+                    status=503,
+                    mimetype='text/plain',
+                    headers={'Retry-After': str(int(health_monitor.check_seconds) + 1)})
+
+
+@app.context_processor
+def inject_read_only() -> dict:
+    """Make the read-only mode available in templates."""
+    return {'read_only': health_monitor.read_only}
+
+
 @app.route("/")
 def index() -> str:
     """Return the Index page."""
     if not USERNAME in session.keys():
         return render_template('index.html')
 
+    user_id = get_user_id_for_session()
+    forum_categories = stale_read(page_cache, content_generation, 'index', get_forum_category_dict)
+
+    # In read-only mode only the cached categories are shown
+    trending_threads, unread_thread_ids = [], dict()
+
+    if not health_monitor.read_only:
+        trending_threads = get_trending_threads(user_id)
+
+        # Only the threads of the categories shown to the user are checked
+        shown_thread_ids = [thread_id
+                            for category in forum_categories.values()
+                            if session[USERNAME] == ADMIN
+                            or not category.is_restricted
+                            or category.user_has_permission(user_id)
+                            for thread_id in category.threads]
+        unread_thread_ids = get_unread_thread_ids(user_id, shown_thread_ids)
+
+        for thread_id, last_read_reply_id in read_buffer.pending_for(user_id).items():
+            if unread_thread_ids.get(thread_id, 0) <= last_read_reply_id:
+                unread_thread_ids.pop(thread_id, None)
+
     return render_template('index.html',
                            username=session[USERNAME],
-                           user_id=get_user_id_for_session(),
-                           forum_categories=get_forum_category_dict())
+                           user_id=user_id,
+                           forum_categories=forum_categories,
+                           trending_threads=trending_threads,
+                           unread_thread_ids=unread_thread_ids)
 
 
 ###############################################################################
@@ -78,7 +178,7 @@ def permissions_ok(message     : str,
                    ) -> bool:
     """Check if user has permission to do action."""
     if thread_id is not None and category_id is None:
-        category_id = get_thread_by_thread_id(thread_id).category_id
+        category_id = get_category_id_by_thread_id(thread_id)
 
     if not user_has_permission_to_category(category_id, get_user_id_for_session()):
         flash(message, category='error')
@@ -101,7 +201,7 @@ def new_category() -> str:
         return redirect(url_for('index'))  # type: ignore
 
     return render_template('new_category.html',
-                           user_ids_and_names=get_user_ids_and_names(),
+                           groups=get_groups(),
                            category_name='')
 
 
@@ -117,25 +217,25 @@ def create_category() -> str:
 
     category_name = request.form.get("category_name")
     all_users = request.form.get('all')
-    sel_users = request.form.getlist('sel_users')
+    sel_users = request.form.getlist('sel_users', type=int)
+    sel_groups = request.form.getlist('sel_groups', type=int)
 
     if not category_name:
         flash("Anna kategorialle nimi.", category='error')
     if category_exists_in_db(category_name):
         flash("Kategoria on jo olemassa.", category='error')
-    if all_users is None and not sel_users:
+    if all_users is None and not sel_users and not sel_groups:
         flash("Valitse kategorian näkyvyys.", category='error')
 
     if '_flashes' in session:
         return render_template('new_category.html',
-                               user_ids_and_names=get_user_ids_and_names(),
+                               groups=get_groups(),
                                category_name=category_name)
 
     category_id = insert_category_to_db(category_name, restricted=all_users is None)
 
-    if all_users is None and sel_users:
-        for user_id in sel_users:
-            insert_permission_into_db(category_id, int(user_id))
+    if all_users is None:
+        grant_permissions(category_id, sel_users, sel_groups)
 
     flash(f"Uusi kategoria '{category_name}' luotu", category='success')
     return redirect(url_for('index'))  # type: ignore
@@ -151,19 +251,118 @@ def delete_category(category_id: int) -> str:
         flash("Vain adminit voivat poistaa kategorioita!", category='error')
         return redirect(url_for('index'))  # type: ignore
 
-    category = get_forum_category_dict()[category_id]
+    category_name = get_category_name(category_id)
 
-    for thread_ in category.threads.values():
-        for reply in thread_.replies.values():
-            for like in reply.likes.values():
-                delete_like_from_db(like.user_id, like.reply_id)
-            delete_reply_from_db(reply.reply_id)
-        delete_thread_from_db(thread_.thread_id)
+    if category_name is None:
+        return Response("Category not found", status=404, mimetype='text/plain')
 
-    delete_permissions_for_category_from_db(category_id)
-    delete_category_from_db(category_id)
+    # The content is deleted by `manage.py worker`
+    enqueue_job('delete_category', {'category_id': category_id})
 
-    flash(f"Kategoria '{category.name}' poistettu.", category='success')
+    flash(f"Kategoria '{category_name}' poistetaan taustalla, kun työprosessi "
+          f"(manage.py worker) on käynnissä.", category='success')
+    return redirect(url_for('index'))  # type: ignore
+
+
+@app.route("/category_permissions/<int:category_id>")
+def category_permissions(category_id: int) -> str:
+    """Return the permission management page of a category."""
+    if not USERNAME in session.keys():
+        return redirect(url_for('index'))  # type: ignore
+
+    if session[USERNAME] != ADMIN:
+        flash("Vain adminit voivat muuttaa käyttöoikeuksia!", category='error')
+        return redirect(url_for('index'))  # type: ignore
+
+    category_names = dict(get_list_of_category_ids_and_names())
+
+    if category_id not in category_names:
+        flash("Kategoriaa ei löytynyt.", category='error')
+        return redirect(url_for('index'))  # type: ignore
+
+    user_count, group_ids = get_permission_summary(category_id)
+
+    return render_template('category_permissions.html',
+                           category_id=category_id,
+                           category_name=category_names[category_id],
+                           user_count=user_count,
+                           group_ids=group_ids,
+                           groups=get_groups())
+
+
+@app.route("/update_category_permissions/<int:category_id>", methods=[POST])
+def update_category_permissions(category_id: int) -> str:
+    """Grant or revoke access to a category from the selected users and groups."""
+    if not USERNAME in session.keys():
+        return redirect(url_for('index'))  # type: ignore
+
+    if session[USERNAME] != ADMIN:
+        flash("Vain adminit voivat muuttaa käyttöoikeuksia!", category='error')
+        return redirect(url_for('index'))  # type: ignore
+
+    if get_category_name(category_id) is None:
+        return Response("Category not found", status=404, mimetype='text/plain')
+
+    sel_users = request.form.getlist('sel_users', type=int)
+    sel_groups = request.form.getlist('sel_groups', type=int)
+
+    if request.form.get('action') == 'revoke':
+        revoke_permissions(category_id, sel_users, sel_groups)
+        flash("Käyttöoikeudet poistettu.", category='success')
+    else:
+        grant_permissions(category_id, sel_users, sel_groups)
+        flash("Käyttöoikeudet myönnetty.", category='success')
+
+    return redirect(url_for('category_permissions', category_id=category_id))  # type: ignore
+
+
+###############################################################################
+#                                    GROUPS                                   #
+###############################################################################
+
+@app.route("/new_group")
+def new_group() -> str:
+    """Return the create new user group page."""
+    if not USERNAME in session.keys():
+        return redirect(url_for('index'))  # type: ignore
+
+    if session[USERNAME] != ADMIN:
+        flash("Vain adminit voivat luoda ryhmiä!", category='error')
+        return redirect(url_for('index'))  # type: ignore
+
+    return render_template('new_group.html',
+                           groups=get_groups(),
+                           group_name='')
+
+
+@app.route("/create_group", methods=[POST])
+def create_group() -> str:
+    """Create a new user group."""
+    if not USERNAME in session.keys():
+        return redirect(url_for('index'))  # type: ignore
+
+    if session[USERNAME] != ADMIN:
+        flash("Vain adminit voivat luoda ryhmiä!", category='error')
+        return redirect(url_for('index'))  # type: ignore
+
+    group_name = request.form.get("group_name")
+    sel_users = request.form.getlist('sel_users', type=int)
+
+    if not group_name:
+        flash("Anna ryhmälle nimi.", category='error')
+    elif group_exists_in_db(group_name):
+        flash("Ryhmä on jo olemassa.", category='error')
+    if not sel_users:
+        flash("Valitse ryhmän jäsenet.", category='error')
+
+    if '_flashes' in session:
+        return render_template('new_group.html',
+                               groups=get_groups(),
+                               group_name=group_name)
+
+    insert_group_into_db(group_name, sel_users)
+
+    flash(f"Uusi ryhmä '{group_name}' luotu", category='success')
     return redirect(url_for('index'))  # type: ignore
 
 
@@ -180,10 +379,72 @@ def thread(thread_id: int) -> str:
     if not permissions_ok("Sinulla ei ole pääsyä ketjuun.", thread_id=thread_id):
         return redirect(url_for('index'))  # type: ignore
 
+    user_id = get_user_id_for_session()
+
+    # Streamed pages aren't cached, so in read-only mode the cached page is served instead
+    streamed = STREAM_THREAD_PAGES and not health_monitor.read_only
+
+    if streamed:
+        thread_ = get_thread_by_thread_id(thread_id, include_replies=False)
+        replies = iterate_replies_by_thread_id(thread_id, user_id)
+    else:
+        thread_ = stale_read(page_cache, content_generation, thread_id,
+                             lambda: get_thread_by_thread_id(thread_id))
+        replies = thread_.replies.values()
+
+    # Replies newer than the previous watermark are marked new on this view. The new watermark
+    # is the latest reply shown, which a cached page may not have, or the latest one when streaming.
+    last_read_reply_id = None
+
+    if not health_monitor.read_only:
+        last_reply_id, last_read_reply_id = get_thread_read_state(thread_id, user_id)
+        pending_reply_id = read_buffer.pending_for(user_id).get(thread_id)
+        if pending_reply_id is not None:
+            last_read_reply_id = max(last_read_reply_id or 0, pending_reply_id)
+
+        if not streamed:
+            last_reply_id = max(thread_.replies, default=0)
+        read_buffer.mark_read(user_id, thread_id, last_reply_id)
+
+    if like_buffer is not None:
+        replies = like_buffer.apply_pending(user_id, replies)
+
+    if streamed:
+        # Consume flashed messages before the session is saved,
+        # which happens before the streamed body is sent.
+        get_flashed_messages(with_categories=True)
+
+        return stream_template('thread.html',
+                               user_id=user_id,
+                               username=session[USERNAME],
+                               thread=thread_,
+                               replies=replies,
+                               last_read_reply_id=last_read_reply_id)
+
     return render_template('thread.html',
-                           user_id=get_user_id_for_session(),
+                           user_id=user_id,
                            username=session[USERNAME],
-                           thread=get_thread_by_thread_id(thread_id))
+                           thread=thread_,
+                           replies=replies,
+                           last_read_reply_id=last_read_reply_id)
+
+
+@app.route("/thread/<int:thread_id>/events")
+def thread_events(thread_id: int) -> Response:
+    """Stream live events of the thread as Server-Sent Events."""
+    if not USERNAME in session.keys():
+        return Response(status=401)
+
+    category_id = get_category_id_by_thread_id(thread_id)
+    if category_id is None:
+        return Response("Thread not found", status=404, mimetype='text/plain')
+
+    if not user_has_permission_to_category(category_id, get_user_id_for_session()):
+        return Response(status=403)
+
+    return Response(thread_event_hub.stream(thread_id),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route("/new_thread/", methods=[GET, POST])
@@ -237,10 +498,13 @@ def submit_thread() -> str:
         thread_id = insert_thread_into_db(category_id, get_user_id_for_session(), title, content)
 
         flash(f"Uusi ketju '{title}' luotiin onnistuneesti.", category='success')
+        thread_ = get_thread_by_thread_id(thread_id)
+
         return render_template('thread.html',
                                user_id=get_user_id_for_session(),
                                username=session[USERNAME],
-                               thread=get_thread_by_thread_id(thread_id))
+                               thread=thread_,
+                               replies=thread_.replies.values())
 
     else:
         return redirect(url_for('index'))  # type: ignore
@@ -446,12 +710,21 @@ def like_reply(thread_id: int, reply_id: int) -> str:
     if not permissions_ok("Sinulla ei ole oikeutta tykätä vastauksesta.", thread_id=thread_id):
         return redirect(url_for('index'))  # type: ignore
 
-    if get_username_by_reply_id(reply_id) == session[USERNAME]:
+    if like_buffer is not None:
+        if not like_buffer.toggle(get_user_id_for_session(), reply_id, liked=True):
+            flash("Tykkäystä ei voitu tallentaa, yritä hetken kuluttua uudelleen.", category='error')
+        return redirect(f"/thread/{thread_id}")  # type: ignore
+
+    result = insert_like_to_db(get_user_id_for_session(), reply_id)
+    if result is None:
+        return Response("Reply not found", status=404, mimetype='text/plain')
+
+    is_own_reply, like_count = result
+
+    if is_own_reply:
         flash("Et voi tykätä omasta vastauksestasi.", category='error')
-    elif user_has_liked_reply(get_user_id_for_session(), reply_id):
+    elif like_count is None:
         flash("Et voi tykätä vastauksesta uudestaan.", category='error')
-    else:
-        insert_like_to_db(get_user_id_for_session(), reply_id)
 
     return redirect(f"/thread/{thread_id}")  # type: ignore
 
@@ -465,12 +738,21 @@ def unlike_reply(thread_id: int, reply_id: int) -> str:
     if not permissions_ok("Sinulla ei ole oikeutta poistaa tykkäystä vastauksesta.", thread_id=thread_id):
         return redirect(url_for('index'))  # type: ignore
 
-    if get_username_by_reply_id(reply_id) == session[USERNAME]:
+    if like_buffer is not None:
+        if not like_buffer.toggle(get_user_id_for_session(), reply_id, liked=False):
+            flash("Tykkäyksen poistoa ei voitu tallentaa, yritä hetken kuluttua uudelleen.", category='error')
+        return redirect(f"/thread/{thread_id}")  # type: ignore
+
+    result = delete_like_from_db(get_user_id_for_session(), reply_id)
+    if result is None:
+        return Response("Reply not found", status=404, mimetype='text/plain')
+
+    is_own_reply, like_count = result
+
+    if is_own_reply:
         flash("Et voi tykätä omista vastauksistasi ja siksi poistaa niistä tykkäyksiä.", category='error')
-    elif not user_has_liked_reply(get_user_id_for_session(), reply_id):
+    elif like_count is None:
         flash("Et voi poistaa tykkäystä vastauksesta uudestaan.", category='error')
-    else:
-        delete_like_from_db(get_user_id_for_session(), reply_id)
 
     return redirect(f"/thread/{thread_id}")  # type: ignore
 
@@ -485,7 +767,8 @@ def search_posts() -> str:
     if not USERNAME in session.keys():
         return redirect(url_for('index'))  # type: ignore
 
-    query = request.args["query"]
+    # Normalize whitespace so that equivalent queries share a cache entry
+    query = ' '.join(request.args["query"].split())
 
     if not query:
         flash(f"Et voi hakea tyhjällä syötteellä.", category='error')
@@ -497,21 +780,151 @@ def search_posts() -> str:
         flash(f"Ei tuloksia haulle '{query}'.", category='success')
         return redirect(url_for('index'))  # type: ignore
 
+    page = max(1, request.args.get('page', 1, type=int))
+
+    # Results are filtered by permission in the database
+    results, total_results = get_search_results(thread_ids, get_user_id_for_session(), query, page)
+
+    return render_template('search_results.html',
+                           username=session[USERNAME],
+                           query=query,
+                           results=results,
+                           page=page,
+                           page_count=-(-total_results // SEARCH_PAGE_SIZE))
+
+
+###############################################################################
+#                                    FEEDS                                    #
+###############################################################################
+
+@app.route("/feed.atom")
+def forum_feed() -> Response:
+    """Return Atom feed of the newest threads and replies in the unrestricted categories."""
+    return feed_response(None)
+
+
+@app.route("/category/<int:category_id>/feed.atom")
+def category_feed(category_id: int) -> Response:
+    """Return Atom feed of the newest threads and replies in an unrestricted category."""
+    return feed_response(category_id)
+
+
+def feed_response(category_id: int | None) -> Response:
+    """Return Atom feed, or 304 if the client has the current version.
+
+    Feeds are public, so they're served without login, and restricted
+    categories have none. The feed document is cached until the content
+    version of its categories changes, and the version is its ETag, so
+    a poll of an unchanged feed costs a single primary key lookup.
+    """
+    version = get_feed_version(category_id)
+
+    if version is None:
+        return Response("Feed not found", status=404, mimetype='text/plain')
+
+    etag = '-'.join(str(part) for part in (category_id or 0, *version))
+
+    # The ETag is weak, as the body may be compressed differently
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
     else:
-        category_dict = get_forum_category_dict()
+        document = feed_cache.get(category_id, version)
 
-        # Filter results by permission
-        restricted_categories = [(id_, name) for id_, name in  get_list_of_category_ids_and_names()
-                                 if not user_has_permission_to_category(id_, get_user_id_for_session())]
+        if document is None:
+            entries = get_feed_entries(category_id, FEED_LIMIT)
+            category_name = dict(get_list_of_category_ids_and_names()).get(category_id)
+            document = render_template('feed.xml',
+                                       category_id=category_id,
+                                       category_name=category_name,
+                                       updated=entries[0].published if entries else datetime.now(),
+                                       entries=entries)
+            feed_cache.put(category_id, version, document)
 
-        for category_id, _ in restricted_categories:
-            del category_dict[category_id]
+        response = Response(document, mimetype='application/atom+xml')
 
-        return render_template('search_results.html',
-                               username=session[USERNAME],
-                               query=query,
-                               category_dict=category_dict,
-                               thread_ids=thread_ids)
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = FEED_MAX_AGE
+    return response
+
+
+###############################################################################
+#                                  STATISTICS                                 #
+###############################################################################
+
+@app.route("/admin/stats")
+def stats() -> str | Response:
+    """Return runtime statistics of the worker process as JSON."""
+    if not USERNAME in session.keys():
+        return redirect(url_for('index'))  # type: ignore
+
+    if session[USERNAME] != ADMIN:
+        flash("Vain adminit voivat nähdä tilastot!", category='error')
+        return redirect(url_for('index'))  # type: ignore
+
+    return jsonify({'caches'       : {cache.name: cache.stats()
+                                       for cache in [search_cache, category_cache, permission_cache, thread_cache,
+                                                     username_cache, feed_cache, page_cache]},
+                    'health'       : health_monitor.stats(),
+                    'invalidation' : invalidation_bus.stats(),
+                    'replicas'     : replica_router.stats(),
+                    'like_buffer'  : like_buffer.stats() if like_buffer is not None else None,
+                    'read_buffer'  : read_buffer.stats(),
+                    'rate_limits'  : rate_limiter.stats() if rate_limiter is not None else None,
+                    'sqlite'       : writer_queue.stats() if writer_queue is not None else None,
+                    'statements'   : statements.stats(),
+                    'title_trie'   : title_trie.stats(),
+                    'jobs'         : get_job_counts() if not health_monitor.read_only else None})
+
+
+###############################################################################
+#                                    ASSETS                                   #
+###############################################################################
+
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+
+@app.context_processor
+def inject_asset_url() -> dict:
+    """Make asset_url() available in templates."""
+    return {'asset_url': asset_url}
+
+
+def asset_url(filename: str) -> str:
+    """Return versioned URL of a static file.
+
+    Falls back to the plain static URL if `manage.py build-static`
+    hasn't been run.
+    """
+    hashed_name = get_hashed_name(filename)
+
+    if hashed_name is None:
+        return url_for('static', filename=filename)
+
+    return url_for('assets', filename=hashed_name)
+
+
+@app.route("/assets/<path:filename>")
+def assets(filename: str) -> Response:
+    """Serve content-hashed static file, precompressed if the client accepts it.
+
+    The URL changes whenever the content does, so the file can be cached forever.
+    """
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encodings = request.accept_encodings
+
+    for encoding, extension in [('br', '.br'), ('gzip', '.gz')]:
+        if encodings[encoding] > 0 and os.path.isfile(os.path.join(BUILD_DIR, filename + extension)):
+            response = send_from_directory(BUILD_DIR, filename + extension, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(BUILD_DIR, filename, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 ###############################################################################
@@ -565,7 +978,7 @@ def login() -> str | Response:
     login_error = "Käyttäjätunnusta ei löytynyt tai salasana on väärin."
 
     username = request.form[USERNAME]
-    sql      = text("SELECT password_hash FROM users WHERE username=(:username)")
+    sql      = text("SELECT user_id, password_hash FROM users WHERE username=(:username)")
     result   = db.session.execute(sql, {USERNAME: username}).first()
 
     if result is None:
@@ -575,8 +988,9 @@ def login() -> str | Response:
 
     # Authenticate user with password
     try:
-        argon2.PasswordHasher().verify(result[0], request.form["password"])
+        argon2.PasswordHasher().verify(result[1], request.form["password"])
         session[USERNAME] = username
+        session[USER_ID] = result[0]
         session["csrf_token"] = os.getrandom(32, flags=0).hex()
     except argon2.exceptions.VerifyMismatchError:
         flash(login_error, category='error')
@@ -588,5 +1002,6 @@ def login() -> str | Response:
 def logout():
     """Log out the user."""
     del session[USERNAME]
+    session.pop(USER_ID, None)
     flash('Sinut on nyt kirjattu ulos', category='success')
     return redirect(url_for('index'))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from collections import deque
+from typing      import Any
+
+from sqlalchemy        import event
+from sqlalchemy.engine import Engine
+
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', 30))
+SQLITE_MMAP_SIZE    = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+# Statements that take SQLite's write lock
+WRITE_STATEMENT = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b', re.IGNORECASE)
+
+# Timestamps are declared as TIMESTAMP, so sqlite3 converts them into datetime objects
+SQLITE_ENGINE_OPTIONS = {'connect_args': {'check_same_thread' : False,
+                                          'timeout'           : SQLITE_BUSY_TIMEOUT,
+                                          'detect_types'      : sqlite3.PARSE_DECLTYPES}}
+
+
+def is_sqlite_url(database_url: str | None) -> bool:
+    """Return True if the database URL points to an SQLite database."""
+    return database_url is not None and database_url.startswith('sqlite')
+
+
+class WriterQueue:
+
+    def __init__(self, timeout: float) -> None:
+        """Create new WriterQueue object.
+
+        SQLite allows only one writer at a time. Instead of letting
+        concurrent writers spin on the busy handler until one of them
+        fails with `database is locked`, the connections of the process
+        queue for the write lock in arrival order, and hold it from their
+        first write statement until the transaction ends.
+        """
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.waiting : deque[object] = deque()
+        self.owner : Any = None
+        self.writes = 0
+        self.waits = 0
+        self.max_wait = 0.0
+
+    def __repr__(self) -> str:
+        return f"  WriterQueue ({len(self.waiting)} waiting)"
+
+    def acquire(self, owner: Any) -> None:
+        """Wait for the write lock on behalf of a connection."""
+        with self.condition:
+            if self.owner is owner:
+                return
+
+            ticket = object()
+            self.waiting.append(ticket)
+            start = time.monotonic()
+            try:
+                while self.owner is not None or self.waiting[0] is not ticket:
+                    remaining = start + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        raise sqlite3.OperationalError("database is locked")
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+
+            self.owner = owner
+            waited = time.monotonic() - start
+            self.writes += 1
+            self.waits += waited > 0.001
+            self.max_wait = max(self.max_wait, waited)
+
+    def release(self, owner: Any) -> None:
+        """Release the write lock if the connection holds it."""
+        with self.condition:
+            if self.owner is owner:
+                self.owner = None
+                self.condition.notify_all()
+
+    def stats(self) -> dict[str, Any]:
+        """Return queue statistics."""
+        with self.condition:
+            return {'waiting'     : len(self.waiting),
+                    'writes'      : self.writes,
+                    'waits'       : self.waits,
+                    'max_wait_ms' : round(self.max_wait * 1000, 1)}
+
+
+def configure_engine(engine: Engine, writer_queue: WriterQueue) -> None:
+    """Tune the connections of the engine and serialize its writers through the queue."""
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection: sqlite3.Connection, _: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout = {int(SQLITE_BUSY_TIMEOUT * 1000)}")
+        cursor.execute("PRAGMA foreign_keys = ON")
+        # LIKE is case sensitive in PostgreSQL, and only then can SQLite use indexes for it
+        cursor.execute("PRAGMA case_sensitive_like = ON")
+        cursor.close()
+
+        # The math functions are optional in SQLite builds
+        try:
+            dbapi_connection.execute("SELECT power(2, 2)")
+        except sqlite3.OperationalError:
+            dbapi_connection.create_function('power', 2, math.pow, deterministic=True)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def queue_writer(_: Any, cursor: sqlite3.Cursor, statement: str, *__: Any) -> None:
+        if WRITE_STATEMENT.match(statement):
+            writer_queue.acquire(cursor.connection)
+
+    @event.listens_for(engine, 'commit')
+    @event.listens_for(engine, 'rollback')
+    def release_writer(connection: Any) -> None:
+        writer_queue.release(connection.connection.dbapi_connection)
+
+    # Connections returned to the pool are rolled back without the events above
+    @event.listens_for(engine, 'reset')
+    @event.listens_for(engine, 'close')
+    def release_returned_writer(dbapi_connection: sqlite3.Connection, *_: Any) -> None:
+        writer_queue.release(dbapi_connection)
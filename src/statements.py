@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import re
+import threading
+import time
+
+from typing import Any
+
+from sqlalchemy        import text, TextClause
+from sqlalchemy.engine import Connection
+
+# Named bind parameters as text() recognizes them, e.g. `:thread_id` but not `::text`
+BIND_PARAMETER = re.compile(r'(?<![:\w\\]):(\w+)(?!:)')
+
+# Key of the set of prepared statement names in the DBAPI connection's info dictionary,
+# which SQLAlchemy clears when the connection is replaced.
+PREPARED_KEY = 'prepared_statements'
+
+
+class Statement:
+
+    def __init__(self, name: str, sql: str, prepare: bool) -> None:
+        """Create new Statement object.
+
+        The text() clause is built once. If the statement is prepared,
+        its named parameters are also rewritten into the positional form
+        of PREPARE, and the statement is run with EXECUTE instead.
+        """
+        self.name = name
+        self.sql = sql
+        self.clause = text(sql)
+        self.prepare = prepare
+        self.params = list(dict.fromkeys(BIND_PARAMETER.findall(sql)))
+
+        positions = {param: number for number, param in enumerate(self.params, start=1)}
+        self.prepare_sql = (f"PREPARE {name} AS "
+                            + BIND_PARAMETER.sub(lambda match: f"${positions[match.group(1)]}", sql))
+        self.execute_clause = text(f"EXECUTE {name}({', '.join(f':{param}' for param in self.params)})"
+                                   if self.params else f"EXECUTE {name}")
+
+    def __repr__(self) -> str:
+        return f"  Statement {self.name} ({'prepared' if self.prepare else 'plain'})"
+
+    def columns(self, **types: Any) -> 'Statement':
+        """Set result column types of both clauses, like TextClause.columns()."""
+        self.clause = self.clause.columns(**types)  # type: ignore
+        self.execute_clause = self.execute_clause.columns(**types)  # type: ignore
+        return self
+
+
+class StatementRegistry:
+
+    def __init__(self, prepare: bool) -> None:
+        """Create new StatementRegistry object.
+
+        Statements are registered once at import, so the hot helpers don't
+        rebuild their text() clauses on every call. With `prepare` set,
+        statements registered with prepare=True are prepared on each
+        database connection the first time they run there, after which
+        PostgreSQL skips parsing and, once it settles on a generic plan,
+        planning them.
+        """
+        self.prepare = prepare
+        self.statements : dict[str, Statement] = dict()
+        self.prepares = 0
+        self.executions = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"  StatementRegistry ({len(self.statements)} statements)"
+
+    def register(self, name: str, sql: str, prepare: bool = False) -> Statement:
+        """Register statement under a unique name."""
+        if name in self.statements:
+            raise ValueError(f"Statement {name} has already been registered.")
+
+        statement = Statement(name, sql, prepare and self.prepare)
+        self.statements[name] = statement
+        return statement
+
+    def resolve(self, statement: Statement, connection: Connection) -> TextClause:
+        """Return the clause that runs the statement on the connection, preparing it there first if needed.
+
+        Prepared statements aren't transactional, so a prepared statement
+        outlives the rollback of the transaction that prepared it.
+        """
+        if not statement.prepare:
+            return statement.clause
+
+        prepared = connection.connection.info.setdefault(PREPARED_KEY, set())
+
+        if statement.name not in prepared:
+            connection.exec_driver_sql(statement.prepare_sql.replace('%', '%%'))
+            prepared.add(statement.name)
+            with self.lock:
+                self.prepares += 1
+
+        with self.lock:
+            self.executions += 1
+        return statement.execute_clause
+
+    def stats(self) -> dict[str, Any]:
+        """Return registry statistics."""
+        with self.lock:
+            return {'statements' : len(self.statements),
+                    'prepared'   : sum(statement.prepare for statement in self.statements.values()),
+                    'prepares'   : self.prepares,
+                    'executions' : self.executions}
+
+
+def benchmark_statement(registry   : StatementRegistry,
+                        connection : Connection,
+                        statement  : Statement,
+                        params     : dict,
+                        mode       : str,
+                        iterations : int
+                        ) -> tuple[float, float, float | None, float | None]:
+    """Run the statement `iterations` times and return the mean (wall, client CPU, planning, execution) time per run.
+
+    Mode `text` rebuilds the text() clause on every run like the helpers used to,
+    `registry` reuses the clause built at registration, and `prepared` runs the
+    statement with EXECUTE. The time not spent on the client's CPU is spent on
+    the server or in transit. On PostgreSQL the statement is then run another
+    `iterations` times with EXPLAIN ANALYZE, whose summary gives the planning
+    and execution time spent on the server, otherwise those are None. All times
+    are in seconds.
+    """
+    if mode == 'prepared':
+        clause = registry.resolve(statement, connection)
+    elif mode == 'registry':
+        clause = statement.clause
+    elif mode != 'text':
+        raise ValueError(f"Unknown benchmark mode {mode}.")
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    for _ in range(iterations):
+        if mode == 'text':
+            clause = text(statement.sql)
+        connection.execute(clause, params).fetchall()
+
+    wall = (time.perf_counter() - wall_start) / iterations
+    cpu = (time.process_time() - cpu_start) / iterations
+
+    if connection.dialect.name != 'postgresql':
+        return wall, cpu, None, None
+
+    # A prepared statement is explained through EXECUTE, so a cached generic plan isn't planned again
+    explain = text(f"EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) {clause.text}")
+    planning = execution = 0.0
+
+    for _ in range(iterations):
+        [summary] = connection.execute(explain, params).scalar_one()
+        planning += summary['Planning Time']
+        execution += summary['Execution Time']
+
+    # EXPLAIN reports milliseconds
+    return wall, cpu, planning / iterations / 1000, execution / iterations / 1000
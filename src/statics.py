@@ -21,6 +21,26 @@ along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
 """
 
 USERNAME = 'username'
+USER_ID = 'user_id'
+PRIMARY_UNTIL = 'primary_until'
 ADMIN = 'admin'
 POST = 'POST'
 GET  = 'GET'
+
+SEARCH_PAGE_SIZE  = 20
+
+REPLY_STREAM_BATCH = 100
+
+TRENDING_LIMIT    = 10
+
+FEED_LIMIT        = 30
+
+SUGGEST_LIMIT      = 10
+SUGGEST_MIN_LENGTH = 2
+
+USER_SEARCH_PAGE_SIZE = 20
+
+API_MAX_IDS       = 100
+API_MAX_PAGE_SIZE = 100
+
+JOB_MAX_ATTEMPTS  = 5
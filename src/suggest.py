@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import heapq
+import itertools
+import re
+import threading
+
+from typing import Any, Iterable
+
+# Titles are matched word by word
+WORD = re.compile(r'\w+')
+
+
+class TrieNode:
+
+    __slots__ = ('children', 'thread_ids', 'best')
+
+    def __init__(self) -> None:
+        """Create new TrieNode object.
+
+        `thread_ids` are the threads with a word that ends at the node, and
+        `best` the best ranked threads of the whole subtree, see TitleTrie.
+        """
+        self.children : dict[str, TrieNode] = dict()
+        self.thread_ids : list[int] = []
+        self.best : list[int] = []
+
+
+class TitleTrie:
+
+    def __init__(self, max_candidates: int) -> None:
+        """Create new TitleTrie object.
+
+        Thread titles are indexed by the prefixes of their words, so that
+        a query matches the titles that have a word starting with each of
+        the query's words. It's used for title suggestions when PostgreSQL's
+        pg_trgm extension isn't available. Each node keeps the
+        `max_candidates` shortest titles of its subtree, newest first on
+        ties, and only those of the query's most selective word are
+        considered, which bounds the cost of short queries. The index is
+        replaced as a whole, so a rebuild can run in the background while
+        the previous index keeps answering queries.
+        """
+        self.max_candidates = max_candidates
+        self.root = TrieNode()
+        self.threads : dict[int, tuple[str, int, str]] = dict()
+        self.generation : int | None = None
+        self.rebuilding = False
+        self.rebuilds = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"  TitleTrie ({len(self.threads)} titles)"
+
+    def build(self, threads: Iterable[tuple[int, str, int, str]], generation: int) -> None:
+        """Index (thread_id, title, category_id, category_name) tuples, replacing the previous index."""
+        root = TrieNode()
+        indexed = dict()
+
+        for thread_id, title, category_id, category_name in threads:
+            indexed[thread_id] = (title, category_id, category_name)
+
+            for word in set(WORD.findall(title.lower())):
+                node = root
+                for char in word:
+                    node = node.children.setdefault(char, TrieNode())
+                node.thread_ids.append(thread_id)
+
+        self.rank_subtree(root, lambda thread_id: (len(indexed[thread_id][0]), -thread_id))
+
+        with self.lock:
+            self.root, self.threads, self.generation = root, indexed, generation
+
+    def rank_subtree(self, node: TrieNode, key: Any) -> None:
+        """Fill in the best ranked threads of the node's subtree by key, after those of its children."""
+        for child in node.children.values():
+            self.rank_subtree(child, key)
+
+        ranked = heapq.merge(sorted(node.thread_ids, key=key),
+                             *(child.best for child in node.children.values()),
+                             key=key)
+
+        # A thread with several words that share a prefix is in several subtrees
+        node.best = list(itertools.islice(dict.fromkeys(ranked), self.max_candidates))
+
+    def begin_rebuild(self) -> bool:
+        """Mark the index as being rebuilt. Return False if it already is."""
+        with self.lock:
+            if self.rebuilding:
+                return False
+            self.rebuilding = True
+            self.rebuilds += 1
+            return True
+
+    def end_rebuild(self) -> None:
+        """Mark the rebuild of the index finished."""
+        with self.lock:
+            self.rebuilding = False
+
+    def stats(self) -> dict[str, Any]:
+        """Return index statistics."""
+        with self.lock:
+            return {'titles'     : len(self.threads),
+                    'generation' : self.generation,
+                    'rebuilding' : self.rebuilding,
+                    'rebuilds'   : self.rebuilds}
+
+    def search(self, query: str) -> list[tuple[int, str, int, str]]:
+        """Return (thread_id, title, category_id, category_name) tuples of the matching threads, best first.
+
+        Titles that start with the query come first, then shorter titles before longer ones.
+        """
+        with self.lock:
+            root, threads = self.root, self.threads
+
+        words = set(WORD.findall(query.lower()))
+        nodes = [self.find(root, word) for word in words]
+        if not nodes or None in nodes:
+            return []
+
+        # The candidates come from the word with the fewest titles, and are checked for the other words
+        matches = []
+        for thread_id in min(nodes, key=lambda node: len(node.best)).best:  # type: ignore
+            title_words = WORD.findall(threads[thread_id][0].lower())
+            if all(any(title_word.startswith(word) for title_word in title_words) for word in words):
+                matches.append(thread_id)
+
+        query = query.lower()
+        ranked = sorted(matches, key=lambda thread_id: (not threads[thread_id][0].lower().startswith(query),
+                                                        len(threads[thread_id][0]),
+                                                        -thread_id))
+        return [(thread_id, *threads[thread_id]) for thread_id in ranked]
+
+    def find(self, root: TrieNode, prefix: str) -> TrieNode | None:
+        """Return the node of the prefix, or None if no word starts with it."""
+        node : TrieNode | None = root
+        for char in prefix:
+            node = node.children.get(char)  # type: ignore
+            if node is None:
+                return None
+        return node
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+from abc    import ABC, abstractmethod
+from typing import Any, Callable, Generic, Hashable, TypeVar
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from app    import app
+from src.db import db
+
+Key    = TypeVar('Key', bound=Hashable)
+Value  = TypeVar('Value')
+Buffer = TypeVar('Buffer', bound='WriteBuffer')
+
+# Longest wait between flushes while the database keeps failing
+WRITE_BUFFER_MAX_BACKOFF_SECONDS = 60
+
+
+class WriteBuffer(ABC, Generic[Key, Value]):
+
+    def __init__(self, name: str, flush_seconds: float, max_events: int, max_pending: int) -> None:
+        """Create new WriteBuffer object.
+
+        Writes are queued in-process by key and written to the database in
+        batches every `flush_seconds`, or as soon as `max_events` keys are
+        pending. Writes to a pending key are merged with merge(), so they
+        coalesce before they reach the database. Subclasses implement
+        merge() and write().
+
+        If flushes fail, e.g. while the database is down, they're retried
+        with exponential backoff, and writes to new keys are dropped once
+        `max_pending` keys are pending, so that the buffer can't grow
+        without bound.
+        """
+        self.name = name
+        self.flush_seconds = flush_seconds
+        self.max_events = max_events
+        self.max_pending = max_pending
+        self.pending : dict[Key, Value] = dict()
+        self.lock = threading.Lock()
+        self.flush_needed = threading.Event()
+        self.flusher : threading.Thread | None = None
+        self.failures = 0
+        self.events = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.flushed = 0
+
+    def __repr__(self) -> str:
+        return f"  {type(self).__name__} ({len(self.pending)} pending {self.name})"
+
+    @abstractmethod
+    def merge(self, older: Value, newer: Value) -> Value:
+        """Return the value that replaces two writes to the same key."""
+
+    @abstractmethod
+    def write(self, pending: dict[Key, Value]) -> None:
+        """Write the pending values to the database and commit."""
+
+    def add(self, key: Key, value: Value) -> bool:
+        """Queue a write of value to key. Return False if the buffer was full and the write was dropped."""
+        with self.lock:
+            self.events += 1
+
+            if key in self.pending:
+                self.coalesced += 1
+                value = self.merge(self.pending[key], value)
+            elif len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self.pending[key] = value
+
+            if len(self.pending) >= self.max_events:
+                self.flush_needed.set()
+
+            # The flusher is started lazily so that it runs in the worker process
+            if self.flusher is None or not self.flusher.is_alive():
+                self.flusher = threading.Thread(target=self.run, daemon=True)
+                self.flusher.start()
+        return True
+
+    def flush(self) -> None:
+        """Write pending values to the database."""
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+            self.flush_needed.clear()
+
+        if not pending:
+            return
+
+        with app.app_context():
+            try:
+                self.write(pending)
+            except SQLAlchemyError:
+                db.session.rollback()
+
+                # The failed values are older than the ones queued after the failure
+                with self.lock:
+                    for key, value in pending.items():
+                        self.pending[key] = self.merge(value, self.pending[key]) if key in self.pending else value
+                    self.failures += 1
+                    logging.exception(f"Flushing {self.name} failed, retrying in {self.retry_delay():.0f} s")
+                return
+
+        with self.lock:
+            self.failures = 0
+            self.flushes += 1
+            self.flushed += len(pending)
+
+    def retry_delay(self) -> float:
+        """Return the exponential backoff after the consecutive failed flushes."""
+        return min(WRITE_BUFFER_MAX_BACKOFF_SECONDS, self.flush_seconds * 2 ** self.failures)
+
+    def run(self) -> None:
+        """Flush pending values periodically."""
+        while True:
+            if self.failures:
+                # A full buffer doesn't hurry the retry of a failing database
+                time.sleep(self.retry_delay())
+            else:
+                self.flush_needed.wait(self.flush_seconds)
+            self.flush()
+
+    def stats(self) -> dict[str, Any]:
+        """Return buffer statistics."""
+        with self.lock:
+            return {'pending'   : len(self.pending),
+                    'events'    : self.events,
+                    'coalesced' : self.coalesced,
+                    'dropped'   : self.dropped,
+                    'flushes'   : self.flushes,
+                    'flushed'   : self.flushed}
+
+
+def create_buffer(buffer_class: Callable[[float, int, int], Buffer], env_prefix: str, flush_ms: int) -> Buffer:
+    """Create buffer configured by the `<env_prefix>_FLUSH_MS`, `<env_prefix>_MAX_EVENTS`
+    and `<env_prefix>_MAX_PENDING` variables.
+
+    Pending values are flushed when the process exits.
+    """
+    buffer = buffer_class(int(os.getenv(f'{env_prefix}_FLUSH_MS', flush_ms)) / 1000,
+                          int(os.getenv(f'{env_prefix}_MAX_EVENTS', 1000)),
+                          int(os.getenv(f'{env_prefix}_MAX_PENDING', 100000)))
+    atexit.register(buffer.flush)
+    return buffer
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import tempfile
+
+# The app reads its configuration when it's imported, so the test
+# database is set up first. Tests run in-process against a throwaway
+# SQLite file, unless TEST_DATABASE_URL points to another database.
+TEST_DIR = tempfile.mkdtemp(prefix='keskusteluforum-tests-')
+
+os.environ['DATABASE_URL']   = os.getenv('TEST_DATABASE_URL', f"sqlite:///{os.path.join(TEST_DIR, 'forum.db')}")
+os.environ['SECRET_KEY']     = 'test-secret-key'
+os.environ['ADMIN_PASSWORD'] = 'test-admin-password1'
+os.environ['RATE_LIMIT']     = '0'
+
+for key in ['LIKE_BUFFER', 'DATABASE_REPLICA_URL', 'READ_ONLY', 'STREAM_THREAD_PAGES']:
+    os.environ.pop(key, None)
+
+import pytest
+
+from flask.testing import FlaskClient
+
+from app import app
+
+
+@pytest.fixture
+def client() -> FlaskClient:
+    """Return a test client with its own session."""
+    return app.test_client()
+
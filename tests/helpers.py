@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import re
+
+from flask.testing import FlaskClient
+
+
+def login(client: FlaskClient, username: str, password: str) -> None:
+    """Log the client in."""
+    client.post('/login', data={'username': username, 'password': password})
+
+
+def register(client: FlaskClient, username: str, password: str) -> str:
+    """Register a new user. Return the page, which shows the validation errors if there were any."""
+    return client.post('/register', data={'username'  : username,
+                                          'password1' : password,
+                                          'password2' : password}).get_data(as_text=True)
+
+
+def create_thread(client: FlaskClient, title: str, content: str) -> int:
+    """Create a thread in the first category and return its thread_id."""
+    new_thread = client.get('/new_thread/').get_data(as_text=True)
+    category_id = re.search(r'<option value="(\d+)"', new_thread).group(1)
+
+    page = client.post('/submit_thread/', data={'category_id' : category_id,
+                                                 'title'       : title,
+                                                 'content'     : content}).get_data(as_text=True)
+    return int(re.search(r'/new_reply/(\d+)', page).group(1))
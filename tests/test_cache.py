@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+from app       import app
+from src.cache import MISSING, InvalidationBus, LRUCache, StaleCache
+from src.db    import cached_read, stale_read
+
+
+def test_cached_read_skips_value_evicted_during_load() -> None:
+    bus = InvalidationBus(check_seconds=60)
+    cache = LRUCache('permissions', 10)
+    generation = bus.register('permissions', cache)
+
+    # E.g. a revoke commits, and its notification arrives, while the old row is being loaded
+    def load() -> str:
+        bus.evict('permissions:1')
+        return 'granted'
+
+    with app.app_context():
+        assert cached_read(cache, generation, 1, load) == 'granted'
+        assert cache.get(1, generation.value) is None
+
+        assert cached_read(cache, generation, 1, lambda: 'revoked') == 'revoked'
+        assert cache.get(1, generation.value) == 'revoked'
+
+
+def test_stale_read_skips_value_evicted_during_load() -> None:
+    bus = InvalidationBus(check_seconds=60)
+    cache = StaleCache('pages', 10, max_age=60)
+    generation = bus.register('content', cache)
+
+    def load() -> str:
+        bus.evict('content:1')
+        return 'old page'
+
+    with app.test_request_context():
+        assert stale_read(cache, generation, 1, load) == 'old page'
+        assert cache.get(1, generation.value) == (None, MISSING)
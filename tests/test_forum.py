@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import re
+import secrets
+
+from flask.testing import FlaskClient
+
+from app           import app
+from src.db        import get_likes_by_reply_id, search_from_db
+from tests.helpers import login, register, create_thread
+
+
+def unique_username() -> str:
+    """Return a username that isn't taken, also in a reused test database."""
+    return f"tester_{secrets.token_hex(4)}"
+
+
+def get_flashes(client: FlaskClient) -> list[str]:
+    """Return and clear the flash messages of the client's session."""
+    with client.session_transaction() as session:
+        return [message for _, message in session.pop('_flashes', [])]
+
+
+def get_reply_id(client: FlaskClient, thread_id: int, content: str) -> int:
+    """Return the reply_id of the reply with the content from the thread page."""
+    page = client.get(f'/thread/{thread_id}/').get_data(as_text=True)
+    for reply_id, reply in re.findall(r'id="likes-(\d+)"(.*?)(?=id="likes-|\Z)', page, re.DOTALL):
+        if content in reply:
+            return int(reply_id)
+    raise AssertionError(f"Reply '{content}' not found")
+
+
+###############################################################################
+#                                    USERS                                    #
+###############################################################################
+
+def test_register_and_login(client: FlaskClient) -> None:
+    username = unique_username()
+
+    register(client, username, 'salasana12345')
+    assert 'Olet nyt rekisteröitynyt.' in get_flashes(client)
+
+    login(client, username, 'salasana12345')
+    with client.session_transaction() as session:
+        assert session['username'] == username
+        assert session['user_id'] > 0
+
+    assert username in client.get('/').get_data(as_text=True)
+
+
+def test_register_rejects_short_password(client: FlaskClient) -> None:
+    username = unique_username()
+
+    page = register(client, username, 'lyhyt1')
+    assert "Salasanan on oltava vähintään 12 merkkiä." in page
+
+    login(client, username, 'lyhyt1')
+    with client.session_transaction() as session:
+        assert 'username' not in session
+
+
+def test_login_with_wrong_password(client: FlaskClient) -> None:
+    login(client, 'User1', 'wrong password')
+
+    assert "Käyttäjätunnusta ei löytynyt tai salasana on väärin." in get_flashes(client)
+    with client.session_transaction() as session:
+        assert 'username' not in session
+
+
+###############################################################################
+#                                  CATEGORIES                                 #
+###############################################################################
+
+def test_permissions_of_missing_category(client: FlaskClient) -> None:
+    login(client, 'admin', 'test-admin-password1')
+    response = client.post('/update_category_permissions/999999', data={'sel_users': ['1']})
+    assert response.status_code == 404
+
+
+###############################################################################
+#                                   THREADS                                   #
+###############################################################################
+
+def test_create_thread(client: FlaskClient) -> None:
+    login(client, 'User1', 'User1')
+    thread_id = create_thread(client, 'Testiketju', 'Ketjun **aloitusviesti**')
+
+    page = client.get(f'/thread/{thread_id}/').get_data(as_text=True)
+    assert 'Testiketju' in page
+    assert '<strong>aloitusviesti</strong>' in page
+
+
+def test_create_thread_requires_login(client: FlaskClient) -> None:
+    client.post('/submit_thread/', data={'category_id': '1', 'title': 'Ei kirjautunut', 'content': 'Sisältö'})
+
+    login(client, 'User1', 'User1')
+    assert 'Ei kirjautunut' not in client.get('/search_posts/?query=kirjautunut').get_data(as_text=True)
+
+
+def test_cached_search_results_are_immutable(client: FlaskClient) -> None:
+    login(client, 'User1', 'User1')
+    thread_id = create_thread(client, 'Haettava ketju', 'Hakusanaviesti')
+
+    with app.app_context():
+        thread_ids = search_from_db('Hakusanaviesti')
+        assert isinstance(thread_ids, tuple) and thread_id in thread_ids
+        assert search_from_db('Hakusanaviesti') is thread_ids
+
+
+def test_events_of_missing_thread(client: FlaskClient) -> None:
+    login(client, 'User1', 'User1')
+    assert client.get('/thread/999999/events').status_code == 404
+
+
+###############################################################################
+#                                   REPLIES                                   #
+###############################################################################
+
+def test_reply(client: FlaskClient) -> None:
+    login(client, 'User1', 'User1')
+    thread_id = create_thread(client, 'Vastattava ketju', 'Aloitus')
+
+    other = app.test_client()
+    login(other, 'User2', 'User2')
+    response = other.post(f'/submit_reply/{thread_id}/', data={'content': 'Ensimmäinen vastaus'})
+    assert response.status_code == 302
+
+    assert 'Ensimmäinen vastaus' in client.get(f'/thread/{thread_id}/').get_data(as_text=True)
+
+
+def test_empty_reply_is_rejected(client: FlaskClient) -> None:
+    login(client, 'User1', 'User1')
+    thread_id = create_thread(client, 'Tyhjä vastaus', 'Aloitus')
+
+    page = client.post(f'/submit_reply/{thread_id}/', data={'content': ''}).get_data(as_text=True)
+    assert "Viesti ei voi olla tyhjä." in page
+
+
+###############################################################################
+#                                    LIKES                                    #
+###############################################################################
+
+def test_like_toggles(client: FlaskClient) -> None:
+    login(client, 'User1', 'User1')
+    thread_id = create_thread(client, 'Tykättävä ketju', 'Aloitus')
+
+    author = app.test_client()
+    login(author, 'User2', 'User2')
+    author.post(f'/submit_reply/{thread_id}/', data={'content': 'Tykkää tästä'})
+    reply_id = get_reply_id(client, thread_id, 'Tykkää tästä')
+    with client.session_transaction() as session:
+        user_id = session['user_id']
+
+    client.get(f'/like_reply/{thread_id}/{reply_id}/')
+    with app.app_context():
+        assert user_id in get_likes_by_reply_id(reply_id)
+
+    client.get(f'/like_reply/{thread_id}/{reply_id}/')
+    assert "Et voi tykätä vastauksesta uudestaan." in get_flashes(client)
+
+    client.get(f'/unlike_reply/{thread_id}/{reply_id}/')
+    with app.app_context():
+        assert get_likes_by_reply_id(reply_id) == {}
+
+    client.get(f'/unlike_reply/{thread_id}/{reply_id}/')
+    assert "Et voi poistaa tykkäystä vastauksesta uudestaan." in get_flashes(client)
+
+
+def test_like_of_missing_reply_is_not_found(client: FlaskClient) -> None:
+    login(client, 'User1', 'User1')
+    thread_id = create_thread(client, 'Ketju ilman vastausta', 'Aloitus')
+
+    assert client.get(f'/like_reply/{thread_id}/999999/').status_code == 404
+    assert client.get(f'/unlike_reply/{thread_id}/999999/').status_code == 404
+
+
+def test_like_updates_cached_thread_page(client: FlaskClient) -> None:
+    login(client, 'User1', 'User1')
+    thread_id = create_thread(client, 'Välimuistissa oleva ketju', 'Aloitus')
+
+    author = app.test_client()
+    login(author, 'User2', 'User2')
+    author.post(f'/submit_reply/{thread_id}/', data={'content': 'Tykkää minusta'})
+    reply_id = get_reply_id(client, thread_id, 'Tykkää minusta')
+
+    # The reader hasn't written, so it's served the cached page
+    reader = app.test_client()
+    login(reader, 'User3', 'User3')
+    assert f'<span id="likes-{reply_id}">0</span>' in reader.get(f'/thread/{thread_id}/').get_data(as_text=True)
+
+    client.get(f'/like_reply/{thread_id}/{reply_id}/')
+    assert f'<span id="likes-{reply_id}">1</span>' in reader.get(f'/thread/{thread_id}/').get_data(as_text=True)
+
+    client.get(f'/unlike_reply/{thread_id}/{reply_id}/')
+    assert f'<span id="likes-{reply_id}">0</span>' in reader.get(f'/thread/{thread_id}/').get_data(as_text=True)
+
+
+def test_own_reply_cannot_be_liked(client: FlaskClient) -> None:
+    login(client, 'User2', 'User2')
+    thread_id = create_thread(client, 'Oma vastaus', 'Aloitus')
+    client.post(f'/submit_reply/{thread_id}/', data={'content': 'Oma vastaukseni'})
+    reply_id = get_reply_id(client, thread_id, 'Oma vastaukseni')
+
+    client.get(f'/like_reply/{thread_id}/{reply_id}/')
+    assert "Et voi tykätä omasta vastauksestasi." in get_flashes(client)
+    with app.app_context():
+        assert get_likes_by_reply_id(reply_id) == {}
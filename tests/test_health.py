@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+from sqlalchemy import create_engine
+
+from src.health import HealthMonitor
+
+
+def test_page_load_does_not_end_slowness() -> None:
+    # Every check is slower than a negative latency limit
+    monitor = HealthMonitor(create_engine('sqlite://'), 60, failure_threshold=2, max_latency=-1, forced=False)
+    monitor.check()
+    monitor.check()
+    assert monitor.read_only
+
+    monitor.record_page_load()
+    assert monitor.read_only
+
+    monitor.max_latency = 60
+    monitor.check()
+    assert not monitor.read_only
+
+
+def test_page_load_ends_connection_failures() -> None:
+    monitor = HealthMonitor(create_engine('sqlite://'), 60, failure_threshold=2, max_latency=60, forced=False)
+    monitor.record_failure()
+    monitor.record_failure()
+    assert monitor.read_only
+
+    monitor.record_page_load()
+    assert not monitor.read_only
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import time
+
+import pytest
+
+from sqlalchemy import text
+
+from app      import app
+from src      import jobs
+from src.db   import JOB_MAX_ATTEMPTS, db, create_tables, enqueue_job, enqueue_recurring_job
+from src.jobs import JobWorker
+
+
+@pytest.fixture(autouse=True)
+def tables() -> None:
+    """Create the tables, in case no request has done it yet, and remove the jobs of earlier runs."""
+    with app.app_context():
+        create_tables()
+        sql = text("DELETE "
+                   "FROM jobs "
+                   "WHERE job_type IN ('test_schedule', 'test_failing', 'test_slow')")
+        db.session.execute(sql)
+        db.session.commit()
+
+
+def get_job_rows(job_type: str) -> list:
+    sql = text("SELECT state, attempts, last_error "
+               "FROM jobs "
+               "WHERE job_type = :job_type")
+    return db.session.execute(sql, {'job_type': job_type}).fetchall()
+
+
+def test_recurring_job_is_scheduled_once() -> None:
+    with app.app_context():
+        assert enqueue_recurring_job('test_schedule', delay=60) is not None
+        assert enqueue_recurring_job('test_schedule', delay=60) is None
+        assert len(get_job_rows('test_schedule')) == 1
+
+
+def test_recurring_job_is_rescheduled_after_last_failure(monkeypatch: pytest.MonkeyPatch) -> None:
+    def fail(_: dict) -> None:
+        raise RuntimeError("broken")
+
+    monkeypatch.setitem(jobs.JOB_TYPES, 'test_failing', (fail, 1))
+    monkeypatch.setitem(jobs.RECURRING_JOB_TYPES, 'test_failing', 3600)
+    monkeypatch.setattr(jobs, 'JOB_RETRY_BASE_SECONDS', 0)
+
+    worker = JobWorker(1, {'test_failing': 1})
+    with app.app_context():
+        enqueue_recurring_job('test_failing')
+        for _ in range(JOB_MAX_ATTEMPTS):
+            assert worker.run_next('test_failing')
+
+        [(state, attempts, last_error)] = get_job_rows('test_failing')
+        assert (state, attempts) == ('queued', 0)
+        assert 'broken' in last_error
+        assert not worker.run_next('test_failing')
+        assert enqueue_recurring_job('test_failing') is None
+
+
+def test_lease_is_renewed_while_job_runs(monkeypatch: pytest.MonkeyPatch) -> None:
+    sql = text("SELECT locked_until "
+               "FROM jobs "
+               "WHERE job_type = 'test_slow'")
+    leases = []
+
+    def run_slowly(_: dict) -> None:
+        for _ in range(2):
+            leases.append(db.session.execute(sql).scalar())
+            db.session.rollback()
+            time.sleep(0.5)
+
+    monkeypatch.setitem(jobs.JOB_TYPES, 'test_slow', (run_slowly, 1))
+    monkeypatch.setattr(jobs, 'JOB_RENEW_SECONDS', 0.1)
+
+    worker = JobWorker(1, {'test_slow': 1})
+    with app.app_context():
+        enqueue_job('test_slow')
+        assert worker.run_next('test_slow')
+        assert leases[1] > leases[0]
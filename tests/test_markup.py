@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+from src.markup import render
+
+
+def test_link_label_is_not_autolinked() -> None:
+    html = render('[a https://x.com](https://b.com)')
+    assert html.count('<a ') == 1
+    assert html == '<p><a href="https://b.com" rel="nofollow noopener">a https://x.com</a></p>'
+
+
+def test_link_href_is_not_emphasized() -> None:
+    html = render('[x](https://a.com/*b*) and *c*')
+    assert '<a href="https://a.com/*b*" rel="nofollow noopener">x</a>' in html
+    assert '<em>c</em>' in html
+
+
+def test_link_label_keeps_emphasis_and_code() -> None:
+    html = render('[**a** `b`](https://a.com)')
+    assert html == '<p><a href="https://a.com" rel="nofollow noopener"><strong>a</strong> <code>b</code></a></p>'
+
+
+def test_placeholder_in_source_is_ignored() -> None:
+    assert render('a \x001\x00 `b`') == '<p>a 1 <code>b</code></p>'
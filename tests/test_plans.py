@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import pytest
+
+from sqlalchemy import text
+
+from app       import app
+from src.db    import db, IS_SQLITE
+from src.plans import PLAN_MAX_COST, PLAN_MIN_REPLIES, seed_forum, check_plans, get_plan_checks, get_unchecked_read_functions
+
+
+def test_plan_checks_cover_read_functions() -> None:
+    """Every read function of src/db.py is run by a plan check, or exempted with a reason."""
+    params = {key: None for key in ['thread_id', 'reply_id', 'category_id', 'user_id']}
+    assert get_unchecked_read_functions(get_plan_checks(params, PLAN_MAX_COST)) == {}
+
+
+@pytest.mark.skipif(IS_SQLITE, reason="plan checks require PostgreSQL, set TEST_DATABASE_URL")
+def test_query_plans() -> None:
+    """The statements of src/db.py don't regress to sequential scans or cross joins."""
+    with app.app_context():
+        replies = db.session.execute(text("SELECT COUNT(*) FROM replies")).scalar() or 0
+        if replies < PLAN_MIN_REPLIES:
+            seed_forum(users=1_000, categories=20, threads=10_000, replies=50_000, likes=100_000, reads=20_000)
+
+        results = check_plans()
+
+    failures = [f"{name}: {'; '.join(violations)}\n    {' '.join(statement.split())[:200]}"
+                for name, statement, violations in results if violations]
+    assert not failures, "\n".join(failures)
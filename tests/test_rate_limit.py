@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import tempfile
+
+from src.rate_limit import RateLimiter
+
+
+def create_limiter() -> RateLimiter:
+    """Return a limiter with an endpoint that allows two requests at once."""
+    return RateLimiter(os.path.join(tempfile.mkdtemp(prefix='keskusteluforum-tests-'), 'buckets.db'), {'reply': (2, 1)})
+
+
+def test_user_rejection_keeps_ip_token() -> None:
+    limiter = create_limiter()
+    assert not limiter.check('reply', 'user', '192.0.2.1')
+    assert not limiter.check('reply', 'user', '192.0.2.1')
+
+    # The user's bucket is empty, so the request from another address is
+    # rejected without taking a token from that address' bucket
+    assert limiter.check('reply', 'user', '192.0.2.2')
+    assert not limiter.check('reply', 'other', '192.0.2.2')
+    assert not limiter.check('reply', 'other', '192.0.2.2')
+
+
+def test_full_buckets_are_pruned() -> None:
+    limiter = create_limiter()
+    limiter.check('reply', None, '192.0.2.1')
+
+    connection = limiter.connect()
+    connection.execute("UPDATE buckets SET updated = updated - ?", (limiter.refill_seconds + 1,))
+    limiter.pruned_at = 0.0
+
+    limiter.check('reply', None, '192.0.2.2')
+    assert [key for key, in connection.execute("SELECT key FROM buckets")] == ['reply:ip:192.0.2.2']
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import pytest
+
+from flask.testing import FlaskClient
+from sqlalchemy    import event
+
+from app           import app
+from src.db        import db, replica_router, insert_reply_into_db, iterate_replies_by_thread_id
+from src.statics   import REPLY_STREAM_BATCH
+from tests.helpers import login, create_thread
+
+
+def test_streamed_read_from_replica_is_not_buffered(client: FlaskClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    login(client, 'User1', 'User1')
+    thread_id = create_thread(client, 'Pitkä ketju', 'Aloitus')
+    with client.session_transaction() as session:
+        user_id = session['user_id']
+
+    with app.app_context():
+        for index in range(REPLY_STREAM_BATCH * 3):
+            insert_reply_into_db(thread_id, user_id, f'Vastaus {index}')
+
+        # The primary stands in for a replica, which is read through connections of its own
+        monkeypatch.setattr(replica_router, 'get_bind', lambda: db.engine)
+
+        cursors = []
+        def record(_connection, cursor, statement, *_) -> None:
+            if 'FROM replies, users' in statement:
+                cursors.append(cursor)
+
+        event.listen(db.engine, 'after_cursor_execute', record)
+        try:
+            replies = iterate_replies_by_thread_id(thread_id, user_id)
+            next(replies)
+
+            # Only the first batch has been fetched, the rest is still on the server
+            assert cursors and cursors[0].fetchone() is not None
+            replies.close()
+        finally:
+            event.remove(db.engine, 'after_cursor_execute', record)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+
+import pytest
+
+from sqlalchemy        import create_engine, text
+from sqlalchemy.engine import Engine
+
+from src.sqlite import SQLITE_ENGINE_OPTIONS, WriterQueue, configure_engine
+
+
+def wait_until_waiting(queue: WriterQueue, count: int) -> None:
+    """Wait until `count` connections are queued for the write lock."""
+    deadline = time.monotonic() + 5
+    while len(queue.waiting) < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def create_queued_engine(path: str, queue: WriterQueue) -> Engine:
+    """Return an engine of an SQLite file whose writers queue in `queue`, with a table to write to."""
+    engine = create_engine(f"sqlite:///{path}", **SQLITE_ENGINE_OPTIONS)  # type: ignore
+    configure_engine(engine, queue)
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE counts (value INTEGER)"))
+    return engine
+
+
+def test_writers_get_the_lock_in_arrival_order() -> None:
+    queue = WriterQueue(timeout=5)
+    queue.acquire('first')
+    order = []
+
+    def write(owner: str) -> None:
+        queue.acquire(owner)
+        order.append(owner)
+        queue.release(owner)
+
+    writers = []
+    for index, owner in enumerate(['second', 'third', 'fourth']):
+        writers.append(threading.Thread(target=write, args=(owner,)))
+        writers[-1].start()
+        wait_until_waiting(queue, index + 1)
+
+    queue.release('first')
+    for writer in writers:
+        writer.join()
+    assert order == ['second', 'third', 'fourth']
+
+
+def test_waiting_writer_times_out() -> None:
+    queue = WriterQueue(timeout=0.05)
+    queue.acquire('first')
+
+    with pytest.raises(sqlite3.OperationalError, match="database is locked"):
+        queue.acquire('second')
+    assert not queue.waiting
+
+    queue.release('first')
+    queue.acquire('second')
+    assert queue.owner == 'second'
+
+
+def test_lock_is_released_on_rollback_and_close(tmp_path: Path) -> None:
+    queue = WriterQueue(timeout=5)
+    engine = create_queued_engine(str(tmp_path / 'forum.db'), queue)
+
+    with engine.connect() as connection:
+        connection.execute(text("INSERT INTO counts VALUES (1)"))
+        assert queue.owner is not None
+        connection.rollback()
+        assert queue.owner is None
+
+        # Returning the connection to the pool rolls back the open transaction
+        connection.execute(text("INSERT INTO counts VALUES (1)"))
+        assert queue.owner is not None
+    assert queue.owner is None
+
+
+def test_concurrent_writers_all_commit(tmp_path: Path) -> None:
+    queue = WriterQueue(timeout=5)
+    engine = create_queued_engine(str(tmp_path / 'forum.db'), queue)
+
+    def write() -> None:
+        for _ in range(20):
+            with engine.begin() as connection:
+                connection.execute(text("INSERT INTO counts VALUES (1)"))
+                connection.execute(text("UPDATE counts SET value = value + 1"))
+
+    writers = [threading.Thread(target=write) for _ in range(8)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT COUNT(*) FROM counts")).scalar() == 160
+    assert queue.stats()['writes'] == 1 + 160
+    assert queue.owner is None
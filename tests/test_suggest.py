@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+from src.suggest import TitleTrie
+
+
+def test_trie_keeps_the_best_candidates() -> None:
+    trie = TitleTrie(max_candidates=2)
+    trie.build([(1, 'Kesämökin pitkä remonttiketju', 1, 'Yleinen'),
+                (2, 'Kesä', 1, 'Yleinen'),
+                (3, 'Kesän tapahtumat', 1, 'Yleinen'),
+                (4, 'Talven ja kesän renkaat', 1, 'Yleinen')], generation=0)
+
+    assert [thread_id for thread_id, *_ in trie.search('kes')] == [2, 3]
+
+
+def test_trie_matches_every_query_word() -> None:
+    trie = TitleTrie(max_candidates=10)
+    trie.build([(1, 'Kesän renkaat', 1, 'Yleinen'),
+                (2, 'Talven renkaat', 1, 'Yleinen'),
+                (3, 'Renkaiden kesäsäilytys', 1, 'Yleinen')], generation=0)
+
+    assert [thread_id for thread_id, *_ in trie.search('renk kes')] == [1, 3]
+    assert trie.search('renk syksy') == []
+    assert trie.search('') == []
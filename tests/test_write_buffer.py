@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Keskusteluforum
+
+Copyright (C) 2024  Markus Ottela
+
+This file is part of Keskusteluforum.
+
+Keskusteluforum is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+Keskusteluforum is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Keskusteluforum. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import threading
+
+import pytest
+
+from sqlalchemy.exc import OperationalError
+
+from src.write_buffer import WriteBuffer
+
+
+class FailingBuffer(WriteBuffer[int, int]):
+
+    def merge(self, older: int, newer: int) -> int:
+        return older + newer
+
+    def write(self, pending: dict[int, int]) -> None:
+        raise OperationalError("INSERT", {}, Exception("database is down"))
+
+
+def test_write_buffer_is_abstract() -> None:
+    with pytest.raises(TypeError):
+        WriteBuffer('nothing', 1.0, 10, 10)  # type: ignore
+
+
+def test_failed_flushes_back_off_and_cap_pending() -> None:
+    buffer = FailingBuffer('counts', 0.5, 10, max_pending=2)
+    buffer.flusher = threading.current_thread()  # Keeps add() from starting the flusher thread
+
+    assert buffer.add(1, 1)
+    assert buffer.add(2, 1)
+    assert not buffer.add(3, 1)
+    assert buffer.add(1, 1)
+
+    for failures in range(1, 4):
+        buffer.flush()
+        assert buffer.failures == failures
+    assert buffer.retry_delay() == 4.0
+    assert buffer.pending == {1: 2, 2: 1}
+    assert buffer.stats()['dropped'] == 1